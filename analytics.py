@@ -0,0 +1,369 @@
+import threading
+from collections import namedtuple
+import numpy as np
+
+from models import (db, Portfolio, PortfolioComposition, PortfolioNameHistory,
+                    Security, Region, AssetClass)
+
+
+'''
+ExposureMatrix
+    the portfolios x securities weight matrix of every portfolio
+
+    The matrix is kept in coordinate form (one row, column and weight per
+    composition) so it costs memory in the number of compositions rather
+    than in portfolios times securities. Region and asset class rollups are
+    the products of the matrix with the one-hot encodings of the securities,
+    summed from the non-zero entries with a single bincount.
+'''
+
+
+class ExposureMatrix:
+    def __init__(self, portfolio_ids, security_ids, rows, columns, weights,
+                 region_codes, asset_class_codes, region_ids,
+                 asset_class_ids, region_names, asset_class_names):
+        self.portfolio_ids = portfolio_ids
+        self.security_ids = security_ids
+        self.rows = rows
+        self.columns = columns
+        self.weights = weights
+        self.region_codes = region_codes
+        self.asset_class_codes = asset_class_codes
+        self.region_ids = region_ids
+        self.asset_class_ids = asset_class_ids
+        self.region_names = region_names
+        self.asset_class_names = asset_class_names
+
+    @property
+    def shape(self):
+        return len(self.portfolio_ids), len(self.security_ids)
+
+    def dense(self):
+        matrix = np.zeros(self.shape)
+        matrix[self.rows, self.columns] = self.weights
+        return matrix
+
+    def product(self, codes, size):
+        '''
+        the product of the matrix with the one-hot encoding of `codes`,
+        computed from the non-zero entries only
+        '''
+        count = self.shape[0]
+        return np.bincount(
+            self.rows * size + codes[self.columns], weights=self.weights,
+            minlength=count * size).reshape(count, size)
+
+    def by_region(self):
+        return self.product(self.region_codes, len(self.region_ids))
+
+    def by_asset_class(self):
+        return self.product(self.asset_class_codes, len(self.asset_class_ids))
+
+
+'''
+load_exposure_matrix()
+    builds the ExposureMatrix from one columnar fetch of the composition
+    table and one of the security table. The region and asset class codes
+    index the ids read along with them, so rows added by another process
+    (or written around the session, like manage.py generate) are counted
+    under their own names.
+'''
+
+
+def reference_codes(model, referenced_ids):
+    names = dict(db.session.query(model.id, model.name))
+    ids, codes = np.unique(np.concatenate([
+        np.array(list(names), dtype=np.int64), referenced_ids]),
+        return_inverse=True)
+    return ids, codes[len(names):], [names[id] for id in ids.tolist()]
+
+
+def load_exposure_matrix():
+    portfolio_ids = np.array(
+        [portfolio_id for portfolio_id, in db.session.query(
+            Portfolio.id).order_by(Portfolio.id)], dtype=np.int64)
+    securities = np.array(db.session.query(
+        Security.id, Security.region_id, Security.asset_class_id
+    ).order_by(Security.id).all(), dtype=np.int64).reshape(-1, 3)
+    compositions = np.array(db.session.query(
+        PortfolioComposition.portfolio_id,
+        PortfolioComposition.security_id,
+        PortfolioComposition.weight
+    ).all(), dtype=np.int64).reshape(-1, 3)
+
+    # read after the securities, so every region and asset class they
+    # reference is in the table
+    region_ids, region_codes, region_names = reference_codes(
+        Region, securities[:, 1])
+    asset_class_ids, asset_class_codes, asset_class_names = reference_codes(
+        AssetClass, securities[:, 2])
+
+    security_ids = securities[:, 0]
+    return ExposureMatrix(
+        portfolio_ids,
+        security_ids,
+        np.searchsorted(portfolio_ids, compositions[:, 0]),
+        np.searchsorted(security_ids, compositions[:, 1]),
+        compositions[:, 2].astype(np.float64),
+        region_codes,
+        asset_class_codes,
+        region_ids,
+        asset_class_ids,
+        region_names,
+        asset_class_names)
+
+
+'''
+exposure_report(matrix)
+    the per-portfolio region and asset class rollups of the matrix, plus
+    the firm-wide rollups averaged over all portfolios
+'''
+
+
+def exposure_report(matrix):
+    regions = matrix.region_names
+    asset_classes = matrix.asset_class_names
+    by_region = matrix.by_region()
+    by_asset_class = matrix.by_asset_class()
+
+    def firm_wide(rollup, names):
+        if rollup.shape[0] == 0:
+            return {name: 0.0 for name in names}
+        return dict(zip(names, rollup.mean(axis=0).tolist()))
+
+    return {
+        'portfolio_ids': matrix.portfolio_ids.tolist(),
+        'regions': regions,
+        'asset_classes': asset_classes,
+        'by_region': by_region.tolist(),
+        'by_asset_class': by_asset_class.tolist(),
+        'firm_by_region': firm_wide(by_region, regions),
+        'firm_by_asset_class': firm_wide(by_asset_class, asset_classes)
+    }
+
+
+'''
+SimilarityIndex
+    sparse portfolio weight vectors for top-k similarity queries
+
+    Each portfolio's compositions are cached with the portfolio version they
+    were read at. Before every query one SELECT of the portfolio ids and
+    versions tells which portfolios were written since (by any worker), and
+    only those are reloaded; the flat arrays used for scoring are rebuilt
+    from the cached vectors with a few numpy concatenations. The version is
+    paired with the id of the portfolio's open name history row, which a
+    portfolio created again under a deleted one's id doesn't share even
+    though its version starts over.
+'''
+
+
+SimilarityMatrix = namedtuple('SimilarityMatrix', [
+    'portfolio_ids', 'names', 'rows', 'security_ids', 'weights', 'norms'])
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self.reloaded = 0
+        self._vectors = {}
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._vectors = {}
+            self._matrix = None
+
+    def refresh(self):
+        portfolios = db.session.query(
+            Portfolio.id, Portfolio.version, PortfolioNameHistory.id,
+            Portfolio.name
+        ).outerjoin(PortfolioNameHistory, db.and_(
+            PortfolioNameHistory.portfolio_id == Portfolio.id,
+            PortfolioNameHistory.valid_to.is_(None))).all()
+
+        with self._lock:
+            versions = {portfolio_id: (version, name_history_id)
+                        for portfolio_id, version, name_history_id, _
+                        in portfolios}
+            names = {portfolio_id: name
+                     for portfolio_id, _, _, name in portfolios}
+            stale = [portfolio_id for portfolio_id, version in versions.items()
+                     if self._vectors.get(portfolio_id, (None,))[0] != version]
+            removed = [portfolio_id for portfolio_id in self._vectors
+                       if portfolio_id not in versions]
+
+            if self._matrix is not None and not stale and not removed:
+                return self._matrix
+
+            for portfolio_id in removed:
+                del self._vectors[portfolio_id]
+            self._load_vectors(stale, versions)
+            self._matrix = self._build(names)
+            return self._matrix
+
+    def _load_vectors(self, portfolio_ids, versions):
+        if not portfolio_ids:
+            return
+
+        query = db.session.query(
+            PortfolioComposition.portfolio_id,
+            PortfolioComposition.security_id,
+            PortfolioComposition.weight)
+        if len(portfolio_ids) < len(versions):
+            query = query.filter(
+                PortfolioComposition.portfolio_id.in_(portfolio_ids))
+        compositions = np.array(query.all(), dtype=np.int64).reshape(-1, 3)
+        compositions = compositions[
+            np.isin(compositions[:, 0], portfolio_ids)]
+
+        # group the rows by portfolio
+        compositions = compositions[
+            np.argsort(compositions[:, 0], kind='stable')]
+        starts = np.searchsorted(compositions[:, 0], portfolio_ids)
+        ends = np.searchsorted(compositions[:, 0], portfolio_ids, side='right')
+        for portfolio_id, start, end in zip(portfolio_ids, starts, ends):
+            self._vectors[portfolio_id] = (
+                versions[portfolio_id],
+                compositions[start:end, 1],
+                compositions[start:end, 2].astype(np.float64))
+        self.reloaded += len(portfolio_ids)
+
+    def _build(self, names):
+        portfolio_ids = sorted(self._vectors)
+        vectors = [self._vectors[portfolio_id] for portfolio_id in portfolio_ids]
+        lengths = [len(security_ids) for _, security_ids, _ in vectors]
+        rows = np.repeat(np.arange(len(portfolio_ids)), lengths)
+        weights = np.concatenate(
+            [weights for _, _, weights in vectors] or [np.zeros(0)])
+
+        return SimilarityMatrix(
+            np.array(portfolio_ids, dtype=np.int64),
+            [names[portfolio_id] for portfolio_id in portfolio_ids],
+            rows,
+            np.concatenate([security_ids for _, security_ids, _ in vectors]
+                           or [np.zeros(0, dtype=np.int64)]),
+            weights,
+            np.sqrt(np.bincount(
+                rows, weights=weights ** 2, minlength=len(portfolio_ids))))
+
+    '''
+    vector(portfolio_id, matrix)
+        the composition of the portfolio as a security id -> weight mapping,
+        read from `matrix` (refreshed when not given), or None when there
+        is no such portfolio
+    '''
+
+    def vector(self, portfolio_id, matrix=None):
+        if matrix is None:
+            matrix = self.refresh()
+        row = np.searchsorted(matrix.portfolio_ids, portfolio_id)
+        if row == len(matrix.portfolio_ids) or \
+                matrix.portfolio_ids[row] != portfolio_id:
+            return None
+        start, end = np.searchsorted(matrix.rows, [row, row + 1])
+        return dict(zip(matrix.security_ids[start:end].tolist(),
+                        matrix.weights[start:end].tolist()))
+
+    '''
+    top_k(composition, k, exclude, matrix)
+        the k portfolios most similar to `composition` (a security id ->
+        weight mapping), ranked both by weight overlap (the sum over
+        securities of the smaller of the two weights) and by cosine
+        similarity of the weight vectors. `matrix` saves the refresh when
+        the caller already has one.
+    '''
+
+    def top_k(self, composition, k, exclude=None, matrix=None):
+        if matrix is None:
+            matrix = self.refresh()
+        count = len(matrix.portfolio_ids)
+
+        query_ids = np.array(sorted(composition), dtype=np.int64)
+        query_weights = np.array(
+            [composition[security_id] for security_id in query_ids.tolist()],
+            dtype=np.float64)
+
+        # the query weight of every non-zero entry of the matrix
+        entry_weights = np.zeros(len(matrix.security_ids))
+        if len(query_ids):
+            positions = np.minimum(
+                np.searchsorted(query_ids, matrix.security_ids),
+                len(query_ids) - 1)
+            matches = query_ids[positions] == matrix.security_ids
+            entry_weights[matches] = query_weights[positions[matches]]
+
+        overlap = np.bincount(
+            matrix.rows, weights=np.minimum(matrix.weights, entry_weights),
+            minlength=count)
+        dot = np.bincount(
+            matrix.rows, weights=matrix.weights * entry_weights,
+            minlength=count)
+        query_norm = np.sqrt((query_weights ** 2).sum())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosine = np.nan_to_num(dot / (matrix.norms * query_norm))
+
+        candidates = np.ones(count, dtype=bool)
+        if exclude is not None:
+            candidates &= matrix.portfolio_ids != exclude
+
+        def ranking(scores):
+            scores = np.where(candidates, scores, -np.inf)
+            size = min(k, int(candidates.sum()))
+            if size <= 0:
+                return []
+            best = np.argpartition(-scores, size - 1)[:size]
+            best = best[np.lexsort((matrix.portfolio_ids[best], -scores[best]))]
+            return [{
+                'portfolio_id': int(matrix.portfolio_ids[row]),
+                'portfolio_name': matrix.names[row],
+                'overlap': float(overlap[row]),
+                'cosine': float(cosine[row])
+            } for row in best.tolist()]
+
+        return {'by_overlap': ranking(overlap), 'by_cosine': ranking(cosine)}
+
+
+similarity_index = SimilarityIndex()
+
+
+'''
+rebalance_trades(portfolio_ids, target)
+    the weight changes that bring every portfolio in `portfolio_ids` to the
+    `target` weights (a security id -> weight mapping), keyed by portfolio id
+
+    The current weights of all the portfolios are read in one query into a
+    portfolios x securities matrix over the securities either held or
+    targeted, and the trades are the non-zero entries of target - current.
+'''
+
+
+def rebalance_trades(portfolio_ids, target):
+    portfolio_ids = np.array(sorted(portfolio_ids), dtype=np.int64)
+    compositions = np.array(db.session.query(
+        PortfolioComposition.portfolio_id,
+        PortfolioComposition.security_id,
+        PortfolioComposition.weight
+    ).filter(PortfolioComposition.portfolio_id.in_(
+        portfolio_ids.tolist())).all(), dtype=np.int64).reshape(-1, 3)
+
+    target_ids = np.array(sorted(target), dtype=np.int64)
+    security_ids = np.union1d(compositions[:, 1], target_ids)
+
+    current = np.zeros((len(portfolio_ids), len(security_ids)), dtype=np.int64)
+    current[np.searchsorted(portfolio_ids, compositions[:, 0]),
+            np.searchsorted(security_ids, compositions[:, 1])] = \
+        compositions[:, 2]
+    targets = np.zeros(len(security_ids), dtype=np.int64)
+    targets[np.searchsorted(security_ids, target_ids)] = \
+        [target[security_id] for security_id in target_ids.tolist()]
+
+    trades = {portfolio_id: [] for portfolio_id in portfolio_ids.tolist()}
+    rows, columns = np.nonzero(targets - current)
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        trades[int(portfolio_ids[row])].append({
+            'security_id': int(security_ids[column]),
+            'current_weight': int(current[row, column]),
+            'target_weight': int(targets[column]),
+            'trade': int(targets[column] - current[row, column])
+        })
+    return trades
@@ -1,59 +1,346 @@
 import os
-from flask import Flask, request, abort, jsonify
+from datetime import datetime, timedelta, timezone
+from flask import (Flask, request, abort, jsonify, Response,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
+from sqlalchemy.exc import SQLAlchemyError
 import json
 
-from models import (setup_db, db, Portfolio, Security, PortfolioComposition, AssetClass, Region)
-from auth import AuthError, requires_auth
+from models import (setup_db, db, Portfolio, Security, PortfolioComposition, AssetClass, Region,
+                    PortfolioCompositionHistory, PortfolioSummary,
+                    reference_data,
+                    portfolio_etag, portfolio_exposures, read_replica)
+from auth import AuthError, requires_auth, check_permissions
+from metrics import init_metrics
+from slow_query_log import current_log
+from pagination import paginate, MAX_PAGE_LIMIT
+from security_import import detect_format, import_securities
+from columnar import (columnar_securities, columnar_portfolios,
+                      columnar_response)
+from analytics import (load_exposure_matrix, exposure_report,
+                       similarity_index, rebalance_trades)
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+DEFAULT_SIMILAR_COUNT = 10
+DEFAULT_SLOW_QUERY_COUNT = 20
+CORS_ALLOW_HEADERS = 'Content-Type,Authorization,true'
+CORS_ALLOW_METHODS = 'GET,PATCH,POST,DELETE,OPTIONS'
+
+
+def wants_columnar():
+    response_format = request.args.get('format', None)
+    if response_format not in (None, 'columnar'):
+        abort(422)
+    return response_format == 'columnar'
+
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+'''
+stream_ndjson(query)
+    streams every row of `query` as one JSON object per line. Rows are
+    fetched STREAM_BATCH_SIZE at a time from a server-side cursor, so the
+    first line goes out before the query has been read to the end.
+'''
+
+
+def stream_ndjson(query):
+    query = query.execution_options(
+        stream_results=True).yield_per(STREAM_BATCH_SIZE)
+
+    def generate():
+        for row in query:
+            yield json.dumps(row.format()) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+'''
+not_modified(etag)
+    returns a 304 response when the request's If-None-Match already holds
+    `etag`, and None otherwise
+'''
+
+
+def not_modified(etag):
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# JSON true and false decode to bools, which are ints in Python
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+'''
+valid_compositions(compositions)
+    checks that every composition has a distinct security_id and a weight
+    and that the weights sum up to 100 %
+'''
+
+
+def valid_compositions(compositions):
+    if not isinstance(compositions, list):
+        return False
+    total_weight = 0
+    security_ids = set()
+    for composition in compositions:
+        if not isinstance(composition, dict) or \
+                not is_integer(composition.get('security_id')) or \
+                not is_integer(composition.get('weight')) or \
+                composition['security_id'] in security_ids:
+            return False
+        security_ids.add(composition['security_id'])
+        total_weight += composition['weight']
+    return total_weight == 100
+
+
+def similar_count(k):
+    if k is None:
+        return DEFAULT_SIMILAR_COUNT
+    if isinstance(k, str) and k.isdigit():
+        k = int(k)
+    if not isinstance(k, int) or isinstance(k, bool) or \
+            not 0 < k <= MAX_PAGE_LIMIT:
+        abort(422)
+    return k
+
+
+'''
+parse_as_of(value)
+    the naive UTC datetime of an ISO 8601 date or date and time. A date
+    alone stands for the end of that day.
+'''
+
+
+def parse_as_of(value):
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        as_of = datetime.fromisoformat(value)
+    except ValueError:
+        abort(422)
+    if as_of.tzinfo is not None:
+        return as_of.astimezone(timezone.utc).replace(tzinfo=None)
+    if len(value) == len('YYYY-MM-DD'):
+        return as_of + timedelta(days=1, microseconds=-1)
+    return as_of
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
     setup_db(app)
+    init_metrics(app)
 
     cors = CORS(app, resources={"*": {"origins": "*"}})
 
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type,Authorization,true')
+                             CORS_ALLOW_HEADERS)
         response.headers.add('Access-Control-Allow-Methods',
-                             'GET,PATCH,POST,DELETE,OPTIONS')
+                             CORS_ALLOW_METHODS)
         return response
 
     @app.route('/portfolios', methods=['GET'])
     @requires_auth('get:portfolios')
+    @read_replica
     def retrieve_portfolios(payload):
-        portfolios = Portfolio.query.order_by(Portfolio.id).all()
-        portfolios_formatted = [portfolio.format() for portfolio in portfolios]
+        # view=summary reads one precomputed row per portfolio instead of
+        # the compositions
+        view = request.args.get('view', None)
+        if view not in (None, 'summary'):
+            abort(422)
 
-        if len(portfolios_formatted) == 0:
+        # format=columnar returns parallel arrays of the page's fields
+        if wants_columnar():
+            if view is not None:
+                abort(422)
+            page = paginate(
+                db.session.query(Portfolio.id, Portfolio.name), Portfolio.id)
+            if len(page.items) == 0 and page.is_first:
+                abort(404)
+            return columnar_response(dict(
+                columnar_portfolios(page.items),
+                success=True, next_cursor=page.next_cursor))
+
+        if view == 'summary':
+            query, column = PortfolioSummary.query, \
+                PortfolioSummary.portfolio_id
+        else:
+            query, column = Portfolio.query, Portfolio.id
+
+        if wants_ndjson():
+            return stream_ndjson(query.order_by(column))
+
+        page = paginate(query, column)
+        portfolios_formatted = [portfolio.format() for portfolio in page.items]
+
+        if len(portfolios_formatted) == 0 and page.is_first:
             abort(404)
 
         return jsonify({
             'success': True,
-            'portfolios': portfolios_formatted
+            'portfolios': portfolios_formatted,
+            'next_cursor': page.next_cursor
         })
 
     @app.route('/portfolios/<int:portfolio_id>', methods=['GET'])
     @requires_auth('get:portfolios')
+    @read_replica
     def retrieve_portfolio(payload, portfolio_id):
 
+        as_of = request.args.get('as_of', None)
+        if as_of is not None:
+            return retrieve_portfolio_as_of(
+                portfolio_id, parse_as_of(as_of))
+
+        # answer conditional requests from the version alone, without
+        # loading the compositions
+        version = db.session.query(Portfolio.version).filter(
+            Portfolio.id == portfolio_id).scalar()
+
+        if version is None:
+            abort(404)
+
+        response = not_modified(portfolio_etag(portfolio_id, version))
+        if response is not None:
+            return response
+
         portfolio = Portfolio.query.get(portfolio_id)
 
         if portfolio is None:
             abort(404)
 
-        return jsonify(
+        response = jsonify(
             {
                 'success': True,
                 'portfolio_id': portfolio.id,
                 'portfolio_name': portfolio.name,
                 'portfolio_compositions': [
                     portfolio_composition.format() for portfolio_composition in portfolio.portfolio_compositions]})
+        response.set_etag(portfolio.etag())
+        return response
+
+    # answered from the history alone, which outlives deleted portfolios
+    def retrieve_portfolio_as_of(portfolio_id, as_of):
+        held = PortfolioCompositionHistory.as_of(portfolio_id, as_of)
+
+        # the portfolio did not exist yet, or no longer, at `as_of`
+        if held is None:
+            abort(404)
+
+        portfolio_name, rows = held
+
+        return jsonify({
+            'success': True,
+            'portfolio_id': portfolio_id,
+            'portfolio_name': portfolio_name,
+            'as_of': as_of.isoformat(),
+            'portfolio_compositions': [
+                row.format(security) for row, security in rows]})
+
+    @app.route('/portfolios/<int:portfolio_id>/exposure', methods=['GET'])
+    @requires_auth('get:portfolios')
+    @read_replica
+    def retrieve_portfolio_exposure(payload, portfolio_id):
+
+        exposure = portfolio_exposures([portfolio_id]).get(portfolio_id)
+
+        if exposure is None:
+            if Portfolio.query.get(portfolio_id) is None:
+                abort(404)
+            exposure = {'by_region': {}, 'by_asset_class': {}}
+
+        return jsonify({
+            'success': True,
+            'portfolio_id': portfolio_id,
+            'by_region': exposure['by_region'],
+            'by_asset_class': exposure['by_asset_class']
+        })
+
+    @app.route('/portfolios/exposure', methods=['GET'])
+    @requires_auth('get:portfolios')
+    @read_replica
+    def retrieve_portfolios_exposure(payload):
+
+        # ids=1,2,3
+        try:
+            portfolio_ids = sorted({
+                int(portfolio_id)
+                for portfolio_id in request.args.get('ids', '').split(',')})
+        except ValueError:
+            abort(422)
+
+        if len(portfolio_ids) > MAX_PAGE_LIMIT:
+            abort(422)
+
+        exposures = portfolio_exposures(portfolio_ids)
+
+        return jsonify({
+            'success': True,
+            'exposures': [{
+                'portfolio_id': portfolio_id,
+                'by_region': exposures[portfolio_id]['by_region'],
+                'by_asset_class': exposures[portfolio_id]['by_asset_class']
+            } for portfolio_id in portfolio_ids if portfolio_id in exposures]
+        })
+
+    @app.route('/analytics/exposure', methods=['GET'])
+    @requires_auth('get:portfolios')
+    @read_replica
+    def retrieve_exposure_matrix(payload):
+
+        report = exposure_report(load_exposure_matrix())
+
+        return jsonify(dict(report, success=True))
+
+    @app.route('/portfolios/<int:portfolio_id>/similar', methods=['GET'])
+    @requires_auth('get:portfolios')
+    @read_replica
+    def retrieve_similar_portfolios(payload, portfolio_id):
+
+        k = similar_count(request.args.get('k', None))
+
+        # one refresh serves both the portfolio's vector and the ranking
+        matrix = similarity_index.refresh()
+        composition = similarity_index.vector(portfolio_id, matrix)
+        if composition is None:
+            abort(404)
+
+        similar = similarity_index.top_k(
+            composition, k, exclude=portfolio_id, matrix=matrix)
+
+        return jsonify(dict(similar, success=True, portfolio_id=portfolio_id))
+
+    @app.route('/portfolios/similar', methods=['POST'])
+    @requires_auth('get:portfolios')
+    @read_replica
+    def search_similar_portfolios(payload):
+
+        body = request.get_json()
+        k = similar_count(body.get('k', None))
+        portfolio_compositions = body.get('portfolio_compositions', None)
+
+        if not valid_compositions(portfolio_compositions):
+            abort(422)
+
+        similar = similarity_index.top_k({
+            composition['security_id']: composition['weight']
+            for composition in portfolio_compositions}, k)
+
+        return jsonify(dict(similar, success=True))
 
     @app.route('/portfolios', methods=['POST'])
     @requires_auth('post:portfolios')
@@ -64,20 +351,16 @@ def create_app(test_config=None):
         portfolio_compositions = body.get('portfolio_compositions', None)
 
         # check if portfolio compositions sum up to 100 %
-        total_weight = 0
-        for portfolio_composition in portfolio_compositions:
-            total_weight += portfolio_composition['weight']
-        if total_weight != 100:
+        if not valid_compositions(portfolio_compositions):
             abort(422)
 
         portfolio = Portfolio(name=portfolio_name)
 
-        for portfolio_composition in portfolio_compositions:
-            composition = PortfolioComposition(
-                security_id=portfolio_composition['security_id'],
-                weight=portfolio_composition['weight'])
-            composition.portfolio = portfolio
-            composition.insert()
+        try:
+            portfolio.insert(portfolio_compositions)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
 
         return jsonify({
             'success': True,
@@ -85,6 +368,43 @@ def create_app(test_config=None):
             'portfolio_name': portfolio.name,
         })
 
+    @app.route('/portfolios/batch', methods=['POST'])
+    @requires_auth('post:portfolios')
+    def create_portfolios(payload):
+
+        body = request.get_json()
+        new_portfolios = body.get('portfolios', None)
+
+        if not isinstance(new_portfolios, list) or len(new_portfolios) == 0:
+            abort(422)
+
+        entries = []
+        for new_portfolio in new_portfolios:
+            if not isinstance(new_portfolio, dict):
+                abort(422)
+            portfolio_compositions = new_portfolio.get(
+                'portfolio_compositions', None)
+            if not valid_compositions(portfolio_compositions):
+                abort(422)
+            entries.append((
+                Portfolio(name=new_portfolio.get('portfolio_name', None)),
+                portfolio_compositions))
+
+        # all the portfolios are created, or none of them
+        try:
+            Portfolio.insert_all(entries)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'portfolios': [{
+                'portfolio_id': portfolio.id,
+                'portfolio_name': portfolio.name
+            } for portfolio, _ in entries]
+        })
+
     @app.route('/portfolios/<int:portfolio_id>', methods=['DELETE'])
     @requires_auth('delete:portfolios')
     def delete_portfolio(payload, portfolio_id):
@@ -107,55 +427,152 @@ def create_app(test_config=None):
         new_name = body.get('portfolio_name', None)
         new_portfolio_compositions = body.get('portfolio_compositions', None)
 
-        portfolio = Portfolio.query.get(portfolio_id)
+        # lock the portfolio so concurrent updates diff against fresh rows
+        portfolio = Portfolio.query.with_for_update().filter_by(
+            id=portfolio_id).one_or_none()
 
         if portfolio is None:
             abort(404)
 
-        if new_name is not None:
-            portfolio.name = new_name
-        if new_portfolio_compositions is not None:
-            # check if portfolio compositions sum up to 100 %
-            total_weight = 0
-            for portfolio_composition in new_portfolio_compositions:
-                total_weight += portfolio_composition['weight']
-            if total_weight != 100:
+        # check if portfolio compositions sum up to 100 %
+        if new_portfolio_compositions is not None and \
+                not valid_compositions(new_portfolio_compositions):
+            abort(422)
+
+        counts = {'added': 0, 'changed': 0, 'removed': 0}
+        try:
+            if new_name is not None:
+                portfolio.rename(new_name)
+            if new_portfolio_compositions is not None:
+                counts = portfolio.update_compositions(
+                    new_portfolio_compositions, commit=False)
+            if db.session.is_modified(portfolio) or any(counts.values()):
+                portfolio.touch()
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'updated': portfolio_id,
+            'added': counts['added'],
+            'changed': counts['changed'],
+            'removed': counts['removed']
+        }), 200
+
+    @app.route('/portfolios/rebalance', methods=['POST'])
+    @requires_auth('get:portfolios')
+    def rebalance_portfolios(payload):
+
+        body = request.get_json()
+        portfolio_ids = body.get('portfolio_ids', None)
+        target_compositions = body.get('target_compositions', None)
+        model_portfolio_id = body.get('model_portfolio_id', None)
+        apply = body.get('apply', False)
+
+        if not isinstance(portfolio_ids, list) or \
+                not 0 < len(portfolio_ids) <= MAX_PAGE_LIMIT or \
+                not all(isinstance(portfolio_id, int)
+                        for portfolio_id in portfolio_ids) or \
+                not isinstance(apply, bool):
+            abort(422)
+        portfolio_ids = sorted(set(portfolio_ids))
+
+        # applying the trades is an update of every portfolio
+        if apply:
+            check_permissions('patch:portfolios', payload)
+
+        # the target is either given or read from a model portfolio
+        if model_portfolio_id is not None:
+            if not isinstance(model_portfolio_id, int) or \
+                    isinstance(model_portfolio_id, bool):
                 abort(422)
+            model_portfolio = Portfolio.query.get(model_portfolio_id)
+            if model_portfolio is None:
+                abort(404)
+            target_compositions = [{
+                'security_id': composition.security_id,
+                'weight': composition.weight
+            } for composition in model_portfolio.portfolio_compositions]
+        elif not valid_compositions(target_compositions) or \
+                Security.query.filter(Security.id.in_([
+                    composition['security_id']
+                    for composition in target_compositions])).count() != \
+                len(target_compositions):
+            abort(422)
 
-            # delete the current compositions
-            PortfolioComposition.query.filter_by(
-                portfolio_id=portfolio_id).delete()
+        # a preview only needs the ids to exist; applying locks the
+        # portfolios before reading the weights the trades apply to
+        if apply:
+            portfolios = Portfolio.query.with_for_update().filter(
+                Portfolio.id.in_(portfolio_ids)).all()
+        else:
+            portfolios = db.session.query(Portfolio.id).filter(
+                Portfolio.id.in_(portfolio_ids)).all()
+
+        if len(portfolios) != len(portfolio_ids):
+            db.session.rollback()
+            abort(404)
 
-            # add new compositions
-            for portfolio_composition in new_portfolio_compositions:
-                composition = PortfolioComposition(
-                    security_id=portfolio_composition['security_id'],
-                    weight=portfolio_composition['weight'])
-                composition.portfolio = portfolio
-                composition.insert()
+        trades = rebalance_trades(portfolio_ids, {
+            composition['security_id']: composition['weight']
+            for composition in target_compositions})
+
+        if apply:
+            try:
+                for portfolio in portfolios:
+                    if trades[portfolio.id]:
+                        portfolio.update_compositions(
+                            target_compositions, commit=False)
+                        portfolio.touch()
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+                abort(422)
 
         return jsonify({
             'success': True,
-            'updated': portfolio_id
-        }), 200
+            'applied': apply,
+            'target_compositions': target_compositions,
+            'portfolios': [{
+                'portfolio_id': portfolio_id,
+                'trades': trades[portfolio_id]
+            } for portfolio_id in portfolio_ids]
+        })
 
     @app.route('/securities', methods=['GET'])
     @requires_auth('get:securities')
+    @read_replica
     def retrieve_securities(payload):
-
-        securities = Security.query.order_by(Security.id).all()
-        securities_formatted = [security.format() for security in securities]
-
-        if len(securities_formatted) == 0:
+        if wants_columnar():
+            page = paginate(db.session.query(
+                Security.id, Security.name, Security.region_id,
+                Security.asset_class_id), Security.id)
+            if len(page.items) == 0 and page.is_first:
+                abort(404)
+            return columnar_response(dict(
+                columnar_securities(page.items),
+                success=True, next_cursor=page.next_cursor))
+
+        if wants_ndjson():
+            return stream_ndjson(Security.query.order_by(Security.id))
+
+        page = paginate(Security.query, Security.id)
+        securities_formatted = [security.format() for security in page.items]
+
+        if len(securities_formatted) == 0 and page.is_first:
             abort(404)
 
         return jsonify({
             'success': True,
-            'securities': securities_formatted
+            'securities': securities_formatted,
+            'next_cursor': page.next_cursor
         })
 
     @app.route('/securities/<int:security_id>', methods=['GET'])
     @requires_auth('get:securities')
+    @read_replica
     def retrieve_security(payload, security_id):
 
         security = Security.query.get(security_id)
@@ -167,8 +584,28 @@ def create_app(test_config=None):
             'success': True,
             'security_id': security.id,
             'security_name': security.name,
-            'asset_class': security.asset_class.name,
-            'region': security.region.name
+            'asset_class': reference_data.asset_class_name(security.asset_class_id),
+            'region': reference_data.region_name(security.region_id)
+        })
+
+    @app.route('/securities/<int:security_id>/portfolios', methods=['GET'])
+    @requires_auth('get:portfolios')
+    @read_replica
+    def retrieve_security_holders(payload, security_id):
+
+        holders = PortfolioComposition.holders(security_id)
+
+        if len(holders) == 0 and Security.query.get(security_id) is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'security_id': security_id,
+            'portfolios': [{
+                'portfolio_id': portfolio_id,
+                'portfolio_name': portfolio_name,
+                'weight': weight
+            } for portfolio_id, portfolio_name, weight in holders]
         })
 
     @app.route('/securities', methods=['POST'])
@@ -180,8 +617,8 @@ def create_app(test_config=None):
         region_id = body.get('region_id', None)
         asset_class_id = body.get('asset_class_id', None)
 
-        if Region.query.get(region_id) is None or AssetClass.query.get(
-                asset_class_id) is None:
+        if not reference_data.has_region(region_id) or \
+                not reference_data.has_asset_class(asset_class_id):
             abort(422)
 
         security = Security(
@@ -191,15 +628,37 @@ def create_app(test_config=None):
 
         security.insert()
 
-        db.session.add(security)
-        db.session.commit()
-
         return jsonify({
             'success': True,
             'security_id': security.id,
             'security_name': security.name,
-            'region': security.region.name,
-            'asset_class': security.asset_class.name,
+            'region': reference_data.region_name(security.region_id),
+            'asset_class': reference_data.asset_class_name(security.asset_class_id),
+        })
+
+    @app.route('/securities/import', methods=['POST'])
+    @requires_auth('post:securities')
+    def import_securities_file(payload):
+        # either a multipart upload named "file" or the raw request body
+        upload = request.files.get('file')
+        if upload is not None:
+            import_format = request.args.get('format') or detect_format(
+                upload.mimetype, upload.filename)
+            stream = upload.stream
+        else:
+            import_format = request.args.get('format') or detect_format(
+                request.mimetype, None)
+            stream = request.stream
+
+        if import_format not in ('csv', 'ndjson'):
+            abort(422)
+
+        imported, errors = import_securities(stream, import_format)
+
+        return jsonify({
+            'success': True,
+            'imported': imported,
+            'errors': errors
         })
 
     @app.route('/securities/<int:security_id>', methods=['DELETE'])
@@ -211,8 +670,7 @@ def create_app(test_config=None):
             abort(404)
 
         # check if the security is in any of the existing portfolios
-        if PortfolioComposition.query.filter_by(
-                security_id=security_id).count() > 0:
+        if PortfolioComposition.is_held(security_id):
             abort(422)
 
         security.delete()
@@ -234,10 +692,14 @@ def create_app(test_config=None):
         if security is None:
             abort(404)
 
-        if Region.query.get(new_region_id) is None or AssetClass.query.get(
-                new_asset_class_id) is None:
+        if not reference_data.has_region(new_region_id) or \
+                not reference_data.has_asset_class(new_asset_class_id):
             abort(422)
 
+        # the holders' summaries total the weights by region and asset class
+        regrouped = new_region_id != security.region_id or \
+            new_asset_class_id != security.asset_class_id
+
         if new_name is not None:
             security.name = new_name
         if new_region_id is not None:
@@ -245,6 +707,11 @@ def create_app(test_config=None):
         if new_asset_class_id is not None:
             security.asset_class_id = new_asset_class_id
 
+        # the security is part of its holders' formatted compositions
+        if db.session.is_modified(security):
+            Portfolio.touch_holders(security_id)
+        if regrouped:
+            PortfolioSummary.refresh_holders(security_id)
         security.update()
 
         return jsonify({
@@ -253,33 +720,70 @@ def create_app(test_config=None):
         }), 200
 
     @app.route('/asset_classes', methods=['GET'])
+    @read_replica
     def retrieve_asset_classes():
 
-        asset_classes = AssetClass.query.order_by(AssetClass.id).all()
-        asset_classes_formatted = [asset_class.format()
-                                   for asset_class in asset_classes]
+        reference_maps = reference_data.snapshot()
+        response = not_modified(reference_maps.asset_classes_etag)
+        if response is not None:
+            return response
+
+        asset_classes = reference_maps.asset_classes
+        asset_classes_formatted = [
+            AssetClass(id=asset_class_id, name=asset_classes[asset_class_id]).format()
+            for asset_class_id in sorted(asset_classes)]
 
         if len(asset_classes_formatted) == 0:
             abort(404)
 
-        return jsonify({
+        response = jsonify({
             'success': True,
             'asset_classes': asset_classes_formatted
         })
+        response.set_etag(reference_maps.asset_classes_etag)
+        return response
 
     @app.route('/regions', methods=['GET'])
+    @read_replica
     def retrieve_regions():
 
-        regions = Region.query.order_by(Region.id).all()
-        regions_formatted = [region.format() for region in regions]
+        reference_maps = reference_data.snapshot()
+        response = not_modified(reference_maps.regions_etag)
+        if response is not None:
+            return response
+
+        regions = reference_maps.regions
+        regions_formatted = [
+            Region(id=region_id, name=regions[region_id]).format()
+            for region_id in sorted(regions)]
 
         if len(regions_formatted) == 0:
             abort(404)
 
-        return jsonify({
+        response = jsonify({
             'success': True,
             'regions': regions_formatted
         })
+        response.set_etag(reference_maps.regions_etag)
+        return response
+
+    @app.route('/admin/slow_queries', methods=['GET'])
+    @requires_auth('get:slow_queries')
+    def retrieve_slow_queries(payload):
+
+        log = current_log()
+        if log is None:
+            abort(404)
+
+        limit = request.args.get('limit', str(DEFAULT_SLOW_QUERY_COUNT))
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_LIMIT:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'threshold_ms': log.threshold_ms,
+            'statements': log.top(int(limit))
+        })
 
     @app.errorhandler(404)
     def not_found(error):
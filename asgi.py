@@ -0,0 +1,463 @@
+import os
+import time
+from databases import Database
+from sqlalchemy import select, func
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route, Mount
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+
+import auth
+import metrics
+from auth import AuthError, token_from_header, check_permissions
+from app import (app as wsgi_app, NDJSON_MIMETYPE, CORS_ALLOW_HEADERS,
+                 CORS_ALLOW_METHODS)
+from models import (database_path, replica_path, Portfolio, Security,
+                    PortfolioComposition, AssetClass, Region, portfolio_etag,
+                    fingerprint)
+from pagination import encode_cursor, decode_cursor, parse_limit
+
+
+'''
+ASGI entry point
+
+    Serves the read endpoints with async handlers: the queries run on an
+    async driver (asyncpg, or aiosqlite locally) and the token signature is
+    checked in a worker thread, so a request waiting on the database or on
+    the key set does not hold up the others. Every other route and method
+    (including CORS preflights), and the NDJSON, columnar, summary and
+    as-of variants of the read endpoints, are passed to the Flask app. The
+    async responses carry the same CORS headers as the Flask ones and are
+    timed into the same Prometheus histograms.
+
+    uvicorn asgi:app
+'''
+
+
+ASYNC_DATABASE_URL = os.environ.get(
+    'ASYNC_DATABASE_URL', replica_path or database_path)
+
+portfolio_table = Portfolio.__table__
+composition_table = PortfolioComposition.__table__
+security_table = Security.__table__
+region_table = Region.__table__
+asset_class_table = AssetClass.__table__
+
+ERROR_MESSAGES = {
+    404: 'Not Found',
+    422: 'Unprocessable entity',
+    500: 'Server error'
+}
+
+
+'''
+authenticate(request, permission)
+    the async counterpart of @requires_auth. Cached tokens are checked
+    inline; the others are verified in the thread pool.
+'''
+
+
+async def authenticate(request, permission):
+    with metrics.auth_timer():
+        token = token_from_header(request.headers.get('Authorization', None))
+        verified = auth.token_cache.get(token)
+        if verified is None:
+            verified = auth.token_cache.put(
+                token, await run_in_threadpool(auth.verify_decode_jwt, token))
+        check_permissions(permission, verified.payload, verified.permissions)
+    return verified.payload
+
+
+class TimedDatabase:
+    """Counts the queries of the async handlers into the request's SQL time"""
+
+    def __init__(self, database):
+        self.database = database
+
+    async def connect(self):
+        await self.database.connect()
+
+    async def disconnect(self):
+        await self.database.disconnect()
+
+    async def timed(self, method, query):
+        started = time.perf_counter()
+        try:
+            return await method(query)
+        finally:
+            metrics.record_statement(time.perf_counter() - started)
+
+    async def fetch_all(self, query):
+        return await self.timed(self.database.fetch_all, query)
+
+    async def fetch_one(self, query):
+        return await self.timed(self.database.fetch_one, query)
+
+    async def fetch_val(self, query):
+        return await self.timed(self.database.fetch_val, query)
+
+
+'''
+timed(route, endpoint)
+    the endpoint with its request recorded in the Prometheus histograms
+    under `route`, the rule of the matching Flask route. Requests handed
+    to the Flask app are recorded there.
+'''
+
+
+def timed(route, endpoint):
+    async def timed_endpoint(request):
+        timings = metrics.RequestTimings()
+        token = metrics.async_timings.set(timings)
+        response = None
+        try:
+            response = await endpoint(request)
+            return response
+        except HTTPException as error:
+            timings.status = error.code
+            raise
+        except AuthError:
+            timings.status = 401
+            raise
+        finally:
+            metrics.async_timings.reset(token)
+            if response is not request.app.state.fallback:
+                if response is not None:
+                    timings.status = response.status_code
+                metrics.observe(request.method, route, timings)
+    return timed_endpoint
+
+
+class CORSHeaders:
+    """
+    Adds the headers Flask-CORS and the after_request hook of app.py put on
+    every Flask response to the responses of the async handlers
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        origin = Headers(scope=scope).get('origin')
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                # the Flask app's responses already have them
+                if 'access-control-allow-origin' not in headers:
+                    headers['Access-Control-Allow-Origin'] = origin or '*'
+                    if origin:
+                        headers.append('Vary', 'Origin')
+                    headers['Access-Control-Allow-Headers'] = \
+                        CORS_ALLOW_HEADERS
+                    headers['Access-Control-Allow-Methods'] = \
+                        CORS_ALLOW_METHODS
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+def wants_fallback(request, *arguments):
+    accept = parse_accept_header(request.headers.get('Accept'), MIMEAccept)
+    return accept.best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE or \
+        any(argument in request.query_params for argument in arguments)
+
+
+def not_modified(request, etag):
+    if not parse_etags(request.headers.get('If-None-Match')).contains(etag):
+        return None
+    return Response(status_code=304, headers={'ETag': '"{}"'.format(etag)})
+
+
+'''
+page_bounds(request)
+    the limit and the id to seek after of a paginated request, following
+    pagination.paginate
+'''
+
+
+def page_bounds(request):
+    limit = parse_limit(request.query_params.get('limit'))
+
+    cursor = request.query_params.get('cursor')
+    last_id = decode_cursor(cursor) if cursor is not None else None
+    return limit, last_id
+
+
+async def fetch_page(database, query, column, request):
+    limit, last_id = page_bounds(request)
+    if last_id is not None:
+        query = query.where(column > last_id)
+
+    # fetch one extra row to know whether another page follows
+    rows = await database.fetch_all(query.order_by(column).limit(limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0])
+    return rows, next_cursor, last_id is None
+
+
+async def fetch_compositions(database, portfolio_ids):
+    rows = await database.fetch_all(select([
+        composition_table.c.portfolio_id,
+        security_table.c.name,
+        region_table.c.name,
+        asset_class_table.c.name,
+        composition_table.c.weight
+    ]).select_from(
+        composition_table.join(
+            security_table,
+            security_table.c.id == composition_table.c.security_id
+        ).join(
+            region_table, region_table.c.id == security_table.c.region_id
+        ).join(
+            asset_class_table,
+            asset_class_table.c.id == security_table.c.asset_class_id)
+    ).where(
+        composition_table.c.portfolio_id.in_(portfolio_ids)
+    ).order_by(
+        composition_table.c.portfolio_id, composition_table.c.security_id))
+
+    compositions = {portfolio_id: [] for portfolio_id in portfolio_ids}
+    for portfolio_id, security_name, region, asset_class, weight in rows:
+        compositions[portfolio_id].append({
+            'security_name': security_name,
+            'region': region,
+            'asset_class': asset_class,
+            'weight': weight
+        })
+    return compositions
+
+
+SECURITY_QUERY = select([
+    security_table.c.id,
+    security_table.c.name,
+    region_table.c.name,
+    asset_class_table.c.name
+]).select_from(
+    security_table.join(
+        region_table, region_table.c.id == security_table.c.region_id
+    ).join(
+        asset_class_table,
+        asset_class_table.c.id == security_table.c.asset_class_id))
+
+
+def format_security(row):
+    return {
+        'security_id': row[0],
+        'security_name': row[1],
+        'region': row[2],
+        'asset_class': row[3]
+    }
+
+
+async def retrieve_portfolios(request):
+    if wants_fallback(request, 'view', 'format'):
+        return request.app.state.fallback
+    await authenticate(request, 'get:portfolios')
+
+    database = request.app.state.database
+    rows, next_cursor, is_first = await fetch_page(
+        database, select([portfolio_table.c.id, portfolio_table.c.name]),
+        portfolio_table.c.id, request)
+
+    if len(rows) == 0 and is_first:
+        abort(404)
+
+    compositions = await fetch_compositions(database, [row[0] for row in rows])
+
+    return JSONResponse({
+        'success': True,
+        'portfolios': [{
+            'portfolio_id': portfolio_id,
+            'portfolio_name': portfolio_name,
+            'portfolio_compositions': compositions[portfolio_id]
+        } for portfolio_id, portfolio_name in rows],
+        'next_cursor': next_cursor
+    })
+
+
+async def retrieve_portfolio(request):
+    if wants_fallback(request, 'as_of'):
+        return request.app.state.fallback
+    await authenticate(request, 'get:portfolios')
+    portfolio_id = request.path_params['portfolio_id']
+    database = request.app.state.database
+
+    row = await database.fetch_one(select([
+        portfolio_table.c.name, portfolio_table.c.version
+    ]).where(portfolio_table.c.id == portfolio_id))
+
+    if row is None:
+        abort(404)
+
+    etag = portfolio_etag(portfolio_id, row[1])
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    compositions = await fetch_compositions(database, [portfolio_id])
+
+    return JSONResponse({
+        'success': True,
+        'portfolio_id': portfolio_id,
+        'portfolio_name': row[0],
+        'portfolio_compositions': compositions[portfolio_id]
+    }, headers={'ETag': '"{}"'.format(etag)})
+
+
+async def retrieve_securities(request):
+    if wants_fallback(request, 'format'):
+        return request.app.state.fallback
+    await authenticate(request, 'get:securities')
+
+    rows, next_cursor, is_first = await fetch_page(
+        request.app.state.database, SECURITY_QUERY, security_table.c.id,
+        request)
+
+    if len(rows) == 0 and is_first:
+        abort(404)
+
+    return JSONResponse({
+        'success': True,
+        'securities': [format_security(row) for row in rows],
+        'next_cursor': next_cursor
+    })
+
+
+async def retrieve_security(request):
+    await authenticate(request, 'get:securities')
+
+    row = await request.app.state.database.fetch_one(SECURITY_QUERY.where(
+        security_table.c.id == request.path_params['security_id']))
+
+    if row is None:
+        abort(404)
+
+    return JSONResponse(dict(format_security(row), success=True))
+
+
+async def retrieve_security_holders(request):
+    await authenticate(request, 'get:portfolios')
+    security_id = request.path_params['security_id']
+    database = request.app.state.database
+
+    holders = await database.fetch_all(select([
+        composition_table.c.portfolio_id,
+        portfolio_table.c.name,
+        composition_table.c.weight
+    ]).select_from(composition_table.join(
+        portfolio_table,
+        portfolio_table.c.id == composition_table.c.portfolio_id
+    )).where(
+        composition_table.c.security_id == security_id
+    ).order_by(composition_table.c.portfolio_id))
+
+    if len(holders) == 0 and await database.fetch_val(select([
+            func.count()]).where(security_table.c.id == security_id)) == 0:
+        abort(404)
+
+    return JSONResponse({
+        'success': True,
+        'security_id': security_id,
+        'portfolios': [{
+            'portfolio_id': portfolio_id,
+            'portfolio_name': portfolio_name,
+            'weight': weight
+        } for portfolio_id, portfolio_name, weight in holders]
+    })
+
+
+def reference_endpoint(table, model, key):
+    async def retrieve(request):
+        names = dict(await request.app.state.database.fetch_all(
+            select([table.c.id, table.c.name])))
+
+        etag = fingerprint(names)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        if len(names) == 0:
+            abort(404)
+
+        return JSONResponse({
+            'success': True,
+            key: [model(id=id, name=names[id]).format()
+                  for id in sorted(names)]
+        }, headers={'ETag': '"{}"'.format(etag)})
+    return retrieve
+
+
+async def http_error(request, error):
+    return JSONResponse({
+        'success': False,
+        'error': error.code,
+        'message': ERROR_MESSAGES.get(error.code, error.name)
+    }, status_code=error.code)
+
+
+async def auth_error(request, error):
+    return JSONResponse({
+        'success': False,
+        'error': 401,
+        'message': 'authentification failed'
+    }, status_code=401)
+
+
+def create_asgi_app(database_url=ASYNC_DATABASE_URL, wsgi_app=wsgi_app):
+    database = TimedDatabase(Database(database_url))
+    fallback = WSGIMiddleware(wsgi_app)
+
+    async def connect():
+        await database.connect()
+
+    async def disconnect():
+        await database.disconnect()
+
+    # other methods on these paths, such as OPTIONS, only partially match
+    # and go on to the Flask app
+    routes = [
+        Route('/portfolios', timed(
+            '/portfolios', retrieve_portfolios), methods=['GET']),
+        Route('/portfolios/{portfolio_id:int}', timed(
+            '/portfolios/<int:portfolio_id>', retrieve_portfolio),
+            methods=['GET']),
+        Route('/securities', timed(
+            '/securities', retrieve_securities), methods=['GET']),
+        Route('/securities/{security_id:int}', timed(
+            '/securities/<int:security_id>', retrieve_security),
+            methods=['GET']),
+        Route('/securities/{security_id:int}/portfolios', timed(
+            '/securities/<int:security_id>/portfolios',
+            retrieve_security_holders), methods=['GET']),
+        Route('/asset_classes', timed('/asset_classes', reference_endpoint(
+            asset_class_table, AssetClass, 'asset_classes')),
+            methods=['GET']),
+        Route('/regions', timed('/regions', reference_endpoint(
+            region_table, Region, 'regions')), methods=['GET']),
+        # everything else is served by the Flask app
+        Mount('', app=fallback)
+    ]
+
+    app = Starlette(
+        routes=routes,
+        exception_handlers={HTTPException: http_error, AuthError: auth_error},
+        on_startup=[connect],
+        on_shutdown=[disconnect])
+    app.state.database = database
+    app.state.fallback = fallback
+    return CORSHeaders(app)
+
+
+app = create_asgi_app() if ASYNC_DATABASE_URL else None
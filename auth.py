@@ -1,14 +1,51 @@
 import os
+import io
+import re
 import json
+import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
+from jose.utils import base64url_decode
 from urllib.request import urlopen
 
+from metrics import (TOKEN_CACHE_HITS, TOKEN_CACHE_MISSES, auth_timer,
+                     jwks_fetch_timer)
+
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+'''
+Local key sets, read instead of JWKS_URL so that no request goes out
+    JWKS_KEYS: the key set itself
+    JWKS_FILE: a file holding the key set
+Either holds a JWKS document or PEM public keys. A PEM key gets the kid
+JWKS_PEM_KID when it is the only one, and its RFC 7638 thumbprint otherwise.
+JWKS_BACKGROUND_REFRESH=false turns off the thread rereading the key set
+every JWKS_TTL seconds; the key set is then reread on the next request.
+'''
+
+JWKS_KEYS_VARIABLE = 'JWKS_KEYS'
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_PEM_KID = os.environ.get('JWKS_PEM_KID')
+JWKS_BACKGROUND_REFRESH = os.environ.get(
+    'JWKS_BACKGROUND_REFRESH', 'true').lower() in ('1', 'true', 'yes')
+PEM_PUBLIC_KEY = re.compile(
+    r'-----BEGIN (?:RSA )?PUBLIC KEY-----.+?-----END (?:RSA )?PUBLIC KEY-----',
+    re.DOTALL)
 
 
 class AuthError(Exception):
@@ -18,7 +55,10 @@ class AuthError(Exception):
 
 
 def get_token_auth_header():
-    auth = request.headers.get('Authorization', None)
+    return token_from_header(request.headers.get('Authorization', None))
+
+
+def token_from_header(auth):
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -48,14 +88,16 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -64,32 +106,233 @@ def check_permissions(permission, payload):
     return True
 
 
+'''
+JWKSKeyStore
+    in-process cache of the Auth0 JSON Web Key Set
+
+    The key set is fetched at most once every `ttl` seconds and each key is
+    parsed once into a jose key object indexed by its kid. A token signed
+    with an unknown kid triggers an early refetch, rate limited to one every
+    `min_refresh_interval` seconds. When a refetch fails the keys from the
+    last successful fetch keep being served.
+
+    With `refresh_in_background`, a daemon thread started by the first
+    lookup of each process refetches the key set every `ttl` seconds, so
+    requests only wait on a fetch for the first key set and unknown kids.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 opener=urlopen, clock=time.monotonic,
+                 refresh_in_background=False):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.opener = opener
+        self.clock = clock
+        self.refresh_in_background = refresh_in_background
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+        self._stopped = threading.Event()
+
+    def get_key(self, kid):
+        if self.refresh_in_background:
+            self.start_refresher()
+        now = self.clock()
+        if self._fetched_at is None or not self.refresh_in_background and \
+                now - self._fetched_at >= self.ttl:
+            self.refresh()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch(self.clock()):
+            self.refresh(force=True)
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = self.clock()
+            # another thread may have refreshed while we waited for the lock
+            if not force and self._fetched_at is not None and \
+                    now - self._fetched_at < self.ttl:
+                return
+            if self._keys and not self._may_refetch(now):
+                return
+            self._attempted_at = now
+
+            try:
+                with jwks_fetch_timer(), self.opener(
+                        self.url, timeout=JWKS_FETCH_TIMEOUT) as jsonurl:
+                    content = jsonurl.read()
+                keys = self.parse_key_set(content)
+            except Exception:
+                if self._keys:
+                    # serve the stale key set until the next attempt succeeds
+                    return
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the JSON Web Key Set.'
+                }, 401)
+
+            self._keys = keys
+            self._fetched_at = now
+
+    def _may_refetch(self, now):
+        return self._attempted_at is None or \
+            now - self._attempted_at >= self.min_refresh_interval
+
+    def start_refresher(self):
+        # threads don't survive a fork, so each worker starts its own
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._stopped.clear()
+            self._refresher = threading.Thread(
+                target=self._refresh_periodically, name='jwks-refresher',
+                daemon=True)
+            self._refresher.start()
+            self._refresher_pid = os.getpid()
+
+    def stop_refresher(self):
+        self._stopped.set()
+        if self._refresher is not None:
+            self._refresher.join()
+        self._refresher = None
+        self._refresher_pid = None
+
+    def _refresh_periodically(self):
+        while not self._stopped.wait(self.ttl):
+            try:
+                self.refresh(force=True)
+            except AuthError:
+                pass
+
+    '''
+    parse_key_set(content)
+        the key objects of a JWKS document or of PEM public keys, by kid
+    '''
+
+    @staticmethod
+    def parse_key_set(content, pem_kid=None):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        pem_keys = PEM_PUBLIC_KEY.findall(content)
+        if not pem_keys:
+            return JWKSKeyStore.parse_keys(json.loads(content))
+
+        pem_kid = pem_kid or JWKS_PEM_KID
+        keys = {}
+        for pem_key in pem_keys:
+            key = jwk.construct(pem_key, ALGORITHMS[0])
+            kid = pem_kid if pem_kid and len(pem_keys) == 1 else \
+                thumbprint(key)
+            keys[kid] = key
+        return keys
+
+    @staticmethod
+    def parse_keys(jwks):
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            keys[key['kid']] = jwk.construct({
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'n': key['n'],
+                'e': key['e']
+            }, ALGORITHMS[0])
+        return keys
+
+
+'''
+thumbprint(key)
+    the RFC 7638 SHA-256 thumbprint of an RSA key object
+'''
+
+
+def thumbprint(key):
+    members = {}
+    for name, value in key.to_dict().items():
+        if name in ('e', 'kty', 'n'):
+            members[name] = value.decode('utf-8') \
+                if isinstance(value, bytes) else value
+    digest = hashlib.sha256(json.dumps(
+        members, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    encoded = base64.urlsafe_b64encode(digest.digest()).decode('utf-8')
+    return encoded.rstrip('=')
+
+
+def read_file(path, timeout=None):
+    return open(path, 'rb')
+
+
+def read_environment(name, timeout=None):
+    return io.BytesIO(os.environ[name].encode('utf-8'))
+
+
+'''
+configured_key_store()
+    the key store reading the key set from JWKS_KEYS or JWKS_FILE when one
+    is set, and from JWKS_URL otherwise. A local key set is read and parsed
+    right away, so a broken one fails at startup rather than on the first
+    request.
+'''
+
+
+def configured_key_store(url=JWKS_URL, key_file=JWKS_FILE,
+                         keys_variable=JWKS_KEYS_VARIABLE,
+                         refresh_in_background=JWKS_BACKGROUND_REFRESH):
+    if os.environ.get(keys_variable):
+        store = JWKSKeyStore(keys_variable, opener=read_environment,
+                             refresh_in_background=refresh_in_background)
+    elif key_file:
+        store = JWKSKeyStore(key_file, opener=read_file,
+                             refresh_in_background=refresh_in_background)
+    else:
+        return JWKSKeyStore(url, refresh_in_background=refresh_in_background)
+    store.refresh()
+    return store
+
+
+jwks_store = configured_key_store()
+
+
+def verify_signature(token, key):
+    signing_input, _, encoded_signature = token.rpartition('.')
+    signature = base64url_decode(encoded_signature.encode('utf-8'))
+    if not key.verify(signing_input.encode('utf-8'), signature):
+        raise jwt.JWTError('Signature verification failed.')
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
+    if rsa_key is not None:
         try:
+            if unverified_header.get('alg') not in ALGORITHMS:
+                raise jwt.JWTError('The specified alg value is not allowed.')
+            # the signature is checked against the pre-built key object, so
+            # jwt.decode only has to validate the claims
+            verify_signature(token, rsa_key)
             payload = jwt.decode(
                 token,
-                rsa_key,
+                None,
                 algorithms=ALGORITHMS,
+                options={'verify_signature': False},
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
@@ -118,13 +361,98 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+'''
+VerifiedTokenCache
+    bounded LRU cache of verified token payloads
+
+    Entries are keyed by the SHA-256 digest of the token, so raw bearer
+    tokens are never kept in memory, and expire at the token's exp claim.
+    The permission list is stored as a frozenset for the per-route check.
+'''
+
+
+VerifiedToken = namedtuple(
+    'VerifiedToken', ['payload', 'permissions', 'expires_at'])
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= self.clock():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                TOKEN_CACHE_MISSES.inc()
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            TOKEN_CACHE_HITS.inc()
+            return entry
+
+    def put(self, token, payload):
+        permissions = payload.get('permissions')
+        entry = VerifiedToken(
+            payload,
+            frozenset(permissions) if permissions is not None else None,
+            payload.get('exp'))
+        # tokens without an expiry are verified on every request
+        if not isinstance(entry.expires_at, (int, float)) or self.maxsize <= 0:
+            return entry
+
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+
+token_cache = VerifiedTokenCache()
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with auth_timer():
+                token = get_token_auth_header()
+                verified = token_cache.get(token)
+                if verified is None:
+                    verified = token_cache.put(token, verify_decode_jwt(token))
+                check_permissions(
+                    permission, verified.payload, verified.permissions)
+            return f(verified.payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,488 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import http.client
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import rsa
+from jose import jwt
+from jose.utils import long_to_base64
+from sqlalchemy import event
+
+import auth
+from app import create_app
+from models import setup_db, db, Security, Portfolio
+from synthetic_data import (load_synthetic_data, REGION_NAMES,
+                            ASSET_CLASS_NAMES)
+
+'''
+Benchmarks of the API
+
+    servers: sends the same GET requests to a running sync server
+    (gunicorn app:app) and a running async one (uvicorn asgi:app) at a fixed
+    concurrency, and prints the throughput and latency percentiles of each
+    as JSON:
+
+    python benchmark.py servers --sync http://127.0.0.1:8000 \
+        --async http://127.0.0.1:8001 --path /portfolios/1 \
+        --concurrency 256 --requests 10000
+
+    The bearer token is read from --token or the FUND_MANAGER variable.
+
+    app: builds the app with create_app against a freshly seeded local
+    database, with Auth0 replaced by a local keypair, and drives every
+    route in-process. Each route reports its throughput, latency
+    percentiles and SQL statements per request. Given the report of an
+    earlier run, the regressions against it are listed and the command
+    fails, for CI:
+
+    python benchmark.py app --concurrency 8 --requests 200 > report.json
+    python benchmark.py app --baseline report.json
+'''
+
+
+PERMISSIONS = [
+    'delete:portfolios', 'delete:securities', 'get:portfolios',
+    'get:securities', 'patch:portfolios', 'patch:securities',
+    'post:portfolios', 'post:securities']
+IMPORT_ROWS = 20
+BATCH_SIZE = 10
+
+
+def percentile_ms(latencies, fraction):
+    if not latencies:
+        return None
+    index = min(len(latencies) - 1, int(len(latencies) * fraction))
+    return round(latencies[index] * 1000, 2)
+
+
+'''
+summarize(results, elapsed)
+    the throughput and latency percentiles of (ok, latency) results
+    collected over `elapsed` seconds. Only the successful requests count
+    towards the throughput and latencies.
+'''
+
+
+def summarize(results, elapsed):
+    latencies = sorted(latency for ok, latency in results if ok)
+    return {
+        'requests': len(results),
+        'errors': len(results) - len(latencies),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile_ms(latencies, 0.50),
+        'p95_ms': percentile_ms(latencies, 0.95),
+        'p99_ms': percentile_ms(latencies, 0.99)
+    }
+
+
+class Client(threading.local):
+    """One keep-alive connection per worker thread"""
+
+    def connection(self, base_url):
+        if getattr(self, 'conn', None) is None:
+            url = urlsplit(base_url)
+            self.conn = http.client.HTTPConnection(url.hostname, url.port)
+        return self.conn
+
+    def reset(self):
+        if getattr(self, 'conn', None) is not None:
+            self.conn.close()
+        self.conn = None
+
+
+def run(base_url, path, token, concurrency, requests):
+    client = Client()
+    headers = {'Authorization': 'Bearer ' + token} if token else {}
+
+    def send(_):
+        started = time.perf_counter()
+        try:
+            conn = client.connection(base_url)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            client.reset()
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(requests)))
+    return summarize(results, time.perf_counter() - started)
+
+
+'''
+local_auth()
+    replaces the Auth0 key set with the public key of a keypair generated
+    for the run, and yields a bearer token signed with it carrying every
+    permission
+'''
+
+
+@contextmanager
+def local_auth():
+    public_key, private_key = rsa.newkeys(2048)
+    jwks = json.dumps({'keys': [{
+        'kty': 'RSA',
+        'kid': 'benchmark',
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': long_to_base64(public_key.n).decode('utf-8'),
+        'e': long_to_base64(public_key.e).decode('utf-8')
+    }]}).encode('utf-8')
+
+    saved = auth.jwks_store, auth.AUTH0_DOMAIN, auth.API_AUDIENCE
+    auth.AUTH0_DOMAIN = auth.AUTH0_DOMAIN or 'benchmark.local'
+    auth.API_AUDIENCE = auth.API_AUDIENCE or 'Asset_Management_System'
+    auth.jwks_store = auth.JWKSKeyStore(
+        'https://{}/.well-known/jwks.json'.format(auth.AUTH0_DOMAIN),
+        opener=lambda url, timeout=None: io.BytesIO(jwks))
+    auth.token_cache.clear()
+
+    now = int(time.time())
+    token = jwt.encode({
+        'iss': 'https://{}/'.format(auth.AUTH0_DOMAIN),
+        'aud': auth.API_AUDIENCE,
+        'sub': 'benchmark|local',
+        'iat': now,
+        'exp': now + 24 * 3600,
+        'permissions': PERMISSIONS
+    }, private_key.save_pkcs1().decode('utf-8'), algorithm='RS256',
+        headers={'kid': 'benchmark'})
+    try:
+        yield token
+    finally:
+        auth.jwks_store, auth.AUTH0_DOMAIN, auth.API_AUDIENCE = saved
+        auth.token_cache.clear()
+
+
+'''
+random_compositions(rng, security_ids, holding_count)
+    `holding_count` distinct securities with integer weights summing to 100
+'''
+
+
+def random_compositions(rng, security_ids, holding_count):
+    cuts = sorted(rng.sample(range(1, 100), holding_count - 1))
+    weights = [end - start for start, end in zip([0] + cuts, cuts + [100])]
+    return [{'security_id': security_id, 'weight': weight}
+            for security_id, weight in zip(
+                rng.sample(security_ids, holding_count), weights)]
+
+
+'''
+Scenario
+    one benchmarked route. `path` and `body` are called with the index of
+    the request and the rows `prepare` set aside for the run (if any), so
+    that writes can target a different row each time.
+'''
+
+
+Scenario = namedtuple('Scenario', [
+    'name', 'method', 'path', 'body', 'content_type', 'prepare'])
+
+
+def scenario(name, method, path, body=None, content_type=None, prepare=None):
+    return Scenario(name, method, path, body, content_type, prepare)
+
+
+def scenarios(rng, portfolio_count, security_ids, holding_count):
+    def portfolio_id(i, _=None):
+        return 1 + i % portfolio_count
+
+    def security_id(i, _=None):
+        return security_ids[i % len(security_ids)]
+
+    # request bodies are drawn up front so that every run sends the same
+    targets = [random_compositions(rng, security_ids, holding_count)
+               for _ in range(64)]
+
+    def target(i):
+        return targets[i % len(targets)]
+
+    def new_portfolios(requests):
+        entries = [(Portfolio(name='DELETED_{}'.format(i)), target(i))
+                   for i in range(requests)]
+        Portfolio.insert_all(entries)
+        return [portfolio.id for portfolio, _ in entries]
+
+    def new_securities(requests):
+        securities = [Security(name='DELETED_{}'.format(i), region_id=1,
+                               asset_class_id=1) for i in range(requests)]
+        db.session.add_all(securities)
+        db.session.commit()
+        return [security.id for security in securities]
+
+    def import_file(i, _):
+        return 'security_name,region_id,asset_class_id\n' + ''.join(
+            'IMPORTED_{}_{},{},{}\n'.format(
+                i, row, 1 + row % len(REGION_NAMES),
+                1 + row % len(ASSET_CLASS_NAMES))
+            for row in range(IMPORT_ROWS))
+
+    return [
+        scenario('GET /portfolios', 'GET', lambda i, _: '/portfolios'),
+        scenario('GET /portfolios?view=summary', 'GET',
+                 lambda i, _: '/portfolios?view=summary'),
+        scenario('GET /portfolios?format=columnar', 'GET',
+                 lambda i, _: '/portfolios?format=columnar'),
+        scenario('GET /portfolios/<int:portfolio_id>', 'GET',
+                 lambda i, _: '/portfolios/{}'.format(portfolio_id(i))),
+        scenario('GET /portfolios/<int:portfolio_id>/exposure', 'GET',
+                 lambda i, _: '/portfolios/{}/exposure'.format(
+                     portfolio_id(i))),
+        scenario('GET /portfolios/exposure', 'GET',
+                 lambda i, _: '/portfolios/exposure?ids={}'.format(','.join(
+                     str(portfolio_id(i + n)) for n in range(BATCH_SIZE)))),
+        scenario('GET /analytics/exposure', 'GET',
+                 lambda i, _: '/analytics/exposure'),
+        scenario('GET /portfolios/<int:portfolio_id>/similar', 'GET',
+                 lambda i, _: '/portfolios/{}/similar'.format(
+                     portfolio_id(i))),
+        scenario('POST /portfolios/similar', 'POST',
+                 lambda i, _: '/portfolios/similar',
+                 lambda i, _: {'portfolio_compositions': target(i)}),
+        scenario('POST /portfolios/rebalance', 'POST',
+                 lambda i, _: '/portfolios/rebalance',
+                 lambda i, _: {
+                     'portfolio_ids': [portfolio_id(i + n)
+                                       for n in range(BATCH_SIZE)],
+                     'target_compositions': target(i)}),
+        scenario('POST /portfolios', 'POST', lambda i, _: '/portfolios',
+                 lambda i, _: {'portfolio_name': 'NEW_{}'.format(i),
+                               'portfolio_compositions': target(i)}),
+        scenario('POST /portfolios/batch', 'POST',
+                 lambda i, _: '/portfolios/batch',
+                 lambda i, _: {'portfolios': [{
+                     'portfolio_name': 'BATCH_{}_{}'.format(i, n),
+                     'portfolio_compositions': target(i + n)
+                 } for n in range(BATCH_SIZE)]}),
+        scenario('PATCH /portfolios/<int:portfolio_id>', 'PATCH',
+                 lambda i, _: '/portfolios/{}'.format(portfolio_id(i)),
+                 lambda i, _: {'portfolio_compositions': target(i)}),
+        scenario('DELETE /portfolios/<int:portfolio_id>', 'DELETE',
+                 lambda i, ids: '/portfolios/{}'.format(ids[i]),
+                 prepare=new_portfolios),
+        scenario('GET /securities', 'GET', lambda i, _: '/securities'),
+        scenario('GET /securities?format=columnar', 'GET',
+                 lambda i, _: '/securities?format=columnar'),
+        scenario('GET /securities/<int:security_id>', 'GET',
+                 lambda i, _: '/securities/{}'.format(security_id(i))),
+        scenario('GET /securities/<int:security_id>/portfolios', 'GET',
+                 lambda i, _: '/securities/{}/portfolios'.format(
+                     security_id(i))),
+        scenario('POST /securities', 'POST', lambda i, _: '/securities',
+                 lambda i, _: {'security_name': 'NEW_{}'.format(i),
+                               'region_id': 1, 'asset_class_id': 1}),
+        scenario('POST /securities/import', 'POST',
+                 lambda i, _: '/securities/import', import_file,
+                 content_type='text/csv'),
+        scenario('PATCH /securities/<int:security_id>', 'PATCH',
+                 lambda i, _: '/securities/{}'.format(security_id(i)),
+                 lambda i, _: {
+                     'region_id': 1 + i % len(REGION_NAMES),
+                     'asset_class_id': 1 + i % len(ASSET_CLASS_NAMES)}),
+        scenario('DELETE /securities/<int:security_id>', 'DELETE',
+                 lambda i, ids: '/securities/{}'.format(ids[i]),
+                 prepare=new_securities),
+        scenario('GET /asset_classes', 'GET', lambda i, _: '/asset_classes'),
+        scenario('GET /regions', 'GET', lambda i, _: '/regions')
+    ]
+
+
+'''
+run_scenario(app, route, token, concurrency, requests)
+    sends `requests` requests of the `route` scenario to `app` from
+    `concurrency` threads, counting the SQL statements each one runs
+'''
+
+
+def run_scenario(app, route, token, concurrency, requests):
+    rows = route.prepare(requests) if route.prepare else None
+    client = threading.local()
+    counter = threading.local()
+
+    def count_statement(*args):
+        counter.statements = getattr(counter, 'statements', 0) + 1
+
+    def send(i):
+        if getattr(client, 'app', None) is None:
+            client.app = app.test_client()
+        headers = {'Authorization': 'Bearer ' + token}
+        kwargs = {}
+        if route.content_type is not None:
+            kwargs['data'] = route.body(i, rows)
+            kwargs['content_type'] = route.content_type
+        elif route.body is not None:
+            kwargs['json'] = route.body(i, rows)
+
+        counter.statements = 0
+        started = time.perf_counter()
+        # buffered so that streamed responses are read to the end here
+        response = client.app.open(
+            route.path(i, rows), method=route.method, headers=headers,
+            buffered=True, **kwargs)
+        latency = time.perf_counter() - started
+        return response.status_code < 400, latency, counter.statements
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(send, range(requests)))
+        elapsed = time.perf_counter() - started
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    report = summarize(
+        [(ok, latency) for ok, latency, _ in results], elapsed)
+    report['statements_per_request'] = round(
+        sum(statements for _, _, statements in results) / requests, 2)
+    return report
+
+
+'''
+run_app(database_url, concurrency, requests, ...)
+    the report of every scenario run against the app created on a fresh
+    database at `database_url`, seeded from `seed`
+'''
+
+
+def run_app(database_url, concurrency, requests, portfolio_count=200,
+            security_count=500, holding_count=20, seed=0):
+    rng = random.Random(seed)
+    app = create_app()
+    setup_db(app, database_url)
+
+    with app.app_context(), local_auth() as token:
+        db.drop_all()
+        db.create_all()
+        load_synthetic_data(
+            seed, len(REGION_NAMES), len(ASSET_CLASS_NAMES), security_count,
+            portfolio_count, holding_count)
+        security_ids = list(range(1, security_count + 1))
+        routes = scenarios(rng, portfolio_count, security_ids, holding_count)
+        # the requests push their own app context, with their own session
+        db.session.remove()
+
+        reports = {}
+        for route in routes:
+            reports[route.name] = run_scenario(
+                app, route, token, concurrency, requests)
+            db.session.remove()
+
+        db.get_engine(app).dispose()
+
+    return {
+        'config': {
+            'concurrency': concurrency,
+            'requests': requests,
+            'portfolios': portfolio_count,
+            'securities': security_count,
+            'holdings': holding_count,
+            'seed': seed
+        },
+        'routes': reports
+    }
+
+
+'''
+regressions(report, baseline, tolerance)
+    the routes of `report` doing worse than in `baseline`: any more SQL
+    statements per request, or throughput or p95 latency worse by more
+    than the `tolerance` fraction
+'''
+
+
+def regressions(report, baseline, tolerance):
+    found = []
+    for name, current in report['routes'].items():
+        previous = baseline['routes'].get(name)
+        if previous is None:
+            continue
+        if current['statements_per_request'] > \
+                previous['statements_per_request']:
+            found.append({'route': name, 'metric': 'statements_per_request',
+                          'baseline': previous['statements_per_request'],
+                          'current': current['statements_per_request']})
+        if current['requests_per_second'] < \
+                previous['requests_per_second'] * (1 - tolerance):
+            found.append({'route': name, 'metric': 'requests_per_second',
+                          'baseline': previous['requests_per_second'],
+                          'current': current['requests_per_second']})
+        if previous['p95_ms'] is not None and current['p95_ms'] is not None \
+                and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            found.append({'route': name, 'metric': 'p95_ms',
+                          'baseline': previous['p95_ms'],
+                          'current': current['p95_ms']})
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    servers = commands.add_parser('servers')
+    servers.add_argument('--sync', dest='sync_url',
+                         default='http://127.0.0.1:8000')
+    servers.add_argument('--async', dest='async_url',
+                         default='http://127.0.0.1:8001')
+    servers.add_argument('--path', default='/portfolios/1')
+    servers.add_argument('--token', default=os.environ.get('FUND_MANAGER'))
+    servers.add_argument('--concurrency', type=int, default=256)
+    servers.add_argument('--requests', type=int, default=10000)
+
+    local = commands.add_parser('app')
+    local.add_argument('--database-url', default=None,
+                       help='a database to drop and reseed, '
+                            'by default a temporary SQLite file')
+    local.add_argument('--concurrency', type=int, default=8)
+    local.add_argument('--requests', type=int, default=200)
+    local.add_argument('--portfolios', type=int, default=200)
+    local.add_argument('--securities', type=int, default=500)
+    local.add_argument('--holdings', type=int, default=20,
+                       help='median number of holdings per portfolio')
+    local.add_argument('--seed', type=int, default=0)
+    local.add_argument('--baseline', type=argparse.FileType('r'))
+    local.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.command == 'servers':
+        print(json.dumps({
+            name: run(url, args.path, args.token, args.concurrency,
+                      args.requests)
+            for name, url in (('sync', args.sync_url),
+                              ('async', args.async_url))
+        }, indent=2))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        report = run_app(
+            database_url, args.concurrency, args.requests,
+            args.portfolios, args.securities, args.holdings, args.seed)
+
+    if args.baseline is not None:
+        report['regressions'] = regressions(
+            report, json.load(args.baseline), args.tolerance)
+    print(json.dumps(report, indent=2))
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import numpy as np
+import orjson
+from flask import Response
+
+from models import db, Security, PortfolioComposition, reference_data
+
+
+'''
+dictionary_encode(ids, name)
+    the code of every id in `ids` and the lookup table of names the codes
+    index into, one entry per distinct id
+'''
+
+
+def dictionary_encode(ids, name):
+    lookup_ids, codes = np.unique(
+        np.asarray(ids, dtype=np.int64), return_inverse=True)
+    return codes.reshape(-1), [name(id) for id in lookup_ids.tolist()]
+
+
+'''
+columnar_securities(rows)
+    parallel arrays of (id, name, region_id, asset_class_id) security rows,
+    with the regions and asset classes dictionary-encoded
+'''
+
+
+def columnar_securities(rows):
+    security_ids, names, region_ids, asset_class_ids = \
+        zip(*rows) if rows else ((), (), (), ())
+    region_codes, regions = dictionary_encode(
+        region_ids, reference_data.region_name)
+    asset_class_codes, asset_classes = dictionary_encode(
+        asset_class_ids, reference_data.asset_class_name)
+
+    return {
+        'securities': {
+            'security_id': np.asarray(security_ids, dtype=np.int64),
+            'security_name': list(names),
+            'region': region_codes,
+            'asset_class': asset_class_codes
+        },
+        'regions': regions,
+        'asset_classes': asset_classes
+    }
+
+
+'''
+columnar_portfolios(portfolios)
+    parallel arrays of the (id, name) portfolio rows, and of all their
+    compositions read in one query, one entry per composition
+'''
+
+
+def columnar_portfolios(portfolios):
+    portfolio_ids = [portfolio_id for portfolio_id, _ in portfolios]
+    rows = db.session.query(
+        PortfolioComposition.portfolio_id,
+        Security.name,
+        Security.region_id,
+        Security.asset_class_id,
+        PortfolioComposition.weight
+    ).join(
+        Security, Security.id == PortfolioComposition.security_id
+    ).filter(
+        PortfolioComposition.portfolio_id.in_(portfolio_ids)
+    ).order_by(
+        PortfolioComposition.portfolio_id, PortfolioComposition.security_id
+    ).all()
+
+    composition_ids, security_names, region_ids, asset_class_ids, weights = \
+        zip(*rows) if rows else ((), (), (), (), ())
+    region_codes, regions = dictionary_encode(
+        region_ids, reference_data.region_name)
+    asset_class_codes, asset_classes = dictionary_encode(
+        asset_class_ids, reference_data.asset_class_name)
+
+    return {
+        'portfolios': {
+            'portfolio_id': np.asarray(portfolio_ids, dtype=np.int64),
+            'portfolio_name': [name for _, name in portfolios]
+        },
+        'portfolio_compositions': {
+            'portfolio_id': np.asarray(composition_ids, dtype=np.int64),
+            'security_name': list(security_names),
+            'region': region_codes,
+            'asset_class': asset_class_codes,
+            'weight': np.asarray(weights, dtype=np.int64)
+        },
+        'regions': regions,
+        'asset_classes': asset_classes
+    }
+
+
+def columnar_response(payload):
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        mimetype='application/json')
@@ -0,0 +1,23 @@
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+from metrics import MULTIPROC_DIR
+
+
+'''
+gunicorn settings, read by `gunicorn app:app` from the working directory
+'''
+
+
+def on_starting(server):
+    # samples left by a previous run of the workers would be summed in
+    if MULTIPROC_DIR:
+        shutil.rmtree(MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(MULTIPROC_DIR)
+
+
+def child_exit(server, worker):
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(worker.pid, MULTIPROC_DIR)
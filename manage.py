@@ -1,8 +1,13 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
+import json
+import numpy as np
+
 from app import create_app
 from models import db
+from analytics import load_exposure_matrix, exposure_report
+from synthetic_data import load_synthetic_data
 
 app = create_app()
 migrate = Migrate(app, db)
@@ -11,5 +16,49 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-o', '--output', dest='output', default=None,
+                help='save the weight matrix and rollups to this .npz file')
+def exposure(output=None):
+    """Print the firm-wide region and asset class exposures"""
+    matrix = load_exposure_matrix()
+    report = exposure_report(matrix)
+    print(json.dumps({
+        'portfolios': len(report['portfolio_ids']),
+        'firm_by_region': report['firm_by_region'],
+        'firm_by_asset_class': report['firm_by_asset_class']
+    }, indent=2))
+
+    if output is not None:
+        np.savez_compressed(
+            output,
+            portfolio_ids=matrix.portfolio_ids,
+            security_ids=matrix.security_ids,
+            # in coordinate form, like the matrix itself
+            rows=matrix.rows,
+            columns=matrix.columns,
+            weights=matrix.weights,
+            shape=np.array(matrix.shape),
+            by_region=matrix.by_region(),
+            by_asset_class=matrix.by_asset_class(),
+            regions=np.array(report['regions']),
+            asset_classes=np.array(report['asset_classes']))
+
+
+@manager.option('--seed', dest='seed', type=int, default=0)
+@manager.option('--regions', dest='regions', type=int, default=5)
+@manager.option('--asset-classes', dest='asset_classes', type=int, default=3)
+@manager.option('--securities', dest='securities', type=int, default=10000)
+@manager.option('--portfolios', dest='portfolios', type=int, default=1000)
+@manager.option('--median-holdings', dest='median_holdings', type=int,
+                default=30, help='median number of holdings per portfolio')
+@manager.option('--max-holdings', dest='max_holdings', type=int, default=100)
+def generate(seed=0, regions=5, asset_classes=3, securities=10000,
+             portfolios=1000, median_holdings=30, max_holdings=100):
+    """Load synthetic regions, asset classes, securities and portfolios"""
+    print(json.dumps(load_synthetic_data(
+        seed, regions, asset_classes, securities, portfolios,
+        median_holdings, max_holdings), indent=2))
+
+
 if __name__ == '__main__':
     manager.run()
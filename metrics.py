@@ -0,0 +1,188 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import Response, g, request, has_request_context
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest,
+                               multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+Prometheus metrics
+
+    Every request records its latency, and the parts of it spent verifying
+    the token and running SQL statements, by route. Lookups in the verified
+    token cache are counted as hits and misses. Requests served by the
+    async handlers of asgi.py keep their timings in a context variable
+    instead of flask.g and are recorded under the same routes.
+
+    Under gunicorn, set `prometheus_multiproc_dir` to an empty directory:
+    each worker then writes its samples there and /metrics sums them over
+    all the workers.
+'''
+
+
+# prometheus-client 0.8 only writes the samples under the lowercase name
+MULTIPROC_DIR = os.environ.get('prometheus_multiproc_dir')
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time spent serving the request',
+    ['method', 'route', 'status'])
+AUTH_LATENCY = Histogram(
+    'http_request_auth_seconds', 'Time spent checking the bearer token',
+    ['route'])
+SQL_LATENCY = Histogram(
+    'http_request_sql_seconds', 'Time spent running SQL statements',
+    ['route'])
+SQL_STATEMENTS = Histogram(
+    'http_request_sql_statements', 'SQL statements run by the request',
+    ['route'], buckets=STATEMENT_BUCKETS)
+APP_LATENCY = Histogram(
+    'http_request_app_seconds',
+    'Time spent outside auth and SQL, mostly handler code and serialization',
+    ['route'])
+JWKS_FETCH_LATENCY = Histogram(
+    'jwks_fetch_duration_seconds', 'Time spent fetching the JSON Web Key Set',
+    ['outcome'])
+TOKEN_CACHE_HITS = Counter(
+    'token_cache_hits', 'Bearer tokens found in the verified token cache')
+TOKEN_CACHE_MISSES = Counter(
+    'token_cache_misses', 'Bearer tokens missing from the verified token cache')
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.status = None
+        self.auth_seconds = 0.0
+        self.sql_seconds = 0.0
+        self.statements = 0
+
+
+# the timings of an async request, which has no flask.g
+async_timings = ContextVar('request_timings', default=None)
+
+
+def current_timings():
+    if not has_request_context():
+        return async_timings.get()
+    return g.get('request_timings', None)
+
+
+def record_statement(seconds):
+    timings = current_timings()
+    if timings is not None:
+        timings.sql_seconds += seconds
+        timings.statements += 1
+
+
+'''
+observe(method, route, timings)
+    records the latency, auth, SQL and app time of a finished request
+'''
+
+
+def observe(method, route, timings):
+    elapsed = time.perf_counter() - timings.started
+    REQUEST_LATENCY.labels(
+        method, route, str(timings.status or 500)).observe(elapsed)
+    AUTH_LATENCY.labels(route).observe(timings.auth_seconds)
+    SQL_LATENCY.labels(route).observe(timings.sql_seconds)
+    SQL_STATEMENTS.labels(route).observe(timings.statements)
+    APP_LATENCY.labels(route).observe(max(
+        elapsed - timings.auth_seconds - timings.sql_seconds, 0.0))
+
+
+@contextmanager
+def auth_timer():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = current_timings()
+        if timings is not None:
+            timings.auth_seconds += time.perf_counter() - started
+
+
+@contextmanager
+def jwks_fetch_timer():
+    started = time.perf_counter()
+    outcome = 'failure'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        JWKS_FETCH_LATENCY.labels(outcome).observe(
+            time.perf_counter() - started)
+
+
+'''
+SQL statements are timed for every engine, including the replica bind.
+Statements run outside a request (CLI commands, migrations) are not
+recorded. The start time is kept on the execution context, which is
+dropped along with it when the statement fails.
+'''
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context,
+                   executemany):
+    started = getattr(context, 'metrics_started', None)
+    if started is not None:
+        record_statement(time.perf_counter() - started)
+
+
+def route_label():
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+'''
+init_metrics(app)
+    times every request of `app` and serves the samples on GET /metrics
+'''
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_timings():
+        g.request_timings = RequestTimings()
+
+    @app.after_request
+    def record_status(response):
+        timings = current_timings()
+        if timings is not None:
+            timings.status = response.status_code
+        return response
+
+    # teardown runs once a streamed response has been sent to the end
+    @app.teardown_request
+    def observe_timings(exception=None):
+        timings = current_timings()
+        if timings is None or request.endpoint == 'metrics':
+            return
+        observe(request.method, route_label(), timings)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render_metrics(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def render_metrics(multiproc_dir=MULTIPROC_DIR):
+    if multiproc_dir is None:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    return generate_latest(registry)
@@ -1,21 +1,143 @@
 import os
-from flask_sqlalchemy import SQLAlchemy
+import json
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from functools import wraps
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import slow_query_log
+from slow_query_log import SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_LOG_FILE
 
 database_path = os.environ.get('DATABASE_URL')
+replica_path = os.environ.get('DATABASE_REPLICA_URL')
+REFERENCE_DATA_TTL = int(os.environ.get('REFERENCE_DATA_TTL', 300))
+REFERENCE_DATA_MIN_RELOAD_INTERVAL = int(
+    os.environ.get('REFERENCE_DATA_MIN_RELOAD_INTERVAL', 30))
+COMPOSITION_SNAPSHOT_INTERVAL = int(
+    os.environ.get('COMPOSITION_SNAPSHOT_INTERVAL', 100))
 
-db = SQLAlchemy()
+
+'''
+Connection pool settings, each left to the SQLAlchemy default when unset
+    DB_POOL_SIZE: connections kept open per worker
+    DB_MAX_OVERFLOW: connections opened above the pool size under load
+    DB_POOL_RECYCLE: seconds after which a connection is replaced
+    DB_POOL_PRE_PING: test connections before handing them out
+    DB_STATEMENT_TIMEOUT: milliseconds before Postgres cancels a statement
+'''
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+DB_POOL_SIZE = _env_int('DB_POOL_SIZE')
+DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW')
+DB_POOL_RECYCLE = _env_int('DB_POOL_RECYCLE')
+DB_POOL_PRE_PING = os.environ.get(
+    'DB_POOL_PRE_PING', '').lower() in ('1', 'true', 'yes')
+DB_STATEMENT_TIMEOUT = _env_int('DB_STATEMENT_TIMEOUT')
+
+REPLICA_BIND = 'replica'
+
+'''
+engine_options(sa_url)
+    the pool and timeout options of the engine connecting to `sa_url`.
+    SQLite file databases don't keep a pool and have no statement timeout,
+    so they only get the recycle and pre-ping settings.
+'''
+
+
+def engine_options(sa_url):
+    options = {}
+    if DB_POOL_RECYCLE is not None:
+        options['pool_recycle'] = DB_POOL_RECYCLE
+    if DB_POOL_PRE_PING:
+        options['pool_pre_ping'] = True
+    if sa_url.drivername.startswith('sqlite'):
+        return options
+
+    if DB_POOL_SIZE is not None:
+        options['pool_size'] = DB_POOL_SIZE
+    if DB_MAX_OVERFLOW is not None:
+        options['max_overflow'] = DB_MAX_OVERFLOW
+    if DB_STATEMENT_TIMEOUT is not None and \
+            sa_url.drivername.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(DB_STATEMENT_TIMEOUT)}
+    return options
+
+
+'''
+RoutingSession
+    sends the queries of a request marked with @read_replica to the replica
+    bind, when one is configured. Flushes always go to the primary.
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and \
+                request.environ.get('read_replica', False) and \
+                REPLICA_BIND in (self.app.config['SQLALCHEMY_BINDS'] or {}):
+            return get_state(self.app).db.get_engine(
+                self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        options.update(engine_options(sa_url))
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with the read
+    replica as the `replica` bind when `replica_path` is set. Statements
+    slower than `slow_query_threshold` milliseconds are logged to
+    `slow_query_log_file` when it is set (see slow_query_log).
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_path=replica_path,
+             slow_query_threshold=SLOW_QUERY_THRESHOLD_MS,
+             slow_query_log_file=SLOW_QUERY_LOG_FILE):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: replica_path}
     db.app = app
     db.init_app(app)
+    slow_query_log.install(app, slow_query_threshold, slow_query_log_file)
+
+
+'''
+read_replica(f)
+    routes the queries of the decorated request handler to the replica,
+    including those of a response streamed after the handler returned
+'''
+
+
+def read_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        request.environ['read_replica'] = True
+        return f(*args, **kwargs)
+    return wrapper
 
 
 '''
@@ -36,21 +158,97 @@ class PortfolioComposition(db.Model):
         primary_key=True)
     weight = db.Column(db.Integer, nullable=False)
 
-    security = db.relationship("Security", backref="portfolio_composition")
+    # the primary key leads with portfolio_id; this index serves lookups by
+    # security and covers the weight so they never touch the table
+    __table_args__ = (
+        db.Index('ix_portfolio_composition_security_id',
+                 'security_id', 'portfolio_id', 'weight'),
+    )
+
+    security = db.relationship(
+        "Security", backref="portfolio_composition", lazy="joined")
 
     def insert(self):
         db.session.add(self)
         db.session.commit()
 
+    '''
+    holders(security_id)
+        the (portfolio id, portfolio name, weight) of every portfolio holding
+        the security
+    '''
+
+    @staticmethod
+    def holders(security_id):
+        return db.session.query(
+            PortfolioComposition.portfolio_id,
+            Portfolio.name,
+            PortfolioComposition.weight
+        ).join(
+            Portfolio, Portfolio.id == PortfolioComposition.portfolio_id
+        ).filter(
+            PortfolioComposition.security_id == security_id
+        ).order_by(PortfolioComposition.portfolio_id).all()
+
+    @staticmethod
+    def is_held(security_id):
+        # EXISTS stops at the first matching row
+        return db.session.query(PortfolioComposition.query.filter(
+            PortfolioComposition.security_id == security_id
+        ).exists()).scalar()
+
     def format(self):
         return {
             'security_name': self.security.name,
-            'region': self.security.region.name,
-            'asset_class': self.security.asset_class.name,
+            'region': reference_data.region_name(self.security.region_id),
+            'asset_class': reference_data.asset_class_name(
+                self.security.asset_class_id),
             'weight': self.weight
         }
 
 
+'''
+upsert_compositions(added, changed)
+    writes composition rows keyed on (portfolio_id, security_id). On
+    Postgres this is a single INSERT ... ON CONFLICT DO UPDATE executemany;
+    other databases get a bulk insert of the added rows and a bulk update
+    of the changed ones.
+'''
+
+
+def upsert_compositions(added, changed):
+    if not added and not changed:
+        return
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        statement = postgresql.insert(PortfolioComposition.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=['portfolio_id', 'security_id'],
+            set_={'weight': statement.excluded.weight})
+        db.session.execute(statement, added + changed)
+        return
+
+    if added:
+        db.session.bulk_insert_mappings(PortfolioComposition, added)
+    if changed:
+        db.session.bulk_update_mappings(PortfolioComposition, changed)
+
+
+'''
+database_now()
+    the current UTC time of the database server. The history is stamped
+    with it so that workers on hosts with skewed clocks agree on the order
+    of the writes. SQLite runs in this process, on this host's clock.
+'''
+
+
+def database_now():
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return datetime.utcnow()
+    return db.session.query(
+        db.func.timezone('UTC', db.func.clock_timestamp())).scalar()
+
+
 '''
 Portfolios
 '''
@@ -61,13 +259,135 @@ class Portfolio(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
+    # bumped by every write to the portfolio or its compositions
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
 
+    # compositions (joined with their security) are loaded in one extra
+    # SELECT ... IN query for all the portfolios of a result; region and
+    # asset class names come from the reference data cache
     portfolio_compositions = db.relationship(
         "PortfolioComposition",
         backref="portfolio",
-        cascade="all, delete, delete-orphan")
+        cascade="all, delete, delete-orphan",
+        lazy="selectin")
+
+    def insert(self, compositions, commit=True):
+        Portfolio.insert_all([(self, compositions)], commit)
+
+    '''
+    insert_all(entries)
+        inserts (portfolio, compositions) pairs in one transaction, writing
+        the compositions of every portfolio with a single executemany
+    '''
+
+    @staticmethod
+    def insert_all(entries, commit=True):
+        db.session.add_all([portfolio for portfolio, _ in entries])
+        db.session.flush()
+        rows = [
+            {
+                'portfolio_id': portfolio.id,
+                'security_id': composition['security_id'],
+                'weight': composition['weight']
+            }
+            for portfolio, compositions in entries
+            for composition in compositions]
+        db.session.bulk_insert_mappings(PortfolioComposition, rows)
+        now = database_now()
+        PortfolioCompositionHistory.record(rows, now)
+        PortfolioNameHistory.record(
+            [(portfolio.id, portfolio.name) for portfolio, _ in entries], now)
+        PortfolioSummary.refresh([portfolio.id for portfolio, _ in entries])
+        if commit:
+            db.session.commit()
+
+    '''
+    update_compositions(compositions)
+        brings the stored compositions in line with `compositions`, only
+        writing the rows that were added, changed or removed. Returns the
+        number of rows in each of those three groups.
+    '''
+
+    def update_compositions(self, compositions, commit=True):
+        current = {composition.security_id: composition.weight
+                   for composition in self.portfolio_compositions}
+        target = {composition['security_id']: composition['weight']
+                  for composition in compositions}
+
+        added = []
+        changed = []
+        for security_id, weight in target.items():
+            row = {'portfolio_id': self.id, 'security_id': security_id,
+                   'weight': weight}
+            if security_id not in current:
+                added.append(row)
+            elif current[security_id] != weight:
+                changed.append(row)
+        removed = [security_id for security_id in current
+                   if security_id not in target]
+
+        if removed:
+            PortfolioComposition.query.filter(
+                PortfolioComposition.portfolio_id == self.id,
+                PortfolioComposition.security_id.in_(removed)
+            ).delete(synchronize_session=False)
+        upsert_compositions(added, changed)
+
+        if added or changed or removed:
+            now = database_now()
+            PortfolioCompositionHistory.close(self.id, now, removed + [
+                row['security_id'] for row in changed])
+            PortfolioCompositionHistory.record(added + changed, now)
+            PortfolioSnapshot.take_if_due(self.id, now)
+            PortfolioSummary.refresh([self.id])
+
+        # the loaded collection no longer matches the rows written above
+        db.session.expire(self, ['portfolio_compositions'])
+        if commit:
+            db.session.commit()
+
+        return {
+            'added': len(added),
+            'changed': len(changed),
+            'removed': len(removed)
+        }
+
+    def rename(self, name):
+        if name == self.name:
+            return
+        now = database_now()
+        PortfolioNameHistory.close(self.id, now)
+        PortfolioNameHistory.record([(self.id, name)], now)
+        self.name = name
+
+    def touch(self):
+        self.version = Portfolio.version + 1
+
+    '''
+    touch_holders(security_id)
+        bumps the version of every portfolio holding the security, whose
+        formatted compositions change with the security
+    '''
+
+    @staticmethod
+    def touch_holders(security_id):
+        holders = db.session.query(PortfolioComposition.portfolio_id).filter(
+            PortfolioComposition.security_id == security_id)
+        Portfolio.query.filter(Portfolio.id.in_(holders.subquery())).update(
+            {Portfolio.version: Portfolio.version + 1},
+            synchronize_session=False)
+
+    def etag(self):
+        return portfolio_etag(self.id, self.version)
 
     def delete(self):
+        now = database_now()
+        PortfolioCompositionHistory.close(self.id, now)
+        PortfolioNameHistory.close(self.id, now)
+        PortfolioSummary.query.filter(
+            PortfolioSummary.portfolio_id == self.id
+        ).delete(synchronize_session=False)
         db.session.delete(self)
         db.session.commit()
 
@@ -76,6 +396,386 @@ class Portfolio(db.Model):
             portfolio_composition.format() for portfolio_composition in self.portfolio_compositions]}
 
 
+def portfolio_etag(portfolio_id, version):
+    return 'portfolio-{}-{}'.format(portfolio_id, version)
+
+
+'''
+PortfolioCompositionHistory
+    append-only log of the portfolio compositions. Each row is one weight
+    held over [valid_from, valid_to); valid_to is NULL while it is current.
+    Writes close the rows they replace and append new ones, in the same
+    transaction as the composition rows.
+'''
+
+
+class PortfolioCompositionHistory(db.Model):
+    __tablename__ = 'portfolio_composition_history'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # no foreign keys: the history outlives deleted portfolios and securities
+    portfolio_id = db.Column(db.Integer, nullable=False)
+    security_id = db.Column(db.Integer, nullable=False)
+    weight = db.Column(db.Integer, nullable=False)
+    valid_from = db.Column(db.DateTime, nullable=False)
+    valid_to = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_portfolio_composition_history_portfolio_id',
+                 'portfolio_id', 'valid_from'),
+    )
+
+    @staticmethod
+    def record(rows, now):
+        if rows:
+            db.session.bulk_insert_mappings(PortfolioCompositionHistory, [
+                dict(row, valid_from=now) for row in rows])
+
+    @staticmethod
+    def close(portfolio_id, now, security_ids=None):
+        query = PortfolioCompositionHistory.query.filter(
+            PortfolioCompositionHistory.portfolio_id == portfolio_id,
+            PortfolioCompositionHistory.valid_to.is_(None))
+        if security_ids is not None:
+            if not security_ids:
+                return
+            query = query.filter(
+                PortfolioCompositionHistory.security_id.in_(security_ids))
+        query.update({PortfolioCompositionHistory.valid_to: now},
+                     synchronize_session=False)
+
+    '''
+    rows(portfolio_id, snapshot, as_of)
+        the rows valid at `as_of` (or the current rows when it is None).
+        Those are either open at the snapshot, and listed in it, or appended
+        after it, so the range scanned on (portfolio_id, valid_from) is only
+        the change log since the snapshot.
+    '''
+
+    @staticmethod
+    def rows(portfolio_id, snapshot=None, as_of=None):
+        return PortfolioCompositionHistory.valid_at(
+            PortfolioCompositionHistory.query, portfolio_id, snapshot, as_of
+        ).order_by(PortfolioCompositionHistory.security_id).all()
+
+    @staticmethod
+    def valid_at(query, portfolio_id, snapshot, as_of):
+        query = query.filter(
+            PortfolioCompositionHistory.portfolio_id == portfolio_id)
+        if snapshot is not None:
+            query = query.filter(db.or_(
+                PortfolioCompositionHistory.valid_from > snapshot.taken_at,
+                PortfolioCompositionHistory.id.in_(snapshot.row_ids())))
+        if as_of is None:
+            query = query.filter(PortfolioCompositionHistory.valid_to.is_(None))
+        else:
+            query = query.filter(
+                PortfolioCompositionHistory.valid_from <= as_of,
+                db.or_(PortfolioCompositionHistory.valid_to.is_(None),
+                       PortfolioCompositionHistory.valid_to > as_of))
+        return query
+
+    '''
+    as_of(portfolio_id, as_of)
+        the name of the portfolio at `as_of` and its (row, security) pairs
+        then, or None when the portfolio did not exist then. One SELECT
+        reads the name and the latest snapshot before `as_of`, and a second
+        the rows since the snapshot joined with their securities, which are
+        None once deleted.
+    '''
+
+    @staticmethod
+    def as_of(portfolio_id, as_of):
+        snapshots = PortfolioSnapshot.before(portfolio_id, as_of).limit(1)
+        name, taken_at, history_row_ids = db.session.query(
+            PortfolioNameHistory.valid_at(
+                portfolio_id, as_of).limit(1).as_scalar(),
+            snapshots.with_entities(PortfolioSnapshot.taken_at).as_scalar(),
+            snapshots.with_entities(
+                PortfolioSnapshot.history_row_ids).as_scalar()
+        ).one()
+        if name is None:
+            return None
+
+        snapshot = None
+        if taken_at is not None:
+            snapshot = PortfolioSnapshot(
+                portfolio_id=portfolio_id, taken_at=taken_at,
+                history_row_ids=history_row_ids)
+        query = db.session.query(PortfolioCompositionHistory, Security) \
+            .outerjoin(
+                Security, Security.id == PortfolioCompositionHistory.security_id)
+        return name, PortfolioCompositionHistory.valid_at(
+            query, portfolio_id, snapshot, as_of
+        ).order_by(PortfolioCompositionHistory.security_id).all()
+
+    def format(self, security):
+        return {
+            'security_name': security.name if security else None,
+            'region': reference_data.region_name(security.region_id)
+            if security else None,
+            'asset_class': reference_data.asset_class_name(
+                security.asset_class_id) if security else None,
+            'weight': self.weight
+        }
+
+
+'''
+PortfolioNameHistory
+    append-only log of the portfolio names, kept like the composition
+    history, so that reads as of a date report the name held then
+'''
+
+
+class PortfolioNameHistory(db.Model):
+    __tablename__ = 'portfolio_name_history'
+
+    id = db.Column(db.Integer, primary_key=True)
+    portfolio_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String, nullable=False)
+    valid_from = db.Column(db.DateTime, nullable=False)
+    valid_to = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_portfolio_name_history_portfolio_id',
+                 'portfolio_id', 'valid_from'),
+    )
+
+    @staticmethod
+    def record(names, now):
+        if names:
+            db.session.bulk_insert_mappings(PortfolioNameHistory, [{
+                'portfolio_id': portfolio_id,
+                'name': name,
+                'valid_from': now
+            } for portfolio_id, name in names])
+
+    @staticmethod
+    def close(portfolio_id, now):
+        PortfolioNameHistory.query.filter(
+            PortfolioNameHistory.portfolio_id == portfolio_id,
+            PortfolioNameHistory.valid_to.is_(None)
+        ).update({PortfolioNameHistory.valid_to: now},
+                 synchronize_session=False)
+
+    # the name of the portfolio at `as_of`, when it existed then
+    @staticmethod
+    def valid_at(portfolio_id, as_of):
+        return db.session.query(PortfolioNameHistory.name).filter(
+            PortfolioNameHistory.portfolio_id == portfolio_id,
+            PortfolioNameHistory.valid_from <= as_of,
+            db.or_(PortfolioNameHistory.valid_to.is_(None),
+                   PortfolioNameHistory.valid_to > as_of)
+        ).order_by(PortfolioNameHistory.valid_from.desc())
+
+
+'''
+PortfolioSnapshot
+    the ids of the history rows open at `taken_at`. A snapshot is taken once
+    COMPOSITION_SNAPSHOT_INTERVAL rows were appended since the previous one,
+    which bounds the change log an as-of read goes through.
+'''
+
+
+class PortfolioSnapshot(db.Model):
+    __tablename__ = 'portfolio_snapshot'
+
+    id = db.Column(db.Integer, primary_key=True)
+    portfolio_id = db.Column(db.Integer, nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    history_row_ids = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_portfolio_snapshot_portfolio_id',
+                 'portfolio_id', 'taken_at'),
+    )
+
+    def row_ids(self):
+        return json.loads(self.history_row_ids)
+
+    @staticmethod
+    def before(portfolio_id, as_of=None):
+        query = PortfolioSnapshot.query.filter(
+            PortfolioSnapshot.portfolio_id == portfolio_id)
+        if as_of is not None:
+            query = query.filter(PortfolioSnapshot.taken_at <= as_of)
+        return query.order_by(PortfolioSnapshot.taken_at.desc())
+
+    @staticmethod
+    def latest(portfolio_id, as_of=None):
+        return PortfolioSnapshot.before(portfolio_id, as_of).first()
+
+    @staticmethod
+    def take_if_due(portfolio_id, now):
+        taken_at = db.session.query(db.func.max(PortfolioSnapshot.taken_at)) \
+            .filter(PortfolioSnapshot.portfolio_id == portfolio_id).as_scalar()
+        appended = db.session.query(
+            db.func.count(PortfolioCompositionHistory.id)
+        ).filter(
+            PortfolioCompositionHistory.portfolio_id == portfolio_id,
+            db.or_(taken_at.is_(None),
+                   PortfolioCompositionHistory.valid_from > taken_at)
+        ).scalar()
+        if appended < COMPOSITION_SNAPSHOT_INTERVAL:
+            return
+
+        rows = PortfolioCompositionHistory.rows(
+            portfolio_id, PortfolioSnapshot.latest(portfolio_id))
+        db.session.add(PortfolioSnapshot(
+            portfolio_id=portfolio_id, taken_at=now,
+            history_row_ids=json.dumps([row.id for row in rows])))
+
+
+'''
+portfolio_exposures(portfolio_ids)
+    sums the weights of each portfolio by region and by asset class with a
+    single GROUP BY over the composition, security, region and asset class
+    tables. Portfolios without compositions are left out of the result.
+'''
+
+
+def portfolio_exposures(portfolio_ids):
+    rows = db.session.query(
+        PortfolioComposition.portfolio_id,
+        Region.name,
+        AssetClass.name,
+        db.func.sum(PortfolioComposition.weight)
+    ).join(
+        Security, Security.id == PortfolioComposition.security_id
+    ).join(
+        Region, Region.id == Security.region_id
+    ).join(
+        AssetClass, AssetClass.id == Security.asset_class_id
+    ).filter(
+        PortfolioComposition.portfolio_id.in_(portfolio_ids)
+    ).group_by(
+        PortfolioComposition.portfolio_id, Region.name, AssetClass.name
+    )
+
+    exposures = {}
+    for portfolio_id, region, asset_class, weight in rows:
+        exposure = exposures.setdefault(
+            portfolio_id, {'by_region': {}, 'by_asset_class': {}})
+        by_region = exposure['by_region']
+        by_asset_class = exposure['by_asset_class']
+        by_region[region] = by_region.get(region, 0) + weight
+        by_asset_class[asset_class] = \
+            by_asset_class.get(asset_class, 0) + weight
+    return exposures
+
+
+'''
+PortfolioSummary
+    denormalized read model of a portfolio for list views: the number of
+    holdings and the weights summed by region and asset class id. The
+    portfolio writes refresh the rows of the portfolios they touch in the
+    same transaction.
+'''
+
+
+class PortfolioSummary(db.Model):
+    __tablename__ = 'portfolio_summary'
+
+    portfolio_id = db.Column(
+        db.Integer,
+        db.ForeignKey('portfolio.id'),
+        primary_key=True)
+    holding_count = db.Column(db.Integer, nullable=False)
+    # JSON objects of region / asset class id -> total weight
+    by_region = db.Column(db.Text, nullable=False)
+    by_asset_class = db.Column(db.Text, nullable=False)
+
+    portfolio_name = db.column_property(
+        db.select([Portfolio.name]).where(
+            Portfolio.id == portfolio_id).as_scalar())
+
+    '''
+    refresh(portfolio_ids)
+        recomputes the summaries of the portfolios with one GROUP BY over
+        their compositions and rewrites their rows. On Postgres the rows
+        are upserted with INSERT ... ON CONFLICT DO UPDATE, so concurrent
+        refreshes of the same portfolio don't collide on the primary key;
+        other databases delete the rows and insert them again.
+    '''
+
+    @staticmethod
+    def refresh(portfolio_ids):
+        if not portfolio_ids:
+            return
+
+        totals = db.session.query(
+            PortfolioComposition.portfolio_id,
+            Security.region_id,
+            Security.asset_class_id,
+            db.func.sum(PortfolioComposition.weight),
+            db.func.count()
+        ).join(
+            Security, Security.id == PortfolioComposition.security_id
+        ).filter(
+            PortfolioComposition.portfolio_id.in_(portfolio_ids)
+        ).group_by(
+            PortfolioComposition.portfolio_id,
+            Security.region_id,
+            Security.asset_class_id
+        )
+
+        summaries = {portfolio_id: {
+            'portfolio_id': portfolio_id,
+            'holding_count': 0,
+            'by_region': {},
+            'by_asset_class': {}
+        } for portfolio_id in portfolio_ids}
+        for portfolio_id, region_id, asset_class_id, weight, count in totals:
+            summary = summaries[portfolio_id]
+            summary['holding_count'] += count
+            by_region = summary['by_region']
+            by_asset_class = summary['by_asset_class']
+            by_region[region_id] = by_region.get(region_id, 0) + weight
+            by_asset_class[asset_class_id] = \
+                by_asset_class.get(asset_class_id, 0) + weight
+
+        rows = [
+            dict(summary,
+                 by_region=json.dumps(summary['by_region']),
+                 by_asset_class=json.dumps(summary['by_asset_class']))
+            for summary in summaries.values()]
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            statement = postgresql.insert(PortfolioSummary.__table__)
+            statement = statement.on_conflict_do_update(
+                index_elements=['portfolio_id'],
+                set_={column: statement.excluded[column] for column in (
+                    'holding_count', 'by_region', 'by_asset_class')})
+            db.session.execute(statement, rows)
+            return
+
+        PortfolioSummary.query.filter(
+            PortfolioSummary.portfolio_id.in_(portfolio_ids)
+        ).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(PortfolioSummary, rows)
+
+    @staticmethod
+    def refresh_holders(security_id):
+        PortfolioSummary.refresh([
+            portfolio_id for portfolio_id, in db.session.query(
+                PortfolioComposition.portfolio_id
+            ).filter(PortfolioComposition.security_id == security_id)])
+
+    def format(self):
+        return {
+            'portfolio_id': self.portfolio_id,
+            'portfolio_name': self.portfolio_name,
+            'holding_count': self.holding_count,
+            'by_region': {
+                reference_data.region_name(region_id): weight
+                for region_id, weight in json.loads(self.by_region).items()},
+            'by_asset_class': {
+                reference_data.asset_class_name(asset_class_id): weight
+                for asset_class_id, weight
+                in json.loads(self.by_asset_class).items()}
+        }
+
+
 '''
 Securities
 '''
@@ -113,8 +813,9 @@ class Security(db.Model):
         return {
             'security_id': self.id,
             'security_name': self.name,
-            'region': self.region.name,
-            'asset_class': self.asset_class.name
+            'region': reference_data.region_name(self.region_id),
+            'asset_class': reference_data.asset_class_name(
+                self.asset_class_id)
         }
 
 
@@ -152,3 +853,140 @@ class Region(db.Model):
             'region_id': self.id,
             'region': self.name,
         }
+
+
+'''
+ReferenceData
+    in-process cache of the Region and AssetClass id -> name maps
+
+    Both maps are loaded together on first use. Committing a change to
+    either table drops them and bumps `version`; REFERENCE_DATA_TTL bounds
+    how long a worker can serve maps changed by another process. An id
+    missing from the maps triggers an early reload, rate limited to one
+    every `min_reload_interval` seconds so that unknown ids sent by clients
+    can't keep emptying the cache. Each map carries an ETag derived from
+    its content, so every worker serving the same data hands out the same
+    tag.
+'''
+
+
+ReferenceMaps = namedtuple(
+    'ReferenceMaps',
+    ['regions', 'asset_classes', 'regions_etag', 'asset_classes_etag'])
+
+
+def fingerprint(names):
+    content = json.dumps(sorted(names.items())).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+class ReferenceData:
+    def __init__(self, ttl=REFERENCE_DATA_TTL,
+                 min_reload_interval=REFERENCE_DATA_MIN_RELOAD_INTERVAL,
+                 clock=time.monotonic):
+        self.ttl = ttl
+        self.min_reload_interval = min_reload_interval
+        self.clock = clock
+        self.version = 0
+        self._maps = None
+        self._loaded_at = None
+        self._reloaded_at = None
+        self._lock = threading.Lock()
+
+    def _load(self, force=False):
+        maps = self._maps
+        if not force and maps is not None and \
+                self.clock() - self._loaded_at < self.ttl:
+            return maps
+
+        version = self.version
+        regions = dict(db.session.query(Region.id, Region.name))
+        asset_classes = dict(db.session.query(AssetClass.id, AssetClass.name))
+        maps = ReferenceMaps(
+            regions, asset_classes,
+            fingerprint(regions), fingerprint(asset_classes))
+        with self._lock:
+            # keep the maps only if nothing was invalidated while loading
+            if version == self.version:
+                self._maps = maps
+                self._loaded_at = self.clock()
+        return maps
+
+    def _lookup(self, index, key):
+        if key is None:
+            return None
+        names = self._load()[index]
+        if key not in names and self._may_reload():
+            # the row may have been added by another worker since the load
+            names = self._load(force=True)[index]
+        return names.get(key)
+
+    def _may_reload(self):
+        with self._lock:
+            now = self.clock()
+            if self._reloaded_at is not None and \
+                    now - self._reloaded_at < self.min_reload_interval:
+                return False
+            self._reloaded_at = now
+            return True
+
+    @property
+    def regions(self):
+        return self._load()[0]
+
+    @property
+    def asset_classes(self):
+        return self._load()[1]
+
+    def snapshot(self):
+        return self._load()
+
+    def region_name(self, region_id):
+        return self._lookup(0, _as_int(region_id))
+
+    def asset_class_name(self, asset_class_id):
+        return self._lookup(1, _as_int(asset_class_id))
+
+    def has_region(self, region_id):
+        return self.region_name(region_id) is not None
+
+    def has_asset_class(self, asset_class_id):
+        return self.asset_class_name(asset_class_id) is not None
+
+    def invalidate(self):
+        with self._lock:
+            self._maps = None
+            self._reloaded_at = None
+            self.version += 1
+
+
+# an id given as an int or a string of digits; floats and bools are not ids
+def _as_int(value):
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    if not isinstance(value, int) or isinstance(value, bool):
+        return None
+    return value
+
+
+reference_data = ReferenceData()
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_reference_data_changes(session, flush_context):
+    for instance in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(instance, (Region, AssetClass)):
+            session.info['reference_data_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_reference_data(session):
+    if session.info.pop('reference_data_changed', False):
+        reference_data.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_reference_data_changes(session):
+    session.info.pop('reference_data_changed', None)
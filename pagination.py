@@ -0,0 +1,77 @@
+import os
+import json
+import base64
+from collections import namedtuple
+from flask import request, abort
+
+
+DEFAULT_PAGE_LIMIT = int(os.environ.get('DEFAULT_PAGE_LIMIT', 100))
+MAX_PAGE_LIMIT = int(os.environ.get('MAX_PAGE_LIMIT', 1000))
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'is_first'])
+
+
+'''
+encode_cursor(last_id) / decode_cursor(cursor)
+    opaque cursors pointing just after the row with id `last_id`
+'''
+
+
+def encode_cursor(last_id):
+    raw = json.dumps({'id': last_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded))['id']
+    except Exception:
+        abort(422)
+    if not isinstance(last_id, int):
+        abort(422)
+    return last_id
+
+
+'''
+parse_limit(value)
+    the page size asked for by the `limit` argument, capped at
+    MAX_PAGE_LIMIT. Anything but a positive integer is rejected.
+'''
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_PAGE_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        abort(422)
+    if limit < 1:
+        abort(422)
+    return min(limit, MAX_PAGE_LIMIT)
+
+
+'''
+paginate(query, column)
+    returns one page of `query` using the `limit` and `cursor` request
+    arguments. Pages are seeked with `column > last_id` on the integer key
+    `column`, so fetching a deep page costs the same as the first one.
+'''
+
+
+def paginate(query, column):
+    limit = parse_limit(request.args.get('limit'))
+
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        query = query.filter(column > decode_cursor(cursor))
+
+    # fetch one extra row to know whether another page follows
+    items = query.order_by(column).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(getattr(items[-1], column.key))
+
+    return Page(items, next_cursor, cursor is None)
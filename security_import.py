@@ -0,0 +1,181 @@
+import os
+import csv
+import codecs
+import json
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Security, reference_data
+
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+IMPORT_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    '.csv': 'csv',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson'
+}
+
+
+def detect_format(mimetype, filename):
+    if mimetype in IMPORT_FORMATS:
+        return IMPORT_FORMATS[mimetype]
+    return IMPORT_FORMATS.get(os.path.splitext(filename or '')[1].lower())
+
+
+'''
+read_rows(stream, import_format)
+    yields (line number, row) pairs from an uploaded CSV or NDJSON stream
+    without reading the whole file into memory. A row that cannot be parsed
+    is yielded as its error message. The lines are decoded as they are
+    read rather than through io.TextIOWrapper, which needs a readable()
+    that the spooled temporary file of a multipart upload lacks before
+    Python 3.11.
+'''
+
+
+def read_rows(stream, import_format):
+    text = codecs.iterdecode(stream, 'utf-8')
+
+    if import_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, 'Invalid JSON.'
+            continue
+        if not isinstance(row, dict):
+            row = 'Each line must be a JSON object.'
+        yield line_number, row
+
+
+def parse_row(row, region_ids, asset_class_ids):
+    name = row.get('security_name')
+    if not isinstance(name, str) or not name.strip():
+        return None, 'security_name is required.'
+
+    try:
+        region_id = int(row.get('region_id'))
+        asset_class_id = int(row.get('asset_class_id'))
+    except (TypeError, ValueError):
+        return None, 'region_id and asset_class_id must be integers.'
+
+    if region_id not in region_ids:
+        return None, 'Unknown region_id {}.'.format(region_id)
+    if asset_class_id not in asset_class_ids:
+        return None, 'Unknown asset_class_id {}.'.format(asset_class_id)
+
+    return {
+        'name': name.strip(),
+        'region_id': region_id,
+        'asset_class_id': asset_class_id
+    }, None
+
+
+'''
+write_batch(rows)
+    inserts security rows with COPY on Postgres and with one executemany on
+    any other database
+'''
+
+
+def write_batch(rows):
+    connection = db.session.connection()
+
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(
+                [row['name'], row['region_id'], row['asset_class_id']])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY security (name, region_id, asset_class_id) '
+                'FROM STDIN WITH (FORMAT csv)', buffer)
+        finally:
+            cursor.close()
+        return
+
+    connection.execute(Security.__table__.insert(), rows)
+
+
+'''
+import_securities(stream, import_format)
+    imports every valid row of the stream in batches of IMPORT_BATCH_SIZE.
+    Invalid rows are reported and skipped; a batch rejected by the database
+    is rolled back to its savepoint without losing the other batches.
+    Returns the number of imported rows and the per-row errors.
+'''
+
+
+def import_securities(stream, import_format):
+    region_ids = set(reference_data.regions)
+    asset_class_ids = set(reference_data.asset_classes)
+    # COPY runs on the raw DBAPI cursor, which raises DBAPI errors
+    dbapi_error = db.session.get_bind().dialect.dbapi.Error
+    seen_names = set()
+    imported = 0
+    errors = []
+    batch = []
+
+    def flush_batch():
+        nonlocal imported
+        names = [row['name'] for _, row in batch]
+        existing = {name for name, in db.session.query(
+            Security.name).filter(Security.name.in_(names))}
+        pending = []
+        for line_number, row in batch:
+            if row['name'] in existing:
+                errors.append({
+                    'line': line_number,
+                    'message': 'Security {} already exists.'.format(
+                        row['name'])})
+            else:
+                pending.append((line_number, row))
+        batch.clear()
+        if not pending:
+            return
+
+        savepoint = db.session.begin_nested()
+        try:
+            write_batch([row for _, row in pending])
+            savepoint.commit()
+            imported += len(pending)
+        except (SQLAlchemyError, dbapi_error):
+            savepoint.rollback()
+            errors.extend({
+                'line': line_number,
+                'message': 'Batch rejected by the database.'
+            } for line_number, _ in pending)
+
+    for line_number, row in read_rows(stream, import_format):
+        if isinstance(row, str):
+            errors.append({'line': line_number, 'message': row})
+            continue
+
+        parsed, error = parse_row(row, region_ids, asset_class_ids)
+        if parsed is not None and parsed['name'] in seen_names:
+            error = 'Duplicate security_name in file.'
+        if error is not None:
+            errors.append({'line': line_number, 'message': error})
+            continue
+
+        seen_names.add(parsed['name'])
+        batch.append((line_number, parsed))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush_batch()
+
+    if batch:
+        flush_batch()
+    db.session.commit()
+
+    return imported, errors
@@ -0,0 +1,277 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from flask import current_app, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import route_label
+
+
+'''
+Slow-query log
+
+    Opt-in (see setup_db): every statement run inside the app is timed, and
+    those slower than SLOW_QUERY_THRESHOLD_MS are written to a rotating file
+    with their bound parameters redacted to their types and the route that
+    ran them. The slow statements are also aggregated by fingerprint (the
+    statement with its literals and placeholders normalized) for the admin
+    endpoint. The first time a SELECT fingerprint is slow its plan is
+    captured in a background thread, with EXPLAIN (ANALYZE, BUFFERS) on
+    Postgres and EXPLAIN QUERY PLAN on SQLite, and logged with it. Locking
+    reads (FOR UPDATE / FOR SHARE) are only planned, never run, so the
+    EXPLAIN can't take row locks or wait behind the request's transaction.
+
+    SLOW_QUERY_THRESHOLD_MS: enables the log, in milliseconds
+    SLOW_QUERY_LOG_FILE: the log file, rotated at SLOW_QUERY_LOG_MAX_BYTES
+    with SLOW_QUERY_LOG_BACKUPS old files kept
+'''
+
+
+def _env_float(name):
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+SLOW_QUERY_THRESHOLD_MS = _env_float('SLOW_QUERY_THRESHOLD_MS')
+SLOW_QUERY_LOG_FILE = os.environ.get('SLOW_QUERY_LOG_FILE', 'slow_queries.log')
+SLOW_QUERY_LOG_MAX_BYTES = int(
+    os.environ.get('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024))
+SLOW_QUERY_LOG_BACKUPS = int(os.environ.get('SLOW_QUERY_LOG_BACKUPS', 5))
+# fingerprints past this many are logged but not aggregated
+MAX_FINGERPRINTS = 1000
+
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN (ANALYZE, BUFFERS) ',
+    'sqlite': 'EXPLAIN QUERY PLAN '
+}
+LOCKING_EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN '
+}
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDERS = re.compile(r'%\(\w+\)s|%s|:\w+|\?')
+PLACEHOLDER_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+LOCKING_CLAUSE = re.compile(
+    r'\bFOR\s+(?:NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b',
+    re.IGNORECASE)
+
+
+'''
+normalize(statement)
+    the statement with its literals and placeholders replaced by ?, lists
+    of them collapsed to (?), and whitespace collapsed, so that the same
+    query with different values or IN list lengths normalizes the same
+'''
+
+
+def normalize(statement):
+    statement = LITERALS.sub('?', statement)
+    statement = PLACEHOLDERS.sub('?', statement)
+    statement = PLACEHOLDER_LISTS.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+def statement_fingerprint(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+'''
+explain_prefix(dialect_name, statement)
+    the EXPLAIN to run before `statement`, or None when it isn't a SELECT
+    or the dialect has none
+'''
+
+
+def explain_prefix(dialect_name, statement):
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    if LOCKING_CLAUSE.search(statement):
+        return LOCKING_EXPLAIN_PREFIXES.get(dialect_name)
+    return EXPLAIN_PREFIXES.get(dialect_name)
+
+
+def redact(parameters):
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact(value) for value in parameters]
+    if parameters is None:
+        return None
+    return '<{}>'.format(type(parameters).__name__)
+
+
+class SlowStatement:
+    def __init__(self, fingerprint, statement):
+        self.fingerprint = fingerprint
+        self.statement = statement
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.routes = set()
+        self.parameters = None
+        self.plan = None
+        self.explaining = False
+
+    def format(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'statement': self.statement,
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3),
+            'max_ms': round(self.max_ms, 3),
+            'routes': sorted(self.routes),
+            'parameters': self.parameters,
+            'plan': self.plan
+        }
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms, log_file=SLOW_QUERY_LOG_FILE,
+                 max_bytes=SLOW_QUERY_LOG_MAX_BYTES,
+                 backups=SLOW_QUERY_LOG_BACKUPS):
+        self.threshold_ms = threshold_ms
+        self.statements = {}
+        self._lock = threading.Lock()
+        self._explains = ThreadPoolExecutor(max_workers=1)
+        self._pending = set()
+        # an unregistered logger, closed along with the log
+        self.logger = logging.Logger('slow_queries')
+        self.handler = RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backups)
+        self.logger.addHandler(self.handler)
+
+    def write(self, entry):
+        self.logger.warning(json.dumps(dict(
+            entry, logged_at=datetime.utcnow().isoformat())))
+
+    def record(self, engine, statement, parameters, elapsed_ms, executemany):
+        normalized = normalize(statement)
+        fingerprint = statement_fingerprint(normalized)
+        route = route_label() if has_request_context() else None
+        rows = None
+        if executemany:
+            rows = len(parameters)
+            parameters = parameters[0] if parameters else ()
+        redacted = redact(parameters)
+
+        self.write({
+            'fingerprint': fingerprint,
+            'statement': statement,
+            'parameters': redacted,
+            'rows': rows,
+            'elapsed_ms': round(elapsed_ms, 3),
+            'route': route
+        })
+
+        with self._lock:
+            entry = self.statements.get(fingerprint)
+            if entry is None:
+                if len(self.statements) >= MAX_FINGERPRINTS:
+                    return
+                entry = self.statements[fingerprint] = SlowStatement(
+                    fingerprint, normalized)
+            entry.count += 1
+            entry.total_ms += elapsed_ms
+            entry.max_ms = max(entry.max_ms, elapsed_ms)
+            if route is not None:
+                entry.routes.add(route)
+            entry.parameters = redacted
+
+            prefix = explain_prefix(engine.dialect.name, statement)
+            if prefix is None or executemany or entry.explaining:
+                return
+            entry.explaining = True
+
+        future = self._explains.submit(
+            self.explain, engine, entry, prefix + statement, parameters)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    def explain(self, engine, entry, statement, parameters):
+        '''
+        runs on the explain thread, outside the app context, so the EXPLAIN
+        statement itself is never timed
+        '''
+        try:
+            with engine.connect() as connection:
+                transaction = connection.begin()
+                try:
+                    rows = connection.execute(statement, parameters).fetchall()
+                finally:
+                    # ANALYZE runs the statement
+                    transaction.rollback()
+            plan = '\n'.join(str(row[-1]) for row in rows)
+        except Exception as error:
+            plan = 'EXPLAIN failed: {}'.format(error)
+
+        entry.plan = plan
+        self.write({'fingerprint': entry.fingerprint, 'plan': plan})
+
+    def wait(self):
+        wait(list(self._pending))
+
+    def top(self, limit):
+        with self._lock:
+            statements = sorted(
+                self.statements.values(),
+                key=lambda entry: (-entry.max_ms, entry.fingerprint))
+            return [entry.format() for entry in statements[:limit]]
+
+    def close(self):
+        self._explains.shutdown(wait=True)
+        self.handler.close()
+
+
+def current_log():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('slow_query_log')
+
+
+'''
+install(app, threshold_ms, log_file)
+    turns the slow-query log of `app` on, replacing any previous one. A
+    threshold of None turns it off.
+'''
+
+
+def install(app, threshold_ms, log_file=SLOW_QUERY_LOG_FILE):
+    previous = app.extensions.pop('slow_query_log', None)
+    if previous is not None:
+        previous.close()
+    if threshold_ms is not None:
+        app.extensions['slow_query_log'] = SlowQueryLog(
+            threshold_ms, log_file)
+
+
+# the start time is kept on the execution context, dropped with it when the
+# statement fails
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if context is not None and current_log() is not None:
+        context.slow_query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context,
+                   executemany):
+    log = current_log()
+    started = getattr(context, 'slow_query_started', None)
+    if log is None or started is None:
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms >= log.threshold_ms:
+        log.record(conn.engine, statement, parameters, elapsed_ms,
+                   executemany)
@@ -0,0 +1,262 @@
+import io
+import csv
+from collections import namedtuple
+import numpy as np
+
+from models import (db, Region, AssetClass, Security, Portfolio,
+                    PortfolioComposition, PortfolioCompositionHistory,
+                    PortfolioNameHistory, PortfolioSummary, database_now)
+
+
+'''
+Synthetic data
+
+    Generates regions, asset classes, securities and portfolios at any
+    scale, the same for the same seed. Portfolio sizes follow a lognormal
+    distribution around the median number of holdings, so most portfolios
+    are mid-sized with a long tail of broad ones, and the weights within a
+    portfolio are skewed the same way. Weights are whole percents, at least
+    1 each and summing to 100. Securities are spread over regions and asset
+    classes with a few of each holding most of them.
+
+    The rows are written with COPY on Postgres and with executemany on any
+    other database, with the ids taken after the largest ones in use.
+'''
+
+
+REGION_NAMES = ['Asia Pacific', 'Europe', 'Middle East', 'Africa', 'America']
+ASSET_CLASS_NAMES = ['Equity', 'Fixed Income', 'Alternative']
+HOLDINGS_SIGMA = 0.6
+# the weights are whole percents of at least 1
+MAX_HOLDINGS = 100
+EXECUTEMANY_BATCH_SIZE = 10000
+SUMMARY_BATCH_SIZE = 500
+PLACEHOLDERS = {
+    'qmark': '?',
+    'format': '%s',
+    'numeric': ':{index}',
+    'named': ':{column}',
+    'pyformat': '%({column})s'
+}
+
+SyntheticData = namedtuple('SyntheticData', [
+    'region_ids', 'asset_class_ids', 'securities', 'portfolio_ids',
+    'compositions'])
+
+
+def zipf_probabilities(count):
+    probabilities = 1 / np.arange(1, count + 1)
+    return probabilities / probabilities.sum()
+
+
+'''
+holding_counts(rng, portfolio_count, median, maximum)
+    the number of holdings of each portfolio, lognormal around `median` and
+    between 1 and `maximum`
+'''
+
+
+def holding_counts(rng, portfolio_count, median, maximum):
+    counts = np.rint(rng.lognormal(
+        np.log(median), HOLDINGS_SIGMA, portfolio_count)).astype(np.int64)
+    return np.clip(counts, 1, maximum)
+
+
+'''
+integer_weights(rng, counts)
+    skewed whole-percent weights of at least 1 summing to 100 for portfolios
+    of `counts` holdings, concatenated. The 100 - count percents left over
+    once every holding has 1 are shared in proportion to lognormal draws,
+    rounded down, and the percents lost to rounding go to the holdings with
+    the largest remainders.
+'''
+
+
+def integer_weights(rng, counts):
+    if len(counts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    total = int(counts.sum())
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    group = np.repeat(np.arange(len(counts)), counts)
+
+    draws = rng.lognormal(0, 1, total)
+    spare = 100 - counts
+    shares = draws / np.add.reduceat(draws, starts)[group] * spare[group]
+    weights = np.floor(shares).astype(np.int64)
+    remainders = shares - weights
+    lost = spare - np.add.reduceat(weights, starts)
+
+    # rank the holdings of each portfolio by remainder, largest first
+    order = np.lexsort((-remainders, group))
+    rank = np.arange(total) - starts[group[order]]
+    weights[order] += rank < lost[group[order]]
+    return weights + 1
+
+
+'''
+generate(seed, region_count, asset_class_count, security_count,
+         portfolio_count, median_holdings, max_holdings, first_ids)
+    the synthetic rows, with the region, asset class, security and portfolio
+    ids numbered from `first_ids`
+'''
+
+
+def generate(seed, region_count, asset_class_count, security_count,
+             portfolio_count, median_holdings, max_holdings=MAX_HOLDINGS,
+             first_ids=(1, 1, 1, 1)):
+    rng = np.random.default_rng(seed)
+    first_region, first_asset_class, first_security, first_portfolio = \
+        first_ids
+
+    region_ids = np.arange(region_count) + first_region
+    asset_class_ids = np.arange(asset_class_count) + first_asset_class
+    security_ids = np.arange(security_count) + first_security
+    securities = np.column_stack([
+        security_ids,
+        rng.choice(region_ids, security_count,
+                   p=zipf_probabilities(region_count)),
+        rng.choice(asset_class_ids, security_count,
+                   p=zipf_probabilities(asset_class_count))])
+
+    portfolio_ids = np.arange(portfolio_count) + first_portfolio
+    counts = holding_counts(rng, portfolio_count, median_holdings,
+                            min(max_holdings, MAX_HOLDINGS, security_count))
+    holdings = np.concatenate([
+        rng.choice(security_ids, count, replace=False) for count in counts
+    ] or [np.zeros(0, dtype=np.int64)])
+    compositions = np.column_stack([
+        np.repeat(portfolio_ids, counts),
+        holdings,
+        integer_weights(rng, counts)])
+
+    return SyntheticData(region_ids, asset_class_ids, securities,
+                         portfolio_ids, compositions)
+
+
+# the usual names go to the first ids, so they are only used in empty tables
+def reference_name(names, prefix, id):
+    return names[id - 1] if id <= len(names) else '{}_{}'.format(prefix, id)
+
+
+'''
+write_rows(connection, table, columns, rows)
+    inserts the rows with COPY on Postgres and on any other database with
+    an executemany on the DBAPI cursor, in batches of EXECUTEMANY_BATCH_SIZE,
+    which skips the per-row parameter processing of SQLAlchemy
+'''
+
+
+def write_rows(connection, table, columns, rows):
+    if not rows:
+        return
+
+    dialect = connection.dialect
+    preparer = dialect.identifier_preparer
+    cursor = connection.connection.cursor()
+    try:
+        if dialect.name == 'postgresql':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                    preparer.format_table(table),
+                    ', '.join(preparer.quote(column) for column in columns)),
+                buffer)
+            return
+
+        statement = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            preparer.format_table(table),
+            ', '.join(preparer.quote(column) for column in columns),
+            ', '.join(PLACEHOLDERS[dialect.paramstyle].format(
+                index=index + 1, column=column)
+                for index, column in enumerate(columns)))
+        # only the columns whose type converts values, such as dates on SQLite
+        processors = [
+            (index, processor) for index, processor in enumerate(
+                table.c[column].type.dialect_impl(dialect).bind_processor(
+                    dialect)
+                for column in columns) if processor is not None]
+        for start in range(0, len(rows), EXECUTEMANY_BATCH_SIZE):
+            batch = [list(row)
+                     for row in rows[start:start + EXECUTEMANY_BATCH_SIZE]]
+            for row in batch:
+                for index, processor in processors:
+                    row[index] = processor(row[index])
+            if not dialect.positional:
+                batch = [dict(zip(columns, row)) for row in batch]
+            cursor.executemany(statement, batch)
+    finally:
+        cursor.close()
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+'''
+load_synthetic_data(seed, region_count, asset_class_count, security_count,
+                    portfolio_count, median_holdings, max_holdings)
+    generates the rows and writes them, their composition and name history
+    and the portfolio summaries in one transaction. Returns the number of rows
+    written to each table.
+'''
+
+
+def load_synthetic_data(seed, region_count, asset_class_count, security_count,
+                        portfolio_count, median_holdings,
+                        max_holdings=MAX_HOLDINGS):
+    models = (Region, AssetClass, Security, Portfolio)
+    data = generate(seed, region_count, asset_class_count, security_count,
+                    portfolio_count, median_holdings, max_holdings,
+                    [next_id(model) for model in models])
+    connection = db.session.connection()
+    now = database_now()
+
+    write_rows(connection, Region.__table__, ['id', 'name'], [
+        (id, reference_name(REGION_NAMES, 'REGION', id))
+        for id in data.region_ids.tolist()])
+    write_rows(connection, AssetClass.__table__, ['id', 'name'], [
+        (id, reference_name(ASSET_CLASS_NAMES, 'ASSET_CLASS', id))
+        for id in data.asset_class_ids.tolist()])
+    write_rows(connection, Security.__table__,
+               ['id', 'name', 'region_id', 'asset_class_id'], [
+                   (id, 'SECURITY_{}'.format(id), region_id, asset_class_id)
+                   for id, region_id, asset_class_id
+                   in data.securities.tolist()])
+    portfolios = [(id, 'PORTFOLIO_{}'.format(id))
+                  for id in data.portfolio_ids.tolist()]
+    write_rows(connection, Portfolio.__table__, ['id', 'name'], portfolios)
+    write_rows(connection, PortfolioNameHistory.__table__,
+               ['portfolio_id', 'name', 'valid_from'],
+               [portfolio + (now,) for portfolio in portfolios])
+
+    compositions = data.compositions.tolist()
+    write_rows(connection, PortfolioComposition.__table__,
+               ['portfolio_id', 'security_id', 'weight'], compositions)
+    write_rows(connection, PortfolioCompositionHistory.__table__,
+               ['portfolio_id', 'security_id', 'weight', 'valid_from'],
+               [row + [now] for row in compositions])
+
+    # the ids were given explicitly, so move the sequences past them
+    if connection.dialect.name == 'postgresql':
+        preparer = connection.dialect.identifier_preparer
+        for model in models:
+            table = preparer.format_table(model.__table__)
+            connection.execute(db.text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                "(SELECT MAX(id) FROM {}))".format(table)), table=table)
+
+    portfolio_ids = data.portfolio_ids.tolist()
+    for start in range(0, len(portfolio_ids), SUMMARY_BATCH_SIZE):
+        PortfolioSummary.refresh(
+            portfolio_ids[start:start + SUMMARY_BATCH_SIZE])
+    db.session.commit()
+
+    return {
+        'regions': len(data.region_ids),
+        'asset_classes': len(data.asset_class_ids),
+        'securities': len(data.securities),
+        'portfolios': len(portfolio_ids),
+        'portfolio_compositions': len(compositions)
+    }
@@ -1,10 +1,46 @@
 import os
+import io
+import base64
+import hashlib
+import sys
+import shutil
+import subprocess
+import time
+import threading
+import tempfile
 import unittest
 import json
+from datetime import datetime
+from functools import lru_cache
+from urllib.error import URLError
+import rsa
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from jose import jwt
+from jose.utils import long_to_base64
 
+import numpy as np
+
+import auth
+import analytics
+import models
+import app as app_module
+import security_import
+import asgi
+import benchmark
+import synthetic_data
+import metrics
+import slow_query_log
 from app import create_app
+from pagination import encode_cursor
 from models import setup_db, db, Portfolio, Security, PortfolioComposition, AssetClass, Region
+from models import reference_data, portfolio_exposures
+from models import PortfolioCompositionHistory, PortfolioSnapshot
+from models import PortfolioSummary, engine_options
+from sqlalchemy.engine.url import make_url
+from starlette.testclient import TestClient
+from prometheus_client import REGISTRY
 
 
 class AssetManagementSystemTestCase(unittest.TestCase):
@@ -380,6 +416,2249 @@ class AssetManagementSystemTestCase(unittest.TestCase):
         self.assertTrue(data['asset_classes'])
 
 
+@lru_cache(maxsize=None)
+def make_signing_key(kid):
+    """Generate an RSA keypair, returning the PEM private key and public JWK"""
+    public_key, private_key = rsa.newkeys(1024)
+    public_jwk = {
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': long_to_base64(public_key.n).decode('utf-8'),
+        'e': long_to_base64(public_key.e).decode('utf-8')}
+    return private_key.save_pkcs1().decode('utf-8'), public_jwk
+
+
+def make_token(kid, permissions, expires_in=3600):
+    private_key, _ = make_signing_key(kid)
+    now = int(time.time())
+    claims = {
+        'iss': 'https://{}/'.format(auth.AUTH0_DOMAIN),
+        'aud': auth.API_AUDIENCE,
+        'sub': 'auth0|local',
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': permissions}
+    return jwt.encode(claims, private_key, algorithm='RS256',
+                      headers={'kid': kid})
+
+
+class StubJWKSOpener:
+    """Stand-in for urlopen serving a local JWKS and counting fetches"""
+
+    def __init__(self, *kids):
+        self.kids = list(kids)
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self, url, timeout=None):
+        self.calls += 1
+        if self.fail:
+            raise URLError('JWKS endpoint unreachable')
+        jwks = {'keys': [make_signing_key(kid)[1] for kid in self.kids]}
+        return io.BytesIO(json.dumps(jwks).encode('utf-8'))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LocalAuthTestCase(unittest.TestCase):
+    """Base test case verifying tokens against a local JWKS stand-in"""
+
+    def setUp(self):
+        self.opener = StubJWKSOpener('key-1')
+        self.clock = FakeClock()
+        self.store = auth.JWKSKeyStore(
+            'https://local.test/.well-known/jwks.json',
+            ttl=600,
+            min_refresh_interval=30,
+            opener=self.opener,
+            clock=self.clock)
+        self.original_store = auth.jwks_store
+        self.original_domain = auth.AUTH0_DOMAIN
+        self.original_audience = auth.API_AUDIENCE
+        auth.jwks_store = self.store
+        auth.AUTH0_DOMAIN = auth.AUTH0_DOMAIN or 'local.test'
+        auth.API_AUDIENCE = auth.API_AUDIENCE or 'Asset_Management_System'
+        auth.token_cache.clear()
+
+    def tearDown(self):
+        auth.jwks_store = self.original_store
+        auth.AUTH0_DOMAIN = self.original_domain
+        auth.API_AUDIENCE = self.original_audience
+        auth.token_cache.clear()
+
+
+class JWKSKeyStoreTestCase(LocalAuthTestCase):
+    """This class represents the JWKS key store test case"""
+
+    def test_key_set_is_fetched_once_per_ttl(self):
+        token = make_token('key-1', ['get:portfolios'])
+        auth.verify_decode_jwt(token)
+        auth.verify_decode_jwt(token)
+        self.assertEqual(self.opener.calls, 1)
+
+        self.clock.now += 600
+        payload = auth.verify_decode_jwt(token)
+        self.assertEqual(self.opener.calls, 2)
+        self.assertEqual(payload['permissions'], ['get:portfolios'])
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        auth.verify_decode_jwt(make_token('key-1', []))
+        self.opener.kids.append('key-2')
+
+        self.clock.now += 10
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(make_token('key-3', []))
+        self.assertEqual(self.opener.calls, 1)
+
+        self.clock.now += 30
+        payload = auth.verify_decode_jwt(make_token('key-2', []))
+        self.assertEqual(self.opener.calls, 2)
+        self.assertEqual(payload['sub'], 'auth0|local')
+
+    def test_stale_key_set_is_served_when_fetch_fails(self):
+        token = make_token('key-1', ['get:securities'])
+        auth.verify_decode_jwt(token)
+
+        self.opener.fail = True
+        self.clock.now += 600
+        payload = auth.verify_decode_jwt(token)
+        auth.verify_decode_jwt(token)
+        self.assertEqual(payload['permissions'], ['get:securities'])
+        self.assertEqual(self.opener.calls, 2)
+
+    def test_401_fetch_fails_without_cached_keys(self):
+        self.opener.fail = True
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(make_token('key-1', []))
+        self.assertEqual(context.exception.error['code'], 'jwks_unavailable')
+
+    def test_400_token_signed_by_other_key(self):
+        private_key, _ = make_signing_key('key-1')
+        forged = jwt.encode({'permissions': []}, private_key,
+                            algorithm='RS256', headers={'kid': 'key-2'})
+        self.opener.kids.append('key-2')
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(forged)
+        self.assertEqual(context.exception.status_code, 400)
+
+
+class VerifiedTokenCacheTestCase(LocalAuthTestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = create_app()
+        self.verifications = 0
+        verify_decode_jwt = auth.verify_decode_jwt
+
+        def counting_verify_decode_jwt(token):
+            self.verifications += 1
+            return verify_decode_jwt(token)
+
+        self.original_verify_decode_jwt = verify_decode_jwt
+        auth.verify_decode_jwt = counting_verify_decode_jwt
+
+        @auth.requires_auth('get:portfolios')
+        def protected(payload):
+            return payload
+
+        self.protected = protected
+
+    def tearDown(self):
+        auth.verify_decode_jwt = self.original_verify_decode_jwt
+        super().tearDown()
+
+    def call(self, token):
+        with self.app.test_request_context(
+                headers={'Authorization': 'Bearer ' + token}):
+            return self.protected()
+
+    def test_repeated_token_is_verified_once(self):
+        hits = sample('token_cache_hits_total')
+        misses = sample('token_cache_misses_total')
+        token = make_token('key-1', ['get:portfolios'])
+        for _ in range(3):
+            payload = self.call(token)
+
+        self.assertEqual(payload['permissions'], ['get:portfolios'])
+        self.assertEqual(self.verifications, 1)
+        self.assertEqual(auth.token_cache.stats()['hits'], 2)
+        self.assertEqual(auth.token_cache.stats()['misses'], 1)
+        self.assertEqual(sample('token_cache_hits_total') - hits, 2)
+        self.assertEqual(sample('token_cache_misses_total') - misses, 1)
+
+    def test_cache_counters_are_exported(self):
+        self.call(make_token('key-1', ['get:portfolios']))
+
+        res = self.app.test_client().get('/metrics')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'token_cache_hits_total', res.data)
+        self.assertIn(b'token_cache_misses_total', res.data)
+
+    def test_cached_token_still_checks_permissions(self):
+        token = make_token('key-1', ['get:securities'])
+        for _ in range(2):
+            with self.assertRaises(auth.AuthError) as context:
+                self.call(token)
+            self.assertEqual(context.exception.status_code, 403)
+        self.assertEqual(self.verifications, 1)
+
+    def test_entry_expires_at_exp_claim(self):
+        cache = auth.VerifiedTokenCache(maxsize=8, clock=self.clock)
+        cache.put('token', {'exp': 100, 'permissions': ['get:portfolios']})
+
+        self.clock.now = 99
+        self.assertIn('get:portfolios', cache.get('token').permissions)
+        self.clock.now = 100
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = auth.VerifiedTokenCache(maxsize=2, clock=self.clock)
+        cache.put('a', {'exp': 100})
+        cache.put('b', {'exp': 100})
+        cache.get('a')
+        cache.put('c', {'exp': 100})
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+FUND_MANAGER_PERMISSIONS = [
+    'delete:portfolios', 'delete:securities', 'get:portfolios',
+    'get:securities', 'patch:portfolios', 'patch:securities',
+    'post:portfolios', 'post:securities']
+REGION_NAMES = ['Asia Pacific', 'Europe', 'Middle East', 'Africa', 'America']
+ASSET_CLASS_NAMES = ['Equity', 'Fixed Income', 'Alternative']
+
+
+def seed_reference_data(security_count=5):
+    regions = [Region(name=name) for name in REGION_NAMES]
+    asset_classes = [AssetClass(name=name) for name in ASSET_CLASS_NAMES]
+    db.session.add_all(regions + asset_classes)
+    db.session.flush()
+    # SECURITY_<n> gets id n
+    securities = [
+        Security(name='SECURITY_{}'.format(i + 1),
+                 region_id=regions[i % len(regions)].id,
+                 asset_class_id=asset_classes[i % len(asset_classes)].id)
+        for i in range(security_count)]
+    db.session.add_all(securities)
+    db.session.commit()
+    return securities
+
+
+def add_portfolios(securities, count, holding_count):
+    """Add portfolios holding `holding_count` securities each, summing to 100"""
+    offset = Portfolio.query.count()
+    for p in range(count):
+        portfolio = Portfolio(name='PORTFOLIO_{}'.format(offset + p + 1))
+        for h in range(holding_count):
+            weight = 100 // holding_count
+            if h == 0:
+                weight += 100 % holding_count
+            composition = PortfolioComposition(
+                security=securities[(p + h) % len(securities)],
+                weight=weight)
+            composition.portfolio = portfolio
+        db.session.add(portfolio)
+    db.session.commit()
+
+
+def enable_foreign_keys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys when asked to, unlike Postgres"""
+    dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
+class LocalDatabaseTestCase(LocalAuthTestCase):
+    """Base test case running the app against a local SQLite database"""
+
+    def setUp(self):
+        super().setUp()
+        self.db_fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, 'sqlite:///' + self.db_file)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        event.listen(db.get_engine(self.app), 'connect', enable_foreign_keys)
+        db.create_all()
+        reference_data.invalidate()
+        analytics.similarity_index.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        self.app_context.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_file)
+        super().tearDown()
+
+    def headers(self, permissions=FUND_MANAGER_PERMISSIONS):
+        return {'Authorization': 'Bearer ' + make_token('key-1', permissions)}
+
+    def capture_statements(self, method, url, extra_headers={}, **kwargs):
+        headers = dict(self.headers(), **extra_headers)
+        statements = []
+        # measure the steady state, with region and asset class names cached
+        reference_data.regions
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = getattr(self.client(), method)(
+                url, headers=headers, buffered=True, **kwargs)
+        finally:
+            event.remove(
+                engine, 'before_cursor_execute', before_cursor_execute)
+        return res, statements
+
+    def count_statements(self, method, url, **kwargs):
+        res, statements = self.capture_statements(method, url, **kwargs)
+        return res, len(statements)
+
+
+class PortfolioQueryCountTestCase(LocalDatabaseTestCase):
+    """Portfolio reads must not issue a query per portfolio or composition"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=30)
+
+    def test_retrieve_portfolios_statement_count_is_flat(self):
+        add_portfolios(self.securities, count=2, holding_count=2)
+        res, small = self.count_statements('get', '/portfolios')
+        self.assertEqual(res.status_code, 200)
+
+        add_portfolios(self.securities, count=20, holding_count=15)
+        res, large = self.count_statements('get', '/portfolios')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['portfolios']), 22)
+        self.assertEqual(
+            len(data['portfolios'][-1]['portfolio_compositions']), 15)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 2)
+
+    def test_retrieve_portfolio_statement_count_is_flat(self):
+        add_portfolios(self.securities, count=1, holding_count=2)
+        add_portfolios(self.securities, count=1, holding_count=25)
+        res, small = self.count_statements('get', '/portfolios/1')
+        self.assertEqual(res.status_code, 200)
+
+        res, large = self.count_statements('get', '/portfolios/2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['portfolio_compositions']), 25)
+        self.assertTrue(data['portfolio_compositions'][0]['region'])
+        self.assertEqual(small, large)
+
+
+class PaginationTestCase(LocalDatabaseTestCase):
+    """This class represents the keyset pagination test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=5)
+
+    def test_walk_securities_pages(self):
+        security_ids = []
+        url = '/securities?limit=2'
+        pages = 0
+        while url:
+            res = self.client().get(url, headers=self.headers())
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            security_ids += [s['security_id'] for s in data['securities']]
+            pages += 1
+            url = data['next_cursor'] and \
+                '/securities?limit=2&cursor=' + data['next_cursor']
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(security_ids, [1, 2, 3, 4, 5])
+
+    def test_retrieve_portfolios_next_page(self):
+        add_portfolios(self.securities, count=3, holding_count=2)
+        res = self.client().get(
+            '/portfolios?limit=2&cursor=' + encode_cursor(1),
+            headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [p['portfolio_id'] for p in data['portfolios']], [2, 3])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_empty_later_page_is_not_404(self):
+        res = self.client().get(
+            '/securities?cursor=' + encode_cursor(5), headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['securities'], [])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_404_empty_first_page(self):
+        res = self.client().get('/portfolios', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_422_malformed_cursor(self):
+        res = self.client().get(
+            '/securities?cursor=not-a-cursor', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['message'], "Unprocessable entity")
+
+    def test_422_malformed_limit(self):
+        for limit in ('x', '2.5', '0'):
+            res = self.client().get(
+                '/securities?limit=' + limit, headers=self.headers())
+            self.assertEqual(res.status_code, 422, limit)
+
+
+class NDJSONStreamingTestCase(LocalDatabaseTestCase):
+    """This class represents the NDJSON streaming test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=5)
+        self.original_batch_size = app_module.STREAM_BATCH_SIZE
+        app_module.STREAM_BATCH_SIZE = 2
+
+    def tearDown(self):
+        app_module.STREAM_BATCH_SIZE = self.original_batch_size
+        super().tearDown()
+
+    def get_ndjson(self, url):
+        headers = self.headers()
+        headers['Accept'] = 'application/x-ndjson'
+        return self.client().get(url, headers=headers)
+
+    def test_stream_securities(self):
+        res = self.get_ndjson('/securities')
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([row['security_id'] for row in rows], [1, 2, 3, 4, 5])
+        self.assertTrue(rows[0]['region'])
+
+    def test_stream_portfolios(self):
+        add_portfolios(self.securities, count=5, holding_count=3)
+        headers = {'Accept': 'application/x-ndjson'}
+        res, statements = self.count_statements(
+            'get', '/portfolios', extra_headers=headers)
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        # one portfolio query plus one composition query per batch of two
+        self.assertEqual(statements, 4)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(
+            [len(row['portfolio_compositions']) for row in rows], [3] * 5)
+
+    def test_json_is_still_the_default(self):
+        res = self.client().get('/securities', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(len(data['securities']), 5)
+
+
+class CreatePortfolioTransactionTestCase(LocalDatabaseTestCase):
+    """Portfolio creation runs in one transaction with a bulk insert"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=50)
+
+    def compositions(self, count):
+        """`count` holdings of 2 %, the first one topped up to 100 %"""
+        weights = [2] * count
+        weights[0] += 100 - 2 * count
+        return [{'security_id': i + 1, 'weight': weight}
+                for i, weight in enumerate(weights)]
+
+    def test_create_portfolio_statement_count_is_flat(self):
+        res, small = self.count_statements('post', '/portfolios', json={
+            'portfolio_name': 'SMALL', 'portfolio_compositions': self.compositions(2)})
+        self.assertEqual(res.status_code, 200)
+
+        res, large = self.count_statements('post', '/portfolios', json={
+            'portfolio_name': 'LARGE', 'portfolio_compositions': self.compositions(40)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['portfolio_name'], 'LARGE')
+        self.assertEqual(
+            PortfolioComposition.query.filter_by(
+                portfolio_id=data['portfolio_id']).count(), 40)
+        self.assertEqual(small, large)
+
+    def test_422_failed_create_leaves_no_partial_portfolio(self):
+        compositions = [{'security_id': 1, 'weight': 50},
+                        {'security_id': 999, 'weight': 50}]
+        res = self.client().post('/portfolios', json={
+            'portfolio_name': 'UNKNOWN_SECURITY',
+            'portfolio_compositions': compositions}, headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Portfolio.query.count(), 0)
+        self.assertEqual(PortfolioComposition.query.count(), 0)
+
+    def test_create_portfolios_batch(self):
+        res = self.client().post('/portfolios/batch', json={'portfolios': [
+            {'portfolio_name': 'BATCH_{}'.format(i),
+             'portfolio_compositions': self.compositions(i + 2)}
+            for i in range(3)]}, headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([p['portfolio_name'] for p in data['portfolios']],
+                         ['BATCH_0', 'BATCH_1', 'BATCH_2'])
+        self.assertEqual(PortfolioComposition.query.count(), 2 + 3 + 4)
+
+    def test_422_batch_is_all_or_nothing(self):
+        res = self.client().post('/portfolios/batch', json={'portfolios': [
+            {'portfolio_name': 'SAME', 'portfolio_compositions': self.compositions(2)},
+            {'portfolio_name': 'SAME', 'portfolio_compositions': self.compositions(3)}]},
+            headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(Portfolio.query.count(), 0)
+
+    def test_422_batch_with_invalid_weights(self):
+        res = self.client().post('/portfolios/batch', json={'portfolios': [
+            {'portfolio_name': 'OK', 'portfolio_compositions': self.compositions(2)},
+            {'portfolio_name': 'BAD', 'portfolio_compositions': [
+                {'security_id': 1, 'weight': 100}, {'security_id': 2, 'weight': 100}]}]},
+            headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Portfolio.query.count(), 0)
+
+    def test_analyst_401_create_portfolios_batch(self):
+        res = self.client().post('/portfolios/batch', json={'portfolios': [
+            {'portfolio_name': 'OK', 'portfolio_compositions': self.compositions(2)}]},
+            headers=self.headers(['get:portfolios', 'post:securities']))
+
+        self.assertEqual(res.status_code, 401)
+
+
+class UpdatePortfolioDiffTestCase(LocalDatabaseTestCase):
+    """PATCH /portfolios/<id> only writes the compositions that changed"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=5)
+        add_portfolios(self.securities, count=1, holding_count=3)
+        # PORTFOLIO_1 holds securities 1, 2 and 3 at 34 %, 33 % and 33 %
+
+    def holdings(self):
+        return {composition.security_id: composition.weight
+                for composition in PortfolioComposition.query.filter_by(
+                    portfolio_id=1)}
+
+    def test_update_portfolio_reports_diff(self):
+        res = self.client().patch('/portfolios/1', json={
+            'portfolio_compositions': [
+                {'security_id': 1, 'weight': 34},
+                {'security_id': 2, 'weight': 30},
+                {'security_id': 4, 'weight': 36}]}, headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(data['added'], 1)
+        self.assertEqual(data['changed'], 1)
+        self.assertEqual(data['removed'], 1)
+        self.assertEqual(self.holdings(), {1: 34, 2: 30, 4: 36})
+
+    def test_unchanged_compositions_are_not_written(self):
+        res, statements = self.capture_statements('patch', '/portfolios/1', json={
+            'portfolio_name': 'RENAMED',
+            'portfolio_compositions': [
+                {'security_id': 1, 'weight': 34},
+                {'security_id': 2, 'weight': 33},
+                {'security_id': 3, 'weight': 33}]})
+        data = json.loads(res.data)
+        writes = [statement for statement in statements
+                  if not statement.lstrip().upper().startswith('SELECT')]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            (data['added'], data['changed'], data['removed']), (0, 0, 0))
+        # the portfolio row and its name history, no composition rows
+        self.assertEqual(len(writes), 3)
+        self.assertFalse([statement for statement in writes
+                          if 'portfolio_composition' in statement])
+        self.assertEqual(Portfolio.query.get(1).name, 'RENAMED')
+
+    def test_422_failed_update_keeps_compositions(self):
+        res = self.client().patch('/portfolios/1', json={
+            'portfolio_compositions': [
+                {'security_id': 1, 'weight': 50},
+                {'security_id': 999, 'weight': 50}]}, headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.holdings(), {1: 34, 2: 33, 3: 33})
+
+    def test_422_duplicate_security(self):
+        res = self.client().patch('/portfolios/1', json={
+            'portfolio_compositions': [
+                {'security_id': 1, 'weight': 50},
+                {'security_id': 1, 'weight': 50}]}, headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_422_boolean_security_id_or_weight(self):
+        for compositions in (
+                [{'security_id': True, 'weight': 50},
+                 {'security_id': 2, 'weight': 50}],
+                [{'security_id': 1, 'weight': 99},
+                 {'security_id': 2, 'weight': True}]):
+            res = self.client().patch(
+                '/portfolios/1', json={'portfolio_compositions': compositions},
+                headers=self.headers())
+            self.assertEqual(res.status_code, 422)
+
+        self.assertEqual(self.holdings(), {1: 34, 2: 33, 3: 33})
+
+
+class SecurityImportTestCase(LocalDatabaseTestCase):
+    """This class represents the bulk security import test case"""
+
+    def setUp(self):
+        super().setUp()
+        seed_reference_data(security_count=2)
+        self.original_batch_size = security_import.IMPORT_BATCH_SIZE
+        security_import.IMPORT_BATCH_SIZE = 2
+
+    def tearDown(self):
+        security_import.IMPORT_BATCH_SIZE = self.original_batch_size
+        super().tearDown()
+
+    def test_import_csv_upload(self):
+        csv_file = (
+            'security_name,region_id,asset_class_id\n'
+            'CSV_1,1,1\n'
+            'CSV_2,2,2\n'
+            'CSV_3,5,3\n')
+        res = self.client().post(
+            '/securities/import',
+            data={'file': (io.BytesIO(csv_file.encode()), 'securities.csv')},
+            content_type='multipart/form-data',
+            headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 3)
+        self.assertEqual(data['errors'], [])
+        self.assertEqual(Security.query.filter_by(name='CSV_3').one().region_id, 5)
+
+    def test_read_rows_from_stream_without_readable(self):
+        class UploadStream:
+            """Like SpooledTemporaryFile before Python 3.11"""
+
+            def __init__(self, content):
+                self.file = io.BytesIO(content)
+
+            def __iter__(self):
+                return iter(self.file)
+
+            def read(self, *args):
+                return self.file.read(*args)
+
+        stream = UploadStream(
+            'security_name,region_id,asset_class_id\n'
+            '"CAF\u00c9\nSA",1,1\r\nCSV_2,2,2\n'.encode('utf-8'))
+
+        self.assertEqual(
+            [row for _, row in security_import.read_rows(stream, 'csv')], [
+                {'security_name': 'CAF\u00c9\nSA', 'region_id': '1',
+                 'asset_class_id': '1'},
+                {'security_name': 'CSV_2', 'region_id': '2',
+                 'asset_class_id': '2'}])
+
+    def test_import_ndjson_reports_row_errors(self):
+        lines = [
+            {'security_name': 'NDJSON_1', 'region_id': 1, 'asset_class_id': 1},
+            {'security_name': 'NDJSON_2', 'region_id': 100, 'asset_class_id': 1},
+            {'security_name': 'SECURITY_1', 'region_id': 1, 'asset_class_id': 1},
+            {'security_name': 'NDJSON_1', 'region_id': 1, 'asset_class_id': 2},
+            {'region_id': 1, 'asset_class_id': 1},
+            {'security_name': 'NDJSON_3', 'region_id': 2, 'asset_class_id': 3}]
+        body = '\n'.join(json.dumps(line) for line in lines) + '\n{oops\n'
+        res = self.client().post(
+            '/securities/import', data=body,
+            content_type='application/x-ndjson', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(
+            [error['line'] for error in data['errors']], [2, 3, 4, 5, 7])
+        self.assertEqual(Security.query.count(), 4)
+
+    def test_lookups_are_loaded_once(self):
+        body = '\n'.join(json.dumps({
+            'security_name': 'BULK_{}'.format(i),
+            'region_id': 1 + i % 5,
+            'asset_class_id': 1 + i % 3}) for i in range(20))
+        security_import.IMPORT_BATCH_SIZE = 1000
+        res, statements = self.count_statements(
+            'post', '/securities/import', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['imported'], 20)
+        self.assertLess(statements, 10)
+
+    def test_422_unknown_format(self):
+        res = self.client().post(
+            '/securities/import', data='<securities/>',
+            content_type='application/xml', headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_assistant_401_import_securities(self):
+        res = self.client().post(
+            '/securities/import', data='', content_type='text/csv',
+            headers=self.headers(['get:portfolios', 'get:securities']))
+
+        self.assertEqual(res.status_code, 401)
+
+
+class ReferenceDataCacheTestCase(LocalDatabaseTestCase):
+    """Region and asset class names are served from an in-process cache"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=5)
+
+    def test_securities_format_without_reference_queries(self):
+        res, statements = self.capture_statements('get', '/securities')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['securities'][0]['region'], 'Asia Pacific')
+        self.assertEqual(data['securities'][1]['asset_class'], 'Fixed Income')
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('JOIN', statements[0])
+
+    def test_create_security_validates_from_cache(self):
+        res, statements = self.capture_statements('post', '/securities', json={
+            'security_name': 'CACHED', 'region_id': '2', 'asset_class_id': 3})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['region'], 'Europe')
+        self.assertEqual(data['asset_class'], 'Alternative')
+        self.assertFalse([statement for statement in statements
+                          if 'FROM region' in statement])
+
+    def test_commit_invalidates_cache(self):
+        version = reference_data.version
+        self.assertEqual(reference_data.region_name(1), 'Asia Pacific')
+
+        Region.query.get(1).name = 'APAC'
+        db.session.commit()
+
+        self.assertGreater(reference_data.version, version)
+        self.assertEqual(reference_data.region_name(1), 'APAC')
+
+    def test_rollback_keeps_cache(self):
+        reference_data.regions
+        version = reference_data.version
+
+        Region.query.get(1).name = 'APAC'
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(reference_data.version, version)
+        self.assertEqual(reference_data.region_name(1), 'Asia Pacific')
+
+    def test_unknown_id_reloads_once(self):
+        reference_data.regions
+        db.session.execute(Region.__table__.insert(), {'name': 'Antarctica'})
+        db.session.commit()
+
+        self.assertEqual(reference_data.region_name(6), 'Antarctica')
+        self.assertFalse(reference_data.has_region(100))
+
+    def test_unknown_ids_reload_at_most_once_per_interval(self):
+        reference_data.regions
+        version = reference_data.version
+
+        res, statements = self.capture_statements('post', '/securities', json={
+            'security_name': 'BAD', 'region_id': 100, 'asset_class_id': 1})
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(len([statement for statement in statements
+                              if 'FROM region' in statement]), 1)
+
+        res, statements = self.capture_statements('post', '/securities', json={
+            'security_name': 'BAD', 'region_id': 101, 'asset_class_id': 1})
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse([statement for statement in statements
+                          if 'FROM region' in statement])
+        self.assertEqual(reference_data.version, version)
+
+    def test_missing_or_malformed_id_does_not_reload(self):
+        reference_data.regions
+
+        res, statements = self.capture_statements('post', '/securities', json={
+            'security_name': 'BAD', 'region_id': 'x', 'asset_class_id': None})
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse([statement for statement in statements
+                          if 'FROM region' in statement])
+
+    def test_422_non_integer_reference_ids(self):
+        for region_id, asset_class_id in ((1.0, 1), (1.5, 1), (True, 1),
+                                          (1, False), ([1], 1)):
+            res = self.client().post(
+                '/securities', headers=self.headers(), json={
+                    'security_name': 'BAD', 'region_id': region_id,
+                    'asset_class_id': asset_class_id})
+            self.assertEqual(res.status_code, 422)
+
+        self.assertEqual(reference_data.region_name('1'), 'Asia Pacific')
+        self.assertEqual(Security.query.filter_by(name='BAD').count(), 0)
+
+
+class ConditionalGetTestCase(LocalDatabaseTestCase):
+    """This class represents the ETag / If-None-Match test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=5)
+        add_portfolios(self.securities, count=2, holding_count=3)
+
+    def etag(self, url):
+        res = self.client().get(url, headers=self.headers())
+        self.assertEqual(res.status_code, 200)
+        return res.headers['ETag']
+
+    def test_304_portfolio_from_version_lookup(self):
+        etag = self.etag('/portfolios/1')
+        res, statements = self.capture_statements(
+            'get', '/portfolios/1', extra_headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('portfolio_composition', statements[0])
+
+    def test_update_portfolio_changes_etag(self):
+        etag = self.etag('/portfolios/1')
+        self.client().patch('/portfolios/1', json={
+            'portfolio_compositions': [
+                {'security_id': 1, 'weight': 50},
+                {'security_id': 2, 'weight': 50}]}, headers=self.headers())
+        res = self.client().get('/portfolios/1', headers=dict(
+            self.headers(), **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_noop_update_keeps_etag(self):
+        etag = self.etag('/portfolios/1')
+        self.client().patch('/portfolios/1', json={
+            'portfolio_name': 'PORTFOLIO_1'}, headers=self.headers())
+
+        self.assertEqual(self.etag('/portfolios/1'), etag)
+
+    def test_update_security_changes_holder_etags(self):
+        etags = [self.etag('/portfolios/1'), self.etag('/portfolios/2')]
+        # security 1 is held by PORTFOLIO_1 only
+        self.client().patch('/securities/1', json={
+            'security_name': 'RENAMED', 'region_id': 1, 'asset_class_id': 1},
+            headers=self.headers())
+
+        self.assertNotEqual(self.etag('/portfolios/1'), etags[0])
+        self.assertEqual(self.etag('/portfolios/2'), etags[1])
+
+    def test_304_regions_and_asset_classes_without_queries(self):
+        for url in ('/regions', '/asset_classes'):
+            etag = self.etag(url)
+            res, statements = self.capture_statements(
+                'get', url, extra_headers={'If-None-Match': etag})
+
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(statements, [])
+
+    def test_new_region_changes_regions_etag(self):
+        etag = self.etag('/regions')
+        db.session.add(Region(name='Antarctica'))
+        db.session.commit()
+        res = self.client().get('/regions', headers={'If-None-Match': etag})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['regions'][-1]['region'], 'Antarctica')
+
+
+class ExposureTestCase(LocalDatabaseTestCase):
+    """This class represents the SQL-side exposure aggregation test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=6)
+        # PORTFOLIO_1 holds securities 1-4, PORTFOLIO_2 securities 2-5
+        add_portfolios(self.securities, count=2, holding_count=4)
+
+    def test_retrieve_portfolio_exposure(self):
+        res, statements = self.capture_statements(
+            'get', '/portfolios/1/exposure')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['by_region'], {
+            'Asia Pacific': 25, 'Europe': 25, 'Middle East': 25,
+            'Africa': 25})
+        self.assertEqual(data['by_asset_class'], {
+            'Equity': 50, 'Fixed Income': 25, 'Alternative': 25})
+        self.assertEqual(len(statements), 1)
+        self.assertIn('GROUP BY', statements[0])
+
+    def test_retrieve_portfolios_exposure(self):
+        res, statements = self.capture_statements(
+            'get', '/portfolios/exposure?ids=2,1,100')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [exposure['portfolio_id'] for exposure in data['exposures']], [1, 2])
+        self.assertEqual(data['exposures'][1]['by_region'], {
+            'Europe': 25, 'Middle East': 25, 'Africa': 25, 'America': 25})
+        self.assertEqual(len(statements), 1)
+
+    def test_404_retrieve_portfolio_exposure(self):
+        res = self.client().get(
+            '/portfolios/100/exposure', headers=self.headers())
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_422_retrieve_portfolios_exposure(self):
+        res = self.client().get(
+            '/portfolios/exposure?ids=1,two', headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+
+
+def one_hot(codes, size):
+    encoding = np.zeros((len(codes), size))
+    encoding[np.arange(len(codes)), codes] = 1
+    return encoding
+
+
+class ExposureMatrixTestCase(LocalDatabaseTestCase):
+    """This class represents the vectorized exposure matrix test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=8)
+        add_portfolios(self.securities, count=5, holding_count=3)
+        add_portfolios(self.securities, count=2, holding_count=7)
+
+    def test_dense_matrix_matches_compositions(self):
+        matrix = analytics.load_exposure_matrix()
+        dense = matrix.dense()
+
+        self.assertEqual(dense.shape, (7, 8))
+        self.assertTrue(np.allclose(dense.sum(axis=1), 100))
+        for composition in PortfolioComposition.query:
+            row = matrix.portfolio_ids.tolist().index(composition.portfolio_id)
+            column = matrix.security_ids.tolist().index(composition.security_id)
+            self.assertEqual(dense[row, column], composition.weight)
+
+    def test_rollups_match_sql_aggregation(self):
+        matrix = analytics.load_exposure_matrix()
+        report = analytics.exposure_report(matrix)
+        exposures = portfolio_exposures(report['portfolio_ids'])
+
+        for row, portfolio_id in enumerate(report['portfolio_ids']):
+            by_region = {
+                region: weight for region, weight in
+                zip(report['regions'], report['by_region'][row]) if weight}
+            self.assertEqual(by_region, exposures[portfolio_id]['by_region'])
+        self.assertTrue(np.allclose(
+            matrix.by_region(),
+            matrix.dense() @ one_hot(
+                matrix.region_codes, len(matrix.region_ids))))
+        self.assertAlmostEqual(sum(report['firm_by_asset_class'].values()), 100)
+
+    def test_region_added_by_another_process(self):
+        reference_data.regions
+        # written around the session, so the cache isn't invalidated
+        db.session.execute(Region.__table__.insert(), {'name': 'Antarctica'})
+        db.session.execute(
+            Security.__table__.update().where(Security.id == 1).values(
+                region_id=6))
+        db.session.commit()
+
+        matrix = analytics.load_exposure_matrix()
+        report = analytics.exposure_report(matrix)
+
+        self.assertEqual(report['regions'], REGION_NAMES + ['Antarctica'])
+        self.assertTrue(np.allclose(
+            matrix.by_region(),
+            matrix.dense() @ one_hot(
+                matrix.region_codes, len(matrix.region_ids))))
+        self.assertGreater(report['firm_by_region']['Antarctica'], 0)
+
+    def test_retrieve_exposure_matrix(self):
+        res = self.client().get('/analytics/exposure', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['portfolio_ids'], [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(data['regions'], REGION_NAMES)
+        self.assertEqual(len(data['by_asset_class'][0]), 3)
+
+
+class SecurityHoldersTestCase(LocalDatabaseTestCase):
+    """This class represents the security reverse index test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=6)
+        # security 3 is held by PORTFOLIO_1, PORTFOLIO_2 and PORTFOLIO_3
+        add_portfolios(self.securities, count=3, holding_count=3)
+
+    def test_retrieve_security_holders(self):
+        res, statements = self.capture_statements(
+            'get', '/securities/3/portfolios')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['portfolios'], [
+            {'portfolio_id': 1, 'portfolio_name': 'PORTFOLIO_1', 'weight': 33},
+            {'portfolio_id': 2, 'portfolio_name': 'PORTFOLIO_2', 'weight': 33},
+            {'portfolio_id': 3, 'portfolio_name': 'PORTFOLIO_3', 'weight': 34}])
+        self.assertEqual(len(statements), 1)
+
+    def test_holders_lookup_uses_security_index(self):
+        query = PortfolioComposition.query.filter(
+            PortfolioComposition.security_id == 3)
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN ' + str(query.statement.compile(
+                compile_kwargs={'literal_binds': True}))).fetchall()
+
+        self.assertIn('ix_portfolio_composition_security_id', str(plan))
+
+    def test_retrieve_unheld_security_holders(self):
+        res = self.client().get(
+            '/securities/6/portfolios', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['portfolios'], [])
+
+    def test_404_retrieve_security_holders(self):
+        res = self.client().get(
+            '/securities/100/portfolios', headers=self.headers())
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_422_delete_held_security_with_exists(self):
+        res, statements = self.capture_statements('delete', '/securities/3')
+
+        self.assertEqual(res.status_code, 422)
+        self.assertTrue(any('EXISTS' in statement for statement in statements))
+        self.assertFalse(any('count(' in statement for statement in statements))
+
+    def test_delete_unheld_security(self):
+        res = self.client().delete('/securities/6', headers=self.headers())
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(Security.query.get(6))
+
+
+class SimilarityTestCase(LocalDatabaseTestCase):
+    """This class represents the portfolio similarity test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=8)
+        add_portfolios(self.securities, count=6, holding_count=3)
+        add_portfolios(self.securities, count=2, holding_count=5)
+
+    def brute_force(self, composition):
+        scores = {}
+        for portfolio in Portfolio.query:
+            weights = {c.security_id: c.weight
+                       for c in portfolio.portfolio_compositions}
+            dot = sum(weight * composition.get(security_id, 0)
+                      for security_id, weight in weights.items())
+            scores[portfolio.id] = (
+                sum(min(weight, composition.get(security_id, 0))
+                    for security_id, weight in weights.items()),
+                dot / (np.linalg.norm(list(weights.values())) *
+                       np.linalg.norm(list(composition.values()))))
+        return scores
+
+    def test_top_k_matches_brute_force(self):
+        composition = {1: 50, 2: 30, 5: 20}
+        similar = analytics.similarity_index.top_k(composition, k=3)
+        scores = self.brute_force(composition)
+
+        for ranking, score in (('by_overlap', 0), ('by_cosine', 1)):
+            expected = sorted(scores, key=lambda p: (-scores[p][score], p))[:3]
+            self.assertEqual(
+                [entry['portfolio_id'] for entry in similar[ranking]],
+                expected)
+            for entry in similar[ranking]:
+                self.assertAlmostEqual(
+                    entry['overlap'], scores[entry['portfolio_id']][0])
+                self.assertAlmostEqual(
+                    entry['cosine'], scores[entry['portfolio_id']][1])
+
+    def test_writes_reload_only_touched_portfolios(self):
+        analytics.similarity_index.top_k({1: 100}, k=3)
+        reloaded = analytics.similarity_index.reloaded
+
+        res = self.client().patch('/portfolios/2', headers=self.headers(),
+                                  json={'portfolio_compositions': [
+                                      {'security_id': 8, 'weight': 100}]})
+        self.assertEqual(res.status_code, 200)
+        self.client().delete('/portfolios/3', headers=self.headers())
+        similar = analytics.similarity_index.top_k({8: 100}, k=10)
+
+        self.assertEqual(analytics.similarity_index.reloaded, reloaded + 1)
+        self.assertEqual(similar['by_overlap'][0],
+                         {'portfolio_id': 2, 'portfolio_name': 'PORTFOLIO_2',
+                          'overlap': 100.0, 'cosine': 1.0})
+        self.assertNotIn(3, [entry['portfolio_id']
+                             for entry in similar['by_cosine']])
+
+    def test_retrieve_similar_portfolios(self):
+        res = self.client().get(
+            '/portfolios/1/similar?k=2', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['by_overlap']), 2)
+        self.assertNotIn(1, [entry['portfolio_id']
+                             for entry in data['by_overlap']])
+        # PORTFOLIO_2 shares the larger weights, while PORTFOLIO_7 holds
+        # every security of PORTFOLIO_1 with a flatter weight vector
+        self.assertEqual(data['by_overlap'][0]['portfolio_id'], 2)
+        self.assertEqual(data['by_cosine'][0]['portfolio_id'], 7)
+
+    def test_retrieve_similar_portfolios_refreshes_once(self):
+        analytics.similarity_index.refresh()
+
+        res, statements = self.capture_statements(
+            'get', '/portfolios/1/similar?k=2')
+
+        self.assertEqual(res.status_code, 200)
+        # the version scan, with nothing stale to reload
+        self.assertEqual(len(statements), 1)
+        self.assertIn('portfolio.version', statements[0])
+
+    def test_reused_portfolio_id_is_reloaded(self):
+        def create(security_id):
+            res = self.client().post(
+                '/portfolios', headers=self.headers(), json={
+                    'portfolio_name': 'REUSED',
+                    'portfolio_compositions': [
+                        {'security_id': security_id, 'weight': 100}]})
+            self.assertEqual(res.status_code, 200)
+            return Portfolio.query.filter_by(name='REUSED').one().id
+
+        portfolio_id = create(1)
+        self.assertEqual(
+            analytics.similarity_index.vector(portfolio_id), {1: 100.0})
+        res = self.client().delete(
+            '/portfolios/{}'.format(portfolio_id), headers=self.headers())
+        self.assertEqual(res.status_code, 200)
+
+        # SQLite hands the highest id out again, at version 1 again
+        self.assertEqual(create(8), portfolio_id)
+        self.assertEqual(
+            analytics.similarity_index.vector(portfolio_id), {8: 100.0})
+
+    def test_search_similar_portfolios(self):
+        res = self.client().post(
+            '/portfolios/similar', headers=self.headers(), json={
+                'k': 1, 'portfolio_compositions': [
+                    {'security_id': 4, 'weight': 34},
+                    {'security_id': 5, 'weight': 33},
+                    {'security_id': 6, 'weight': 33}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['by_cosine'][0]['portfolio_id'], 4)
+        self.assertAlmostEqual(data['by_cosine'][0]['cosine'], 1.0)
+
+    def test_404_retrieve_similar_portfolios(self):
+        res = self.client().get(
+            '/portfolios/100/similar', headers=self.headers())
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_422_search_similar_portfolios(self):
+        res = self.client().post(
+            '/portfolios/similar', headers=self.headers(), json={
+                'k': 0, 'portfolio_compositions': [
+                    {'security_id': 1, 'weight': 100}]})
+
+        self.assertEqual(res.status_code, 422)
+
+
+class RebalanceTestCase(LocalDatabaseTestCase):
+    """This class represents the batch rebalance test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=6)
+        add_portfolios(self.securities, count=4, holding_count=2)
+        self.target = [{'security_id': 1, 'weight': 60},
+                       {'security_id': 3, 'weight': 40}]
+
+    def weights(self, portfolio_id):
+        return {c.security_id: c.weight for c in PortfolioComposition.query
+                .filter_by(portfolio_id=portfolio_id)}
+
+    def test_rebalance_trades(self):
+        trades = analytics.rebalance_trades(
+            [1, 2, 3], {1: 60, 3: 40})
+
+        # PORTFOLIO_1 holds 50/50 securities 1 and 2
+        self.assertEqual(trades[1], [
+            {'security_id': 1, 'current_weight': 50,
+             'target_weight': 60, 'trade': 10},
+            {'security_id': 2, 'current_weight': 50,
+             'target_weight': 0, 'trade': -50},
+            {'security_id': 3, 'current_weight': 0,
+             'target_weight': 40, 'trade': 40}])
+        for portfolio_id, portfolio_trades in trades.items():
+            current = self.weights(portfolio_id)
+            for trade in portfolio_trades:
+                current[trade['security_id']] = \
+                    current.get(trade['security_id'], 0) + trade['trade']
+            self.assertEqual(
+                {security_id: weight for security_id, weight
+                 in current.items() if weight}, {1: 60, 3: 40})
+
+    def test_preview_rebalance(self):
+        res, statements = self.capture_statements(
+            'post', '/portfolios/rebalance', json={
+                'portfolio_ids': [1, 2, 3, 4],
+                'target_compositions': self.target})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['applied'], False)
+        self.assertEqual([p['portfolio_id'] for p in data['portfolios']],
+                         [1, 2, 3, 4])
+        self.assertEqual(self.weights(2), {2: 50, 3: 50})
+        # validation, the portfolio ids and the weights
+        self.assertEqual(len(statements), 3)
+
+    def test_apply_rebalance_to_model_portfolio(self):
+        res = self.client().post(
+            '/portfolios/rebalance', headers=self.headers(), json={
+                'portfolio_ids': [2, 3], 'model_portfolio_id': 1,
+                'apply': True})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['applied'], True)
+        self.assertEqual(self.weights(2), {1: 50, 2: 50})
+        self.assertEqual(self.weights(3), {1: 50, 2: 50})
+        self.assertEqual(Portfolio.query.get(2).version, 2)
+        self.assertEqual(Portfolio.query.get(4).version, 1)
+
+    def test_401_apply_rebalance_without_patch_permission(self):
+        res = self.client().post(
+            '/portfolios/rebalance',
+            headers=self.headers(['get:portfolios']), json={
+                'portfolio_ids': [2], 'target_compositions': self.target,
+                'apply': True})
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(self.weights(2), {2: 50, 3: 50})
+
+    def test_404_rebalance_unknown_portfolio(self):
+        res = self.client().post(
+            '/portfolios/rebalance', headers=self.headers(), json={
+                'portfolio_ids': [1, 100], 'target_compositions': self.target,
+                'apply': True})
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(self.weights(1), {1: 50, 2: 50})
+
+    def test_422_rebalance_to_malformed_model_portfolio(self):
+        res = self.client().post(
+            '/portfolios/rebalance', headers=self.headers(), json={
+                'portfolio_ids': [1], 'model_portfolio_id': '2'})
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_422_rebalance_to_invalid_target(self):
+        res = self.client().post(
+            '/portfolios/rebalance', headers=self.headers(), json={
+                'portfolio_ids': [1], 'target_compositions': [
+                    {'security_id': 100, 'weight': 100}]})
+
+        self.assertEqual(res.status_code, 422)
+
+
+class CompositionHistoryTestCase(LocalDatabaseTestCase):
+    """This class represents the composition history test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.original_interval = models.COMPOSITION_SNAPSHOT_INTERVAL
+        models.COMPOSITION_SNAPSHOT_INTERVAL = 4
+        self.securities = seed_reference_data(security_count=6)
+        self.before = datetime.utcnow()
+        res = self.client().post(
+            '/portfolios/batch', headers=self.headers(), json={'portfolios': [{
+                'portfolio_name': 'PORTFOLIO_{}'.format(p),
+                'portfolio_compositions': [
+                    {'security_id': p, 'weight': 50},
+                    {'security_id': p + 1, 'weight': 50}]} for p in (1, 2)]})
+        self.assertEqual(res.status_code, 200)
+
+    def tearDown(self):
+        models.COMPOSITION_SNAPSHOT_INTERVAL = self.original_interval
+        super().tearDown()
+
+    def patch_portfolio(self, portfolio_id, weights):
+        res = self.client().patch(
+            '/portfolios/{}'.format(portfolio_id), headers=self.headers(),
+            json={'portfolio_compositions': [
+                {'security_id': security_id, 'weight': weight}
+                for security_id, weight in weights.items()]})
+        self.assertEqual(res.status_code, 200)
+        return datetime.utcnow()
+
+    def read_as_of(self, portfolio_id, as_of):
+        return self.client().get(
+            '/portfolios/{}?as_of={}'.format(portfolio_id, as_of.isoformat()),
+            headers=self.headers())
+
+    def holdings(self, portfolio_id, as_of):
+        res = self.read_as_of(portfolio_id, as_of)
+        self.assertEqual(res.status_code, 200)
+        return {(c['security_name'], c['weight'])
+                for c in json.loads(res.data)['portfolio_compositions']}
+
+    def test_retrieve_portfolio_as_of(self):
+        created = datetime.utcnow()
+        updated = self.patch_portfolio(2, {3: 70, 4: 30})
+
+        self.assertEqual(self.read_as_of(2, self.before).status_code, 404)
+        self.assertEqual(self.holdings(2, created),
+                         {('SECURITY_2', 50), ('SECURITY_3', 50)})
+        self.assertEqual(self.holdings(2, updated),
+                         {('SECURITY_3', 70), ('SECURITY_4', 30)})
+        self.assertEqual(
+            PortfolioCompositionHistory.query.filter_by(
+                portfolio_id=2).count(), 4)
+
+    def test_snapshots_bound_as_of_reads(self):
+        history = []
+        for weight in range(10, 100, 10):
+            history.append((
+                self.patch_portfolio(
+                    1, {weight % 6 + 1: weight, 6: 100 - weight}),
+                {('SECURITY_{}'.format(weight % 6 + 1), weight),
+                 ('SECURITY_6', 100 - weight)}))
+
+        snapshots = PortfolioSnapshot.query.filter_by(portfolio_id=1).all()
+        self.assertTrue(len(snapshots) >= 2)
+        for as_of, holdings in history:
+            self.assertEqual(self.holdings(1, as_of), holdings)
+
+        # the latest read only goes through the rows since the last snapshot
+        snapshot = PortfolioSnapshot.latest(1)
+        appended = PortfolioCompositionHistory.query.filter(
+            PortfolioCompositionHistory.portfolio_id == 1,
+            PortfolioCompositionHistory.valid_from > snapshot.taken_at).count()
+        self.assertTrue(appended < models.COMPOSITION_SNAPSHOT_INTERVAL)
+
+    def test_as_of_read_statements(self):
+        for weight in range(10, 60, 10):
+            as_of = self.patch_portfolio(1, {1: weight, 2: 100 - weight})
+        self.assertIsNotNone(PortfolioSnapshot.latest(1))
+
+        res, statements = self.capture_statements(
+            'get', '/portfolios/1?as_of={}'.format(as_of.isoformat()))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['portfolio_compositions']), 2)
+        # the name and snapshot, then the rows joined with their securities
+        self.assertEqual(len(statements), 2)
+
+    def test_deleted_portfolio_history_is_closed(self):
+        res = self.client().delete('/portfolios/1', headers=self.headers())
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(PortfolioCompositionHistory.query.filter_by(
+            portfolio_id=1, valid_to=None).count(), 0)
+        self.assertEqual(PortfolioCompositionHistory.query.filter_by(
+            portfolio_id=1).count(), 2)
+
+    def test_deleted_portfolio_is_read_from_history(self):
+        created = datetime.utcnow()
+        self.client().delete('/portfolios/1', headers=self.headers())
+        deleted = datetime.utcnow()
+
+        res = self.client().get(
+            '/portfolios/1?as_of={}'.format(created.isoformat()),
+            headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['portfolio_name'], 'PORTFOLIO_1')
+        self.assertEqual(len(data['portfolio_compositions']), 2)
+
+        self.assertEqual(self.read_as_of(1, deleted).status_code, 404)
+        self.assertEqual(self.read_as_of(100, created).status_code, 404)
+
+    def test_portfolio_name_as_of(self):
+        created = datetime.utcnow()
+        res = self.client().patch('/portfolios/2', headers=self.headers(),
+                                  json={'portfolio_name': 'RENAMED'})
+        self.assertEqual(res.status_code, 200)
+        renamed = datetime.utcnow()
+
+        def name(as_of):
+            res = self.read_as_of(2, as_of)
+            self.assertEqual(res.status_code, 200)
+            return json.loads(res.data)['portfolio_name']
+
+        self.assertEqual(name(created), 'PORTFOLIO_2')
+        self.assertEqual(name(renamed), 'RENAMED')
+
+    def test_retrieve_portfolio_as_of_date(self):
+        res = self.client().get(
+            '/portfolios/1?as_of={}'.format(datetime.utcnow().date()),
+            headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['portfolio_compositions']), 2)
+        self.assertTrue(data['as_of'].endswith('23:59:59.999999'))
+
+    def test_422_retrieve_portfolio_as_of_invalid_date(self):
+        res = self.client().get(
+            '/portfolios/1?as_of=yesterday', headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+
+
+class PortfolioSummaryTestCase(LocalDatabaseTestCase):
+    """This class represents the portfolio summary read model test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=6)
+        res = self.client().post(
+            '/portfolios/batch', headers=self.headers(), json={'portfolios': [
+                {'portfolio_name': 'PORTFOLIO_1', 'portfolio_compositions': [
+                    {'security_id': 1, 'weight': 60},
+                    {'security_id': 2, 'weight': 40}]},
+                {'portfolio_name': 'PORTFOLIO_2', 'portfolio_compositions': [
+                    {'security_id': 2, 'weight': 50},
+                    {'security_id': 3, 'weight': 25},
+                    {'security_id': 4, 'weight': 25}]}]})
+        self.assertEqual(res.status_code, 200)
+
+    def summaries(self):
+        res, statements = self.capture_statements(
+            'get', '/portfolios?view=summary')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        return {summary['portfolio_id']: summary
+                for summary in json.loads(res.data)['portfolios']}
+
+    def test_retrieve_portfolio_summaries(self):
+        summaries = self.summaries()
+
+        self.assertEqual(summaries[1], {
+            'portfolio_id': 1, 'portfolio_name': 'PORTFOLIO_1',
+            'holding_count': 2,
+            'by_region': {'Asia Pacific': 60, 'Europe': 40},
+            'by_asset_class': {'Equity': 60, 'Fixed Income': 40}})
+        exposures = portfolio_exposures([1, 2])
+        for portfolio_id, summary in summaries.items():
+            self.assertEqual(summary['by_region'],
+                             exposures[portfolio_id]['by_region'])
+            self.assertEqual(summary['by_asset_class'],
+                             exposures[portfolio_id]['by_asset_class'])
+
+    def test_update_portfolio_refreshes_summary(self):
+        res = self.client().patch(
+            '/portfolios/1', headers=self.headers(), json={
+                'portfolio_name': 'PORTFOLIO_ONE',
+                'portfolio_compositions': [
+                    {'security_id': 1, 'weight': 50},
+                    {'security_id': 4, 'weight': 30},
+                    {'security_id': 5, 'weight': 20}]})
+        self.assertEqual(res.status_code, 200)
+
+        summary = self.summaries()[1]
+        self.assertEqual(summary['portfolio_name'], 'PORTFOLIO_ONE')
+        self.assertEqual(summary['holding_count'], 3)
+        self.assertEqual(summary['by_region'],
+                         {'Asia Pacific': 50, 'Africa': 30, 'America': 20})
+
+    def test_update_security_refreshes_holders_summaries(self):
+        res = self.client().patch(
+            '/securities/2', headers=self.headers(),
+            json={'region_id': 5, 'asset_class_id': 2})
+        self.assertEqual(res.status_code, 200)
+
+        summaries = self.summaries()
+        self.assertEqual(summaries[1]['by_region'],
+                         {'Asia Pacific': 60, 'America': 40})
+        self.assertEqual(summaries[2]['by_region'],
+                         {'America': 50, 'Middle East': 25, 'Africa': 25})
+
+    def test_delete_portfolio_removes_summary(self):
+        res = self.client().delete('/portfolios/1', headers=self.headers())
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(list(self.summaries()), [2])
+        self.assertIsNone(PortfolioSummary.query.get(1))
+
+    def test_422_retrieve_portfolios_unknown_view(self):
+        res = self.client().get(
+            '/portfolios?view=full', headers=self.headers())
+
+        self.assertEqual(res.status_code, 422)
+
+
+class ReadReplicaTestCase(LocalDatabaseTestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.replica_fd, self.replica_file = tempfile.mkstemp(suffix='.db')
+        setup_db(self.app, 'sqlite:///' + self.db_file,
+                 'sqlite:///' + self.replica_file)
+        db.Model.metadata.create_all(bind=self.replica_engine())
+        self.securities = seed_reference_data(security_count=4)
+        add_portfolios(self.securities, count=2, holding_count=2)
+
+    def tearDown(self):
+        self.replica_engine().dispose()
+        super().tearDown()
+        os.close(self.replica_fd)
+        os.unlink(self.replica_file)
+
+    def replica_engine(self):
+        return db.get_engine(self.app, bind='replica')
+
+    def replicate(self):
+        self.replica_engine().dispose()
+        shutil.copyfile(self.db_file, self.replica_file)
+
+    def test_retrieve_handlers_read_from_replica(self):
+        res = self.client().get('/portfolios', headers=self.headers())
+        self.assertEqual(res.status_code, 404)
+
+        self.replicate()
+        res = self.client().get('/portfolios', headers=self.headers())
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['portfolios']), 2)
+
+    def test_similar_portfolios_search_reads_from_replica(self):
+        def search():
+            res = self.client().post(
+                '/portfolios/similar', headers=self.headers(), json={
+                    'portfolio_compositions': [
+                        {'security_id': 1, 'weight': 100}]})
+            self.assertEqual(res.status_code, 200)
+            return json.loads(res.data)['by_overlap']
+
+        self.assertEqual(search(), [])
+
+        self.replicate()
+        self.assertEqual(len(search()), 2)
+
+    def test_writes_go_to_primary(self):
+        self.replicate()
+        res = self.client().get('/portfolios/1', headers=self.headers())
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().patch('/portfolios/1', headers=self.headers(),
+                                  json={'portfolio_name': 'PRIMARY'})
+        self.assertEqual(res.status_code, 200)
+
+        primary = db.get_engine(self.app)
+        replica = self.replica_engine()
+        self.assertEqual(primary.execute(
+            'SELECT name FROM portfolio WHERE id = 1').scalar(), 'PRIMARY')
+        self.assertEqual(replica.execute(
+            'SELECT name FROM portfolio WHERE id = 1').scalar(), 'PORTFOLIO_1')
+
+    def test_engine_options(self):
+        originals = (models.DB_POOL_SIZE, models.DB_MAX_OVERFLOW,
+                     models.DB_POOL_RECYCLE, models.DB_POOL_PRE_PING,
+                     models.DB_STATEMENT_TIMEOUT)
+        models.DB_POOL_SIZE, models.DB_MAX_OVERFLOW = 5, 10
+        models.DB_POOL_RECYCLE, models.DB_POOL_PRE_PING = 1800, True
+        models.DB_STATEMENT_TIMEOUT = 2000
+        try:
+            postgres = engine_options(make_url('postgresql://localhost/db'))
+            sqlite = engine_options(make_url('sqlite:///' + self.db_file))
+        finally:
+            (models.DB_POOL_SIZE, models.DB_MAX_OVERFLOW,
+             models.DB_POOL_RECYCLE, models.DB_POOL_PRE_PING,
+             models.DB_STATEMENT_TIMEOUT) = originals
+
+        self.assertEqual(postgres, {
+            'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 1800,
+            'pool_pre_ping': True,
+            'connect_args': {'options': '-c statement_timeout=2000'}})
+        self.assertEqual(sqlite, {'pool_recycle': 1800, 'pool_pre_ping': True})
+
+
+class AsyncServingTestCase(LocalDatabaseTestCase):
+    """This class represents the ASGI entry point test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=6)
+        add_portfolios(self.securities, count=8, holding_count=3)
+        self.async_client = TestClient(asgi.create_asgi_app(
+            'sqlite:///' + self.db_file, self.app)).__enter__()
+
+    def tearDown(self):
+        self.async_client.__exit__(None, None, None)
+        super().tearDown()
+
+    @staticmethod
+    def normalize(data):
+        """Compositions come back in a different order from the two apps"""
+        for portfolio in data.get('portfolios', []) + [data]:
+            if 'portfolio_compositions' in portfolio:
+                portfolio['portfolio_compositions'].sort(
+                    key=lambda composition: composition['security_name'])
+        return data
+
+    @staticmethod
+    def cors_headers(headers):
+        """The CORS headers, with repeated headers merged as a client would"""
+        return {
+            name: {value.strip() for value in
+                   ','.join(headers.getlist(name) if hasattr(
+                       headers, 'getlist') else [headers[name]]).split(',')}
+            for name in ['Access-Control-Allow-Origin',
+                         'Access-Control-Allow-Headers',
+                         'Access-Control-Allow-Methods', 'Vary']
+            if name in headers}
+
+    def test_async_reads_match_sync_app(self):
+        for url in ['/portfolios', '/portfolios?limit=3',
+                    '/portfolios?limit=x', '/portfolios/2',
+                    '/portfolios/100', '/securities', '/securities/4',
+                    '/securities/3/portfolios', '/regions', '/asset_classes']:
+            for origin in ({}, {'Origin': 'https://app.example.com'}):
+                headers = dict(self.headers(), **origin)
+                sync = self.client().get(url, headers=headers)
+                res = self.async_client.get(url, headers=headers)
+
+                self.assertEqual(res.status_code, sync.status_code, url)
+                self.assertEqual(self.normalize(res.json()),
+                                 self.normalize(json.loads(sync.data)), url)
+                self.assertEqual(res.headers.get('ETag'),
+                                 sync.headers.get('ETag'))
+                self.assertEqual(self.cors_headers(res.headers),
+                                 self.cors_headers(sync.headers), url)
+
+    def test_preflight_matches_sync_app(self):
+        headers = {'Origin': 'https://app.example.com',
+                   'Access-Control-Request-Method': 'GET',
+                   'Access-Control-Request-Headers': 'Authorization'}
+        for url in ['/portfolios', '/portfolios/2', '/securities',
+                    '/securities/4', '/securities/3/portfolios', '/regions',
+                    '/asset_classes']:
+            sync = self.client().options(url, headers=headers)
+            res = self.async_client.options(url, headers=headers)
+
+            self.assertEqual(res.status_code, 200, url)
+            self.assertEqual(res.status_code, sync.status_code, url)
+            self.assertEqual(self.cors_headers(res.headers),
+                             self.cors_headers(sync.headers), url)
+
+    def test_async_requests_are_timed(self):
+        route = '/portfolios/<int:portfolio_id>'
+        requests = sample('http_request_duration_seconds_count',
+                          method='GET', route=route, status='200')
+        not_found = sample('http_request_duration_seconds_count',
+                           method='GET', route=route, status='404')
+        statements = sample('http_request_sql_statements_sum', route=route)
+        auth_checks = sample('http_request_auth_seconds_count', route=route)
+
+        self.async_client.get('/portfolios/2', headers=self.headers())
+        self.async_client.get('/portfolios/100', headers=self.headers())
+
+        self.assertEqual(sample('http_request_duration_seconds_count',
+                                method='GET', route=route, status='200'),
+                         requests + 1)
+        self.assertEqual(sample('http_request_duration_seconds_count',
+                                method='GET', route=route, status='404'),
+                         not_found + 1)
+        # the portfolio and its compositions, then the missing portfolio
+        self.assertEqual(
+            sample('http_request_sql_statements_sum', route=route),
+            statements + 3)
+        self.assertEqual(
+            sample('http_request_auth_seconds_count', route=route),
+            auth_checks + 2)
+
+    def test_async_pagination_and_conditional_get(self):
+        res = self.async_client.get(
+            '/portfolios?limit=5', headers=self.headers())
+        cursor = res.json()['next_cursor']
+        res = self.async_client.get(
+            '/portfolios?limit=5&cursor=' + cursor, headers=self.headers())
+
+        self.assertEqual([p['portfolio_id'] for p in res.json()['portfolios']],
+                         [6, 7, 8])
+        self.assertIsNone(res.json()['next_cursor'])
+
+        etag = self.async_client.get(
+            '/portfolios/1', headers=self.headers()).headers['ETag']
+        res = self.async_client.get('/portfolios/1', headers=dict(
+            self.headers(), **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_other_routes_fall_back_to_flask(self):
+        res = self.async_client.post(
+            '/portfolios', headers=self.headers(), json={
+                'portfolio_name': 'FALLBACK', 'portfolio_compositions': [
+                    {'security_id': 1, 'weight': 100}]})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.async_client.get(
+            '/portfolios/1/exposure', headers=self.headers())
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['portfolio_id'], 1)
+
+    def test_async_errors(self):
+        res = self.async_client.get('/portfolios/100', headers=self.headers())
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.json()['message'], 'Not Found')
+
+        res = self.async_client.get('/portfolios?cursor=invalid',
+                                    headers=self.headers())
+        self.assertEqual(res.status_code, 422)
+
+        res = self.async_client.get('/securities')
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json()['success'], False)
+
+
+class ColumnarFormatTestCase(LocalDatabaseTestCase):
+    """This class represents the columnar response format test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=12)
+        add_portfolios(self.securities, count=10, holding_count=4)
+
+    def test_columnar_securities(self):
+        res, statements = self.capture_statements(
+            'get', '/securities?format=columnar&limit=8')
+        data = json.loads(res.data)
+        rows = json.loads(self.client().get(
+            '/securities?limit=8', headers=self.headers()).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        columns = data['securities']
+        self.assertEqual([{
+            'security_id': columns['security_id'][i],
+            'security_name': columns['security_name'][i],
+            'region': data['regions'][columns['region'][i]],
+            'asset_class': data['asset_classes'][columns['asset_class'][i]]
+        } for i in range(len(columns['security_id']))], rows['securities'])
+        self.assertEqual(data['next_cursor'], rows['next_cursor'])
+
+    def test_columnar_portfolios(self):
+        res, statements = self.capture_statements(
+            'get', '/portfolios?format=columnar')
+        data = json.loads(res.data)
+        rows = json.loads(self.client().get(
+            '/portfolios', headers=self.headers()).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(data['portfolios']['portfolio_id'], list(range(1, 11)))
+        compositions = data['portfolio_compositions']
+        for portfolio in rows['portfolios']:
+            decoded = [{
+                'security_name': compositions['security_name'][i],
+                'region': data['regions'][compositions['region'][i]],
+                'asset_class':
+                    data['asset_classes'][compositions['asset_class'][i]],
+                'weight': compositions['weight'][i]
+            } for i, portfolio_id in enumerate(compositions['portfolio_id'])
+                if portfolio_id == portfolio['portfolio_id']]
+            self.assertCountEqual(decoded, portfolio['portfolio_compositions'])
+        self.assertLess(len(res.data), len(json.dumps(rows)))
+
+    def test_422_unknown_format(self):
+        res = self.client().get(
+            '/securities?format=rows', headers=self.headers())
+        self.assertEqual(res.status_code, 422)
+
+        res = self.client().get(
+            '/portfolios?format=columnar&view=summary', headers=self.headers())
+        self.assertEqual(res.status_code, 422)
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class MetricsTestCase(LocalDatabaseTestCase):
+    """This class represents the /metrics test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.securities = seed_reference_data(security_count=5)
+        add_portfolios(self.securities, count=3, holding_count=2)
+
+    def test_request_is_timed_by_route(self):
+        route = '/portfolios/<int:portfolio_id>'
+        requests = sample('http_request_duration_seconds_count',
+                          method='GET', route=route, status='200')
+        statements = sample('http_request_sql_statements_sum', route=route)
+        auth_checks = sample('http_request_auth_seconds_count', route=route)
+
+        res, captured = self.capture_statements('get', '/portfolios/2')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sample('http_request_duration_seconds_count',
+                                method='GET', route=route, status='200'),
+                         requests + 1)
+        self.assertEqual(
+            sample('http_request_sql_statements_sum', route=route),
+            statements + len(captured))
+        self.assertEqual(
+            sample('http_request_auth_seconds_count', route=route),
+            auth_checks + 1)
+        self.assertGreater(
+            sample('http_request_sql_seconds_sum', route=route), 0)
+
+    def test_error_status_is_labelled(self):
+        route = '/portfolios/<int:portfolio_id>'
+        not_found = sample('http_request_duration_seconds_count',
+                           method='GET', route=route, status='404')
+        unauthorized = sample('http_request_duration_seconds_count',
+                              method='GET', route=route, status='401')
+
+        self.client().get('/portfolios/100', headers=self.headers())
+        self.client().get('/portfolios/1')
+
+        self.assertEqual(sample('http_request_duration_seconds_count',
+                                method='GET', route=route, status='404'),
+                         not_found + 1)
+        self.assertEqual(sample('http_request_duration_seconds_count',
+                                method='GET', route=route, status='401'),
+                         unauthorized + 1)
+
+    def test_jwks_fetch_is_timed(self):
+        fetches = sample('jwks_fetch_duration_seconds_count',
+                         outcome='success')
+        failures = sample('jwks_fetch_duration_seconds_count',
+                          outcome='failure')
+
+        auth.verify_decode_jwt(make_token('key-1', []))
+        self.opener.fail = True
+        self.clock.now += 600
+        auth.verify_decode_jwt(make_token('key-1', []))
+
+        self.assertEqual(sample('jwks_fetch_duration_seconds_count',
+                                outcome='success'), fetches + 1)
+        self.assertEqual(sample('jwks_fetch_duration_seconds_count',
+                                outcome='failure'), failures + 1)
+
+    def test_metrics_endpoint(self):
+        self.client().get('/portfolios', headers=self.headers())
+        res = self.client().get('/metrics')
+        text = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_request_duration_seconds_bucket', text)
+        self.assertIn('http_request_sql_statements_sum{route="/portfolios"}',
+                      text)
+        self.assertNotIn('route="/metrics"', text)
+
+    def test_multiprocess_samples_are_summed(self):
+        multiproc_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, multiproc_dir)
+        env = dict(os.environ, prometheus_multiproc_dir=multiproc_dir)
+        env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+        for _ in range(2):
+            subprocess.run([
+                sys.executable, '-c',
+                'import metrics; '
+                'metrics.SQL_STATEMENTS.labels("/portfolios").observe(3); '
+                'metrics.TOKEN_CACHE_HITS.inc()'
+            ], env=env, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        text = metrics.render_metrics(multiproc_dir).decode('utf-8')
+
+        self.assertIn(
+            'http_request_sql_statements_count{route="/portfolios"} 2.0', text)
+        self.assertIn(
+            'http_request_sql_statements_sum{route="/portfolios"} 6.0', text)
+        self.assertIn('token_cache_hits_total 2.0', text)
+
+
+class SlowQueryLogTestCase(LocalDatabaseTestCase):
+    """This class represents the slow-query log test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.log_fd, self.log_file = tempfile.mkstemp(suffix='.log')
+        setup_db(self.app, 'sqlite:///' + self.db_file,
+                 slow_query_threshold=0, slow_query_log_file=self.log_file)
+        self.log = self.app.extensions['slow_query_log']
+        self.securities = seed_reference_data(security_count=5)
+        add_portfolios(self.securities, count=3, holding_count=2)
+        self.log.wait()
+        open(self.log_file, 'w').close()
+
+    def tearDown(self):
+        slow_query_log.install(self.app, None)
+        os.close(self.log_fd)
+        os.unlink(self.log_file)
+        super().tearDown()
+
+    def entries(self):
+        self.log.wait()
+        with open(self.log_file) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_slow_statements_are_logged_with_route_and_plan(self):
+        res = self.client().get('/portfolios/2', headers=self.headers())
+        self.assertEqual(res.status_code, 200)
+
+        entries = self.entries()
+        statements = [entry for entry in entries
+                      if entry.get('route') == '/portfolios/<int:portfolio_id>']
+        plans = {entry['fingerprint']: entry['plan']
+                 for entry in entries if 'plan' in entry}
+
+        self.assertTrue(statements)
+        for entry in statements:
+            self.assertTrue(entry['statement'].lstrip().startswith('SELECT'))
+            self.assertNotIn(2, entry['parameters'])
+            self.assertIn(entry['fingerprint'], plans)
+        self.assertIn(['<int>'], [entry['parameters'] for entry in statements])
+        self.assertTrue(any('portfolio' in plan for plan in plans.values()))
+
+    def test_statements_under_threshold_are_not_logged(self):
+        self.log.threshold_ms = 60000
+        self.client().get('/portfolios/2', headers=self.headers())
+        self.assertEqual(self.entries(), [])
+
+    def test_top_statements_by_fingerprint(self):
+        headers = self.headers(
+            FUND_MANAGER_PERMISSIONS + ['get:slow_queries'])
+        self.client().get('/portfolios/1', headers=self.headers())
+        self.client().get('/portfolios/3', headers=self.headers())
+
+        res = self.client().get('/admin/slow_queries', headers=headers)
+        data = json.loads(res.data)
+        self.log.wait()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['threshold_ms'], 0)
+        max_ms = [entry['max_ms'] for entry in data['statements']]
+        self.assertEqual(max_ms, sorted(max_ms, reverse=True))
+        composition_reads = [
+            entry for entry in data['statements']
+            if '/portfolios/<int:portfolio_id>' in entry['routes'] and
+            'FROM portfolio_composition' in entry['statement']]
+        self.assertEqual(len(composition_reads), 1)
+        self.assertEqual(composition_reads[0]['count'], 2)
+
+        res = self.client().get('/admin/slow_queries?limit=1', headers=headers)
+        self.assertEqual(len(json.loads(res.data)['statements']), 1)
+        res = self.client().get('/admin/slow_queries?limit=x', headers=headers)
+        self.assertEqual(res.status_code, 422)
+        res = self.client().get(
+            '/admin/slow_queries', headers=self.headers())
+        self.assertEqual(res.status_code, 401)
+
+    def test_404_when_disabled(self):
+        slow_query_log.install(self.app, None)
+        res = self.client().get('/admin/slow_queries', headers=self.headers(
+            FUND_MANAGER_PERMISSIONS + ['get:slow_queries']))
+        self.assertEqual(res.status_code, 404)
+
+    def test_fingerprint_ignores_values(self):
+        first = slow_query_log.normalize(
+            "SELECT * FROM security WHERE id IN (?, ?, ?) AND name = 'A'")
+        second = slow_query_log.normalize(
+            "SELECT *\nFROM security WHERE id IN (%(id_1)s) AND name = 'B'")
+        self.assertEqual(first, second)
+        self.assertEqual(slow_query_log.redact({'id': 3, 'name': None}),
+                         {'id': '<int>', 'name': None})
+
+    def test_locking_reads_are_not_analyzed(self):
+        self.assertEqual(slow_query_log.explain_prefix(
+            'postgresql', 'SELECT * FROM portfolio WHERE id = %(id)s'),
+            'EXPLAIN (ANALYZE, BUFFERS) ')
+        self.assertEqual(slow_query_log.explain_prefix(
+            'postgresql', 'SELECT * FROM portfolio WHERE id = %(id)s '
+            'FOR UPDATE'), 'EXPLAIN ')
+        self.assertEqual(slow_query_log.explain_prefix(
+            'postgresql', 'SELECT * FROM portfolio FOR SHARE'), 'EXPLAIN ')
+        self.assertIsNone(slow_query_log.explain_prefix(
+            'postgresql', 'UPDATE portfolio SET version = 2'))
+
+    def test_failed_statement_leaves_no_start_time(self):
+        with self.app.test_request_context():
+            connection = db.session.connection()
+            with self.assertRaises(SQLAlchemyError):
+                connection.execute('SELECT * FROM missing_table')
+            db.session.rollback()
+            connection = db.session.connection()
+            connection.execute('SELECT 1')
+
+            self.assertFalse(connection.info.get('slow_query_started'))
+        self.assertIn('SELECT 1', [entry.get('statement')
+                                   for entry in self.entries()])
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """This class represents the in-process benchmark test case"""
+
+    def setUp(self):
+        self.db_fd, self.db_file = tempfile.mkstemp(suffix='.db')
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(self.db_file)
+
+    def test_every_route_is_benchmarked(self):
+        original_store = auth.jwks_store
+        report = benchmark.run_app(
+            'sqlite:///' + self.db_file, concurrency=2, requests=4,
+            portfolio_count=12, security_count=30, holding_count=5)
+
+        self.assertIs(auth.jwks_store, original_store)
+        routes = report['routes']
+        for name, route in routes.items():
+            self.assertEqual(route['errors'], 0, name)
+            self.assertEqual(route['requests'], 4)
+            self.assertIsNotNone(route['p99_ms'])
+        self.assertEqual(
+            routes['GET /portfolios/<int:portfolio_id>']
+            ['statements_per_request'], 3)
+
+        # every route of the app but the operational ones
+        rules = {'{} {}'.format(method, rule.rule)
+                 for rule in create_app().url_map.iter_rules()
+                 for method in rule.methods - {'HEAD', 'OPTIONS'}
+                 if rule.endpoint not in ('static', 'metrics',
+                                          'retrieve_slow_queries')}
+        self.assertEqual(
+            {name.split('?')[0] for name in routes}, rules)
+
+    def test_regressions_against_baseline(self):
+        baseline = {'routes': {'GET /regions': {
+            'statements_per_request': 1, 'requests_per_second': 100.0,
+            'p95_ms': 10.0}}}
+        report = {'routes': {'GET /regions': {
+            'statements_per_request': 2, 'requests_per_second': 90.0,
+            'p95_ms': 20.0}}}
+
+        found = benchmark.regressions(report, baseline, tolerance=0.25)
+
+        self.assertEqual([entry['metric'] for entry in found],
+                         ['statements_per_request', 'p95_ms'])
+
+
+class SyntheticDataTestCase(LocalDatabaseTestCase):
+    """This class represents the synthetic data generator test case"""
+
+    def test_generation_is_deterministic(self):
+        first = synthetic_data.generate(7, 5, 3, 200, 50, 20)
+        second = synthetic_data.generate(7, 5, 3, 200, 50, 20)
+        other = synthetic_data.generate(8, 5, 3, 200, 50, 20)
+
+        np.testing.assert_array_equal(first.securities, second.securities)
+        np.testing.assert_array_equal(first.compositions, second.compositions)
+        self.assertFalse(
+            np.array_equal(first.compositions, other.compositions))
+
+    def test_weights_sum_to_100(self):
+        data = synthetic_data.generate(0, 5, 3, 300, 400, 30)
+        compositions = data.compositions
+
+        totals = np.bincount(compositions[:, 0], weights=compositions[:, 2])
+        self.assertTrue(np.all(totals[data.portfolio_ids] == 100))
+        self.assertGreaterEqual(compositions[:, 2].min(), 1)
+        counts = np.bincount(compositions[:, 0])[data.portfolio_ids]
+        self.assertLessEqual(counts.max(), 100)
+        self.assertLess(counts.min(), counts.max())
+        pairs = compositions[:, 0] * 1000 + compositions[:, 1]
+        self.assertEqual(len(np.unique(pairs)), len(pairs))
+
+    def test_load(self):
+        counts = synthetic_data.load_synthetic_data(0, 6, 3, 100, 40, 10)
+        self.assertEqual(counts['portfolios'], 40)
+        self.assertEqual(Security.query.count(), 100)
+        self.assertEqual(
+            PortfolioComposition.query.count(),
+            counts['portfolio_compositions'])
+        self.assertEqual(
+            PortfolioCompositionHistory.query.count(),
+            counts['portfolio_compositions'])
+        self.assertEqual(PortfolioSummary.query.count(), 40)
+        self.assertEqual(Region.query.get(1).name, 'Asia Pacific')
+        self.assertEqual(Region.query.get(6).name, 'REGION_6')
+
+        # a second load is numbered after the first
+        synthetic_data.load_synthetic_data(1, 1, 1, 10, 5, 3)
+        self.assertEqual(Security.query.count(), 110)
+        self.assertEqual(Region.query.get(7).name, 'REGION_7')
+
+        res = self.client().get('/portfolios/45', headers=self.headers())
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sum(composition['weight'] for composition
+                             in data['portfolio_compositions']), 100)
+        res = self.client().get(
+            '/portfolios?view=summary&limit=100', headers=self.headers())
+        self.assertEqual(len(json.loads(res.data)['portfolios']), 45)
+
+
+class OfflineKeySetTestCase(LocalAuthTestCase):
+    """This class represents the local key set test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.key_fd, self.key_file = tempfile.mkstemp(suffix='.json')
+        self.write_key_set('key-1')
+
+    def tearDown(self):
+        auth.jwks_store.stop_refresher()
+        os.close(self.key_fd)
+        os.unlink(self.key_file)
+        super().tearDown()
+
+    def write_key_set(self, *kids):
+        with open(self.key_file, 'w') as key_file:
+            json.dump({'keys': [make_signing_key(kid)[1] for kid in kids]},
+                      key_file)
+
+    def test_key_set_is_read_from_file_at_startup(self):
+        auth.jwks_store = auth.configured_key_store(
+            key_file=self.key_file, keys_variable='UNSET_JWKS_KEYS',
+            refresh_in_background=False)
+
+        self.assertIs(auth.jwks_store.opener, auth.read_file)
+        self.assertIsNotNone(auth.jwks_store._fetched_at)
+        payload = auth.verify_decode_jwt(
+            make_token('key-1', ['get:portfolios']))
+        self.assertEqual(payload['permissions'], ['get:portfolios'])
+
+    def test_pem_keys_from_environment(self):
+        private_key = rsa.PrivateKey.load_pkcs1(make_signing_key('key-1')[0])
+        public_pem = rsa.PublicKey(private_key.n, private_key.e).save_pkcs1()
+        os.environ['TEST_JWKS_KEYS'] = public_pem.decode('utf-8')
+        self.addCleanup(os.environ.pop, 'TEST_JWKS_KEYS')
+
+        auth.jwks_store = auth.configured_key_store(
+            keys_variable='TEST_JWKS_KEYS', refresh_in_background=False)
+        kid, = auth.jwks_store._keys
+        public_jwk = make_signing_key('key-1')[1]
+        digest = hashlib.sha256(json.dumps(
+            {'e': public_jwk['e'], 'kty': 'RSA', 'n': public_jwk['n']},
+            sort_keys=True, separators=(',', ':')).encode('utf-8')).digest()
+        self.assertEqual(
+            kid, base64.urlsafe_b64encode(digest).decode('utf-8').rstrip('='))
+
+        token = jwt.encode(
+            jwt.get_unverified_claims(make_token('key-1', [])),
+            make_signing_key('key-1')[0], algorithm='RS256',
+            headers={'kid': kid})
+        self.assertEqual(auth.verify_decode_jwt(token)['sub'], 'auth0|local')
+
+        keys = auth.JWKSKeyStore.parse_key_set(public_pem, pem_kid='key-1')
+        self.assertEqual(list(keys), ['key-1'])
+
+    def test_broken_key_set_fails_at_startup(self):
+        with open(self.key_file, 'w') as key_file:
+            key_file.write('not a key set')
+
+        with self.assertRaises(auth.AuthError):
+            auth.configured_key_store(
+                key_file=self.key_file, keys_variable='UNSET_JWKS_KEYS')
+
+    def test_background_refresher(self):
+        reads = []
+
+        def read_file(path, timeout=None):
+            reads.append(threading.current_thread().name)
+            return auth.read_file(path)
+
+        store = auth.JWKSKeyStore(self.key_file, ttl=0.05,
+                                  min_refresh_interval=0, opener=read_file,
+                                  refresh_in_background=True)
+        auth.jwks_store = store
+        auth.verify_decode_jwt(make_token('key-1', []))
+
+        self.write_key_set('key-1', 'key-2')
+        deadline = time.monotonic() + 5
+        while 'key-2' not in store._keys and time.monotonic() < deadline:
+            auth.verify_decode_jwt(make_token('key-1', []))
+            time.sleep(0.01)
+        refresher = store._refresher
+        store.stop_refresher()
+
+        self.assertIn('key-2', store._keys)
+        self.assertFalse(refresher.is_alive())
+        # only the first key set was read on the request path
+        self.assertNotEqual(reads[0], 'jwks-refresher')
+        self.assertEqual(set(reads[1:]), {'jwks-refresher'})
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()